@@ -29,14 +29,44 @@
 #    support for waiting for a card detect event.
 #    This patch is copied from here https://github.com/mxgxw/MFRC522-python/issues/17.
 #
+#    The GPIO and SPI backends can be passed to the constructor (e.g. the simulated
+#    ones of simulation.py), by default RPi.GPIO and the spi module are used.
+#
+#    With irq_completion=True MFRC522_ToCard and CalulateCRC do not poll the
+#    interrupt request registers (up to 2000 respectively 255 SPI reads) but wait
+#    for the IRQ line of the chip. The SPI transfers are counted in total
+#    (spi_transfers) and per operation (operations).
+#
+#    The IRQ line is active low (IRqInv is always set in CommIEnReg) and stays low
+#    as long as an enabled interrupt request is raised. The calling thread blocks
+#    in GPIO.wait_for_edge (the kernel waits for the edge of the sysfs GPIO), no
+#    event detection callback is registered for the IRQ line.
+#
+#    With burst_transfers=True (default) the FIFO is written and read and several
+#    registers are read in a single SPI transfer (the MFRC522 accepts any number of
+#    addresses respectively data bytes within one SPI frame) instead of one
+#    transfer per byte.
+#
+#    The reader keeps a session: the chip is initialised once and only again after
+#    an error (a command that did not complete). The values of the registers that
+#    are only changed by the host are cached, hence bit masks are set without reading
+#    the register first and writes that do not change a register are skipped.
+#
 
-import RPi.GPIO as GPIO
-import spi
 import signal
-import threading
+import time
+
+try:
+  import RPi.GPIO as GPIO
+  import spi
+except ImportError:
+  # not running on a raspberry, backends need to be passed to the constructor
+  GPIO = None
+  spi = None
   
 class MFRC522:
   NRSTPD = 22
+  IRQ = 24
   
   MAX_LEN = 16
   
@@ -62,6 +92,11 @@ class MFRC522:
   PICC_TRANSFER  = 0xB0
   PICC_HALT      = 0x50
   
+  # anticollision/select command of each cascade level and the cascade tag
+  # preceding the first UID bytes of a level if the UID is not complete yet
+  PICC_CASCADE_LEVELS = (0x93, 0x95, 0x97)
+  PICC_CASCADE_TAG    = 0x88
+  
   MI_OK       = 0
   MI_NOTAGERR = 1
   MI_ERR      = 2
@@ -133,29 +168,110 @@ class MFRC522:
   Reserved32      = 0x3D
   Reserved33      = 0x3E
   Reserved34      = 0x3F
+  
+  # registers only changed by the host (cached until the next soft reset)
+  HostRegisters = (CommIEnReg, DivlEnReg, BitFramingReg, ModeReg, TxModeReg, RxModeReg, TxControlReg,
+                   TxAutoReg, TModeReg, TPrescalerReg, TReloadRegH, TReloadRegL)
     
   serNum = []
   
-  def __init__(self, dev='/dev/spidev0.0', spd=1000000):
-    self.irq = threading.Event()
-    spi.openSPI(device=dev,speed=spd)
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setup(self.NRSTPD, GPIO.OUT)
-    GPIO.output(self.NRSTPD, 1)
-    GPIO.setup(24, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-    GPIO.add_event_detect(24, GPIO.FALLING, callback=self.input_cb)
+  def __init__(self, dev='/dev/spidev0.0', spd=1000000, gpio=None, spi_backend=None, irq_completion=False, irq_timeout=0.1, burst_transfers=True):
+    self.gpio = gpio or GPIO
+    self.spi = spi_backend or spi
+    self.irq_completion = irq_completion # wait for the IRQ line instead of polling
+    self.irq_timeout = irq_timeout       # maximum time (in s) to wait for the IRQ line
+    self.burst_transfers = burst_transfers # multiple bytes per SPI transfer
+    self.spi_transfers = 0
+    self.operations = {} # name -> [number of operations, number of SPI transfers]
+    self.registers = {}  # cached values of the HostRegisters
+    self.needs_init = False
+    self.resets = 0
+    self.spi.openSPI(device=dev,speed=spd)
+    self.gpio.setmode(self.gpio.BCM)
+    self.gpio.setup(self.NRSTPD, self.gpio.OUT)
+    self.gpio.output(self.NRSTPD, 1)
+    self.gpio.setup(self.IRQ, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
     self.MFRC522_Init()
   
   def MFRC522_Reset(self):
     self.Write_MFRC522(self.CommandReg, self.PCD_RESETPHASE)
+    self.registers = {}
+    self.resets += 1
   
   def Write_MFRC522(self, addr, val):
-    spi.transfer(((addr<<1)&0x7E,val))
+    if addr in self.HostRegisters:
+      # setting StartSend starts a transmission even if the value does not change
+      if self.registers.get(addr) == val and not (addr == self.BitFramingReg and val & 0x80):
+        return
+      self.registers[addr] = val
+    self.spi_transfers += 1
+    self.spi.transfer(((addr<<1)&0x7E,val))
   
   def Read_MFRC522(self, addr):
-    val = spi.transfer((((addr<<1)&0x7E) | 0x80,0))
+    if addr in self.registers:
+      return self.registers[addr]
+    self.spi_transfers += 1
+    val = self.spi.transfer((((addr<<1)&0x7E) | 0x80,0))
+    if addr in self.HostRegisters:
+      self.registers[addr] = val[1]
     return val[1]
   
+  # read the given registers (an address may be given several times, e.g. the FIFO)
+  def ReadRegisters(self, addrs):
+    if not self.burst_transfers:
+      return [self.Read_MFRC522(addr) for addr in addrs]
+    if not addrs:
+      return []
+    # every byte sent addresses the register returned with the next byte
+    self.spi_transfers += 1
+    val = self.spi.transfer(tuple([((addr<<1)&0x7E) | 0x80 for addr in addrs] + [0]))
+    return list(val[1:])
+  
+  # write the given bytes to the FIFO
+  def WriteFIFO(self, data):
+    if not self.burst_transfers:
+      for value in data:
+        self.Write_MFRC522(self.FIFODataReg, value)
+      return
+    if not data:
+      return
+    # all bytes following the address are written to the same register
+    self.spi_transfers += 1
+    self.spi.transfer(tuple([(self.FIFODataReg<<1)&0x7E] + list(data)))
+  
+  # read the given number of bytes from the FIFO
+  def ReadFIFO(self, count):
+    return self.ReadRegisters([self.FIFODataReg] * count)
+  
+  # count an operation and the SPI transfers done since transfers
+  def CountOperation(self, name, transfers):
+    counts = self.operations.setdefault(name, [0, 0])
+    counts[0] += 1
+    counts[1] += self.spi_transfers - transfers
+  
+  # Wait at most timeout seconds for the IRQ line to become active (low).
+  # Returns whether it is active.
+  def WaitForIRQLine(self, timeout):
+    if self.gpio.input(self.IRQ) == self.gpio.LOW:
+      return True
+    if self.gpio.wait_for_edge(self.IRQ, self.gpio.FALLING, timeout=max(1, int(timeout * 1000))) is not None:
+      return True
+    # an edge right before wait_for_edge has been missed
+    return self.gpio.input(self.IRQ) == self.gpio.LOW
+
+  # Wait for the IRQ line until one of the given bits of the given interrupt
+  # request register is set. Returns the value of the register, None on timeout.
+  def WaitForIRQ(self, reg, bits):
+    deadline = time.time() + self.irq_timeout
+    while True:
+      n = self.Read_MFRC522(reg)
+      if n & bits:
+        return n
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return None
+      self.WaitForIRQLine(remaining)
+  
   def SetBitMask(self, reg, mask):
     tmp = self.Read_MFRC522(reg)
     self.Write_MFRC522(reg, tmp | mask)
@@ -173,6 +289,7 @@ class MFRC522:
     self.ClearBitMask(self.TxControlReg, 0x03)
   
   def MFRC522_ToCard(self,command,sendData):
+    transfers = self.spi_transfers
     backData = []
     backLen = 0
     status = self.MI_ERR
@@ -189,40 +306,57 @@ class MFRC522:
       irqEn = 0x77
       waitIRq = 0x30
     
-    self.Write_MFRC522(self.CommIEnReg, irqEn|0x80)
-    self.ClearBitMask(self.CommIrqReg, 0x80)
-    self.SetBitMask(self.FIFOLevelReg, 0x80)
+    if self.irq_completion:
+      # only the requests waited for drive the IRQ line, e.g. TxIRq would keep it active
+      self.Write_MFRC522(self.CommIEnReg, waitIRq|0x01|0x80)
+    else:
+      self.Write_MFRC522(self.CommIEnReg, irqEn|0x80)
+    # clear all interrupt requests and flush the FIFO
+    # (both registers only act on the bits written, no need to read them first)
+    self.Write_MFRC522(self.CommIrqReg, 0x7F)
+    self.Write_MFRC522(self.FIFOLevelReg, 0x80)
     
     self.Write_MFRC522(self.CommandReg, self.PCD_IDLE);  
     
-    while(i<len(sendData)):
-      self.Write_MFRC522(self.FIFODataReg, sendData[i])
-      i = i+1
+    self.WriteFIFO(sendData)
     
     self.Write_MFRC522(self.CommandReg, command)
       
     if command == self.PCD_TRANSCEIVE:
       self.SetBitMask(self.BitFramingReg, 0x80)
     
-    i = 2000
-    while True:
-      n = self.Read_MFRC522(self.CommIrqReg)
-      i = i - 1
-      if ~((i!=0) and ~(n&0x01) and ~(n&waitIRq)):
-        break
+    if self.irq_completion:
+      # the timer interrupt is raised if the card does not answer
+      n = self.WaitForIRQ(self.CommIrqReg, waitIRq|0x01)
+      completed = n is not None
+      # release the IRQ line
+      self.Write_MFRC522(self.CommIEnReg, 0x80)
+    else:
+      i = 2000
+      while True:
+        n = self.Read_MFRC522(self.CommIrqReg)
+        i = i - 1
+        if ~((i!=0) and ~(n&0x01) and ~(n&waitIRq)):
+          break
+      completed = i != 0
     
     self.ClearBitMask(self.BitFramingReg, 0x80)
+    if not completed:
+      # the chip did not respond as expected, it is initialised again before waiting for the next card
+      self.needs_init = True
   
-    if i != 0:
-      if (self.Read_MFRC522(self.ErrorReg) & 0x1B)==0x00:
+    if completed:
+      # the FIFO level and the valid bits of the last byte are read along with the errors
+      (error, level, control) = self.ReadRegisters((self.ErrorReg, self.FIFOLevelReg, self.ControlReg))
+      if (error & 0x1B)==0x00:
         status = self.MI_OK
 
         if n & irqEn & 0x01:
           status = self.MI_NOTAGERR
       
         if command == self.PCD_TRANSCEIVE:
-          n = self.Read_MFRC522(self.FIFOLevelReg)
-          lastBits = self.Read_MFRC522(self.ControlReg) & 0x07
+          n = level
+          lastBits = control & 0x07
           if lastBits != 0:
             backLen = (n-1)*8 + lastBits
           else:
@@ -233,34 +367,44 @@ class MFRC522:
           if n > self.MAX_LEN:
             n = self.MAX_LEN
     
-          i = 0
-          while i<n:
-            backData.append(self.Read_MFRC522(self.FIFODataReg))
-            i = i + 1;
+          backData = self.ReadFIFO(n)
       else:
         status = self.MI_ERR
 
+    self.CountOperation("ToCard", transfers)
     return (status,backData,backLen)
 
-  def input_cb(self, pin):
-    self.irq.set()
-    self.Write_MFRC522(self.CommIrqReg, 0x00)
-    self.Write_MFRC522(self.DivIrqReg, 0x00)
-
-  def MFRC522_WaitForCard(self):
+  # Wait until a card answers a REQA. Afterwards the card is in READY state,
+  # i.e. it can be selected with MFRC522_Anticoll right away (without MFRC522_Request).
+  # The chip is only initialised if this is needed after an error.
+  # Returns False if no card has answered within the given timeout (in s, None waits forever).
+  def MFRC522_WaitForCard(self, timeout=None):
+    transfers = self.spi_transfers
+    detected = True
+    if timeout is not None:
+      deadline = time.time() + timeout
+    if self.needs_init:
+      self.MFRC522_Init()
     # enable IRQ on detect
-    self.MFRC522_Init()
-    self.irq.clear()
-    self.Write_MFRC522(self.CommIrqReg, 0x00)
-    self.Write_MFRC522(self.DivIrqReg, 0x00)
     self.Write_MFRC522(self.CommIEnReg, 0xA0)
-    # wait for it
-    while not self.irq.wait(0.2):
+    self.Write_MFRC522(self.BitFramingReg, 0x07)
+    self.Write_MFRC522(self.CommIrqReg, 0x7F)
+    self.Write_MFRC522(self.DivIrqReg, 0x7F)
+    # send a REQA every 0.2s until a card answers
+    while True:
       self.Write_MFRC522(self.FIFODataReg, self.PICC_REQIDL)
       self.Write_MFRC522(self.CommandReg, self.PCD_TRANSCEIVE)
       self.Write_MFRC522(self.BitFramingReg, 0x87)
-    self.irq.clear()
-    self.MFRC522_Init()
+      wait = 0.2
+      if timeout is not None:
+        wait = min(wait, deadline - time.time())
+      if self.WaitForIRQLine(max(wait, 0)):
+        break
+      if timeout is not None and time.time() >= deadline:
+        detected = False
+        break
+    self.CountOperation("WaitForCard", transfers)
+    return detected
   
   
   def MFRC522_Request(self, reqMode):
@@ -279,7 +423,7 @@ class MFRC522:
     return (status,backBits)
   
   
-  def MFRC522_Anticoll(self):
+  def MFRC522_Anticoll(self, cascade=PICC_ANTICOLL):
     backData = []
     serNumCheck = 0
     
@@ -287,7 +431,7 @@ class MFRC522:
   
     self.Write_MFRC522(self.BitFramingReg, 0x00)
     
-    serNum.append(self.PICC_ANTICOLL)
+    serNum.append(cascade)
     serNum.append(0x20)
     
     (status,backData,backBits) = self.MFRC522_ToCard(self.PCD_TRANSCEIVE,serNum)
@@ -306,28 +450,47 @@ class MFRC522:
     return (status,backData)
   
   def CalulateCRC(self, pIndata):
-    self.ClearBitMask(self.DivIrqReg, 0x04)
-    self.SetBitMask(self.FIFOLevelReg, 0x80);
-    i = 0
-    while i<len(pIndata):
-      self.Write_MFRC522(self.FIFODataReg, pIndata[i])
-      i = i + 1
+    transfers = self.spi_transfers
+    self.Write_MFRC522(self.DivIrqReg, 0x04)
+    self.Write_MFRC522(self.FIFOLevelReg, 0x80)
+    self.WriteFIFO(pIndata)
     self.Write_MFRC522(self.CommandReg, self.PCD_CALCCRC)
-    i = 0xFF
-    while True:
-      n = self.Read_MFRC522(self.DivIrqReg)
-      i = i - 1
-      if not ((i != 0) and not (n&0x04)):
-        break
+    # the CRC of a few bytes is usually done at the first read,
+    # hence the result is read along with the interrupt request
+    (n, resultL, resultM) = self.ReadRegisters((self.DivIrqReg, self.CRCResultRegL, self.CRCResultRegM))
+    if not (n & 0x04):
+      if self.irq_completion:
+        self.Write_MFRC522(self.DivlEnReg, 0x04)
+        self.WaitForIRQ(self.DivIrqReg, 0x04)
+        self.Write_MFRC522(self.DivlEnReg, 0x00)
+      else:
+        i = 0xFE
+        while True:
+          n = self.Read_MFRC522(self.DivIrqReg)
+          i = i - 1
+          if not ((i != 0) and not (n&0x04)):
+            break
+      (resultL, resultM) = self.ReadRegisters((self.CRCResultRegL, self.CRCResultRegM))
     pOutData = []
-    pOutData.append(self.Read_MFRC522(self.CRCResultRegL))
-    pOutData.append(self.Read_MFRC522(self.CRCResultRegM))
+    pOutData.append(resultL)
+    pOutData.append(resultM)
+    self.CountOperation("CalulateCRC", transfers)
     return pOutData
   
   def MFRC522_SelectTag(self, serNum):
+    (status, sak) = self.SelectCascade(serNum, self.PICC_SElECTTAG)
+    if status == self.MI_OK:
+      return    sak
+    else:
+      return 0
+  
+  # select the given 4 UID bytes and check byte (as returned by MFRC522_Anticoll) of the
+  # given cascade level, returns (status, SAK)
+  def SelectCascade(self, serNum, cascade):
     backData = []
     buf = []
-    buf.append(self.PICC_SElECTTAG)
+    self.Write_MFRC522(self.BitFramingReg, 0x00)
+    buf.append(cascade)
     buf.append(0x70)
     i = 0
     while i<5:
@@ -339,10 +502,55 @@ class MFRC522:
     (status, backData, backLen) = self.MFRC522_ToCard(self.PCD_TRANSCEIVE, buf)
     
     if (status == self.MI_OK) and (backLen == 0x18):
-      print "Size: " + str(backData[0])
-      return    backData[0]
+      return (self.MI_OK, backData[0])
     else:
-      return 0
+      return (self.MI_ERR, 0)
+  
+  # Read the complete UID (4, 7 or 10 bytes) of the card in READY state, i.e. run the
+  # anticollision and select of every cascade level. Afterwards the card is selected.
+  # Returns (status, UID)
+  def MFRC522_ReadUID(self):
+    uid = []
+    for cascade in self.PICC_CASCADE_LEVELS:
+      (status, serNum) = self.MFRC522_Anticoll(cascade)
+      if status != self.MI_OK:
+        return (status, uid)
+      (status, sak) = self.SelectCascade(serNum, cascade)
+      if status != self.MI_OK:
+        return (status, uid)
+      if not (sak & 0x04):
+        return (self.MI_OK, uid + serNum[0:4])
+      # UID not complete, the first byte is the cascade tag
+      uid += serNum[1:4]
+    return (self.MI_ERR, uid)
+  
+  # select the card with the given UID (4, 7 or 10 bytes) after it has answered REQA or WUPA
+  def MFRC522_SelectUID(self, uid):
+    parts = []
+    rest = list(uid)
+    while len(rest) > 4:
+      parts.append([self.PICC_CASCADE_TAG] + rest[0:3])
+      rest = rest[3:]
+    parts.append(rest)
+    for (cascade, part) in zip(self.PICC_CASCADE_LEVELS, parts):
+      serNum = part + [part[0] ^ part[1] ^ part[2] ^ part[3]]
+      (status, sak) = self.SelectCascade(serNum, cascade)
+      if status != self.MI_OK:
+        return status
+    return self.MI_OK
+  
+  # Put the selected card into HALT state: it does not answer REQA anymore
+  # (i.e. it is ignored by MFRC522_WaitForCard) but it can be woken up with WUPA (PICC_REQALL).
+  def MFRC522_Halt(self):
+    buf = []
+    buf.append(self.PICC_HALT)
+    buf.append(0)
+    self.Write_MFRC522(self.BitFramingReg, 0x00)
+    pOut = self.CalulateCRC(buf)
+    buf.append(pOut[0])
+    buf.append(pOut[1])
+    # the card does not answer, i.e. the command ends with a timeout
+    self.MFRC522_ToCard(self.PCD_TRANSCEIVE, buf)
   
   def MFRC522_Auth(self, authMode, BlockAddr, Sectorkey, serNum):
     buff = []
@@ -433,7 +641,8 @@ class MFRC522:
         i = i+1
 
   def MFRC522_Init(self):
-    GPIO.output(self.NRSTPD, 1)
+    self.needs_init = False
+    self.gpio.output(self.NRSTPD, 1)
   
     self.MFRC522_Reset();
     
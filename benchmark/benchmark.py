@@ -0,0 +1,519 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# End-to-end latency benchmarks of the jukebox.
+#
+# The real control code of jukebox.py is run against the fake MPD server of
+# fake_mpd.py and the simulated buttons, RFID reader and LCD of simulation.py.
+# For every path the time from the stimulus (card placed on the reader,
+# button pressed) to each stage is measured:
+# * card:       uid (UID looked up), ping (ping sound started),
+#               mpd_play (play command arrived at MPD), lcd_title (title shown on the LCD)
+# * play_pause: mpd_command (play/pause arrived at MPD), lcd (display updated)
+# * next, prev: mpd_command (next/previous arrived at MPD), lcd (new title shown)
+# * volume:     lcd (volume shown), mpd_setvol (volume sent to MPD)
+#
+# For each stage p50/p95/p99 of the latency since the stimulus and of the
+# duration of the stage itself (since the previous stage) are reported.
+# Furthermore the throughput of rapid repeated card swipes and button presses
+# is measured. The results are written to a JSON file, the results of another
+# version can be compared with --compare.
+#
+# The SPI transfers of the RFID reader are counted per operation (MFRC522_ToCard,
+# CalulateCRC, ...), --rfid-polling polls the reader instead of waiting for its IRQ line.
+#
+# Usage:
+#   python benchmark/benchmark.py [--runs 30] [--output result.json] [--compare old.json]
+#
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+jukebox_dir = os.path.join(benchmark_dir, "..")
+sys.path.insert(0, jukebox_dir)
+
+from clock import monotonic
+import fake_mpd
+
+# maximum time (in s) to wait for a single stage
+stage_timeout = 3.0
+
+# nearest rank percentile of the given sorted values
+def percentile(values, p):
+	if not values:
+		return None
+	rank = int(round(p / 100.0 * len(values) + 0.5)) - 1
+	return values[max(0, min(len(values) - 1, rank))]
+
+# p50/p95/p99/mean/max (in ms) of the given durations (in s)
+def summarize(durations):
+	values = sorted(duration * 1000.0 for duration in durations)
+	if not values:
+		return {"count": 0}
+	return {
+		"count": len(values),
+		"p50": round(percentile(values, 50), 3),
+		"p95": round(percentile(values, 95), 3),
+		"p99": round(percentile(values, 99), 3),
+		"mean": round(sum(values) / len(values), 3),
+		"max": round(values[-1], 3),
+	}
+
+def git_revision():
+	try:
+		with open(os.devnull, "w") as devnull:
+			return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=jukebox_dir, stderr=devnull).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+# records events (MPD commands, LCD frames, function calls) with their timestamps
+# and allows waiting for an event matching a condition
+class Recorder:
+
+	def __init__(self):
+		self.condition = threading.Condition()
+		self.events = [] # (timestamp, kind, data)
+
+	def record(self, timestamp, kind, data):
+		with self.condition:
+			self.events.append((timestamp, kind, data))
+			self.condition.notify_all()
+
+	# first event of the given kind after the given timestamp for which match(data) is true,
+	# returns its timestamp or None if no such event happened within timeout seconds
+	def wait_for(self, kind, after, match=None, timeout=stage_timeout):
+		deadline = monotonic() + timeout
+		with self.condition:
+			while True:
+				for timestamp, event_kind, data in self.events:
+					if event_kind == kind and timestamp >= after and (match is None or match(data)):
+						return timestamp
+				remaining = deadline - monotonic()
+				if remaining <= 0:
+					return None
+				self.condition.wait(remaining)
+
+	def count(self, kind, after, match=None):
+		with self.condition:
+			return len([1 for timestamp, event_kind, data in self.events
+				if event_kind == kind and timestamp >= after and (match is None or match(data))])
+
+	def clear(self):
+		with self.condition:
+			self.events = []
+
+
+class Benchmark:
+
+	def __init__(self, options):
+		self.options = options
+		self.recorder = Recorder()
+		self.results = {"paths": {}, "throughput": {}}
+
+	#-------------------------------------------------------------------
+	# setup
+
+	def start(self):
+		with open(os.path.join(jukebox_dir, "library.json")) as data_file:
+			directories = [entry['directory'] for entry in json.load(data_file)]
+		self.mpd_server = fake_mpd.FakeMPDServer(directories, self.options.tracks, response_delay=self.options.mpd_delay / 1000.0)
+		self.mpd_server.command_listeners.append(lambda timestamp, name, args: self.recorder.record(timestamp, "mpd", (name, args)))
+		self.mpd_server.start()
+
+		os.environ["JUKEBOX_SIMULATION"] = "1"
+		os.environ["MPD_HOST"] = self.mpd_server.host
+		os.environ["MPD_PORT"] = str(self.mpd_server.port)
+
+		import jukebox
+		self.jukebox = jukebox
+
+		# the jukebox prints a lot, keep the output of the benchmark readable
+		# (jukebox.py reloads sys, hence this is only possible after importing it)
+		self.stdout = sys.stdout
+		sys.stdout = open(self.options.log, "a")
+		self.state_dir = tempfile.mkdtemp()
+		# files written by the jukebox are kept out of the checkout
+		jukebox.state_file = os.path.join(self.state_dir, "state.json")
+		jukebox.library_cache_file = os.path.join(self.state_dir, "library.cache")
+		jukebox.track_index_file = os.path.join(self.state_dir, "library.db")
+		jukebox.media_watcher_enabled = False
+		jukebox.play_startup_sound = False
+		jukebox.tracing_enabled = self.options.trace is not None
+		jukebox.MIFAREReader.irq_completion = not self.options.rfid_polling
+
+		# instrument the stages that cannot be observed from the outside
+		self.instrument("handle_rfid_uid", "uid")
+		jukebox.play_sound = lambda sound_file: self.recorder.record(monotonic(), "ping", sound_file)
+		jukebox.hw.lcd.frame_listeners.append(lambda timestamp, rows: self.recorder.record(timestamp, "lcd", rows))
+
+		jukebox.start_jukebox()
+		time.sleep(1) # let the threads settle
+
+	# record calls of the given function of jukebox.py as events of the given kind
+	def instrument(self, name, kind):
+		function = getattr(self.jukebox, name)
+		recorder = self.recorder
+		def wrapper(*args):
+			recorder.record(monotonic(), kind, args)
+			return function(*args)
+		setattr(self.jukebox, name, wrapper)
+
+	def stop(self):
+		self.jukebox.stop_jukebox()
+		self.mpd_server.stop()
+		if self.options.trace is not None:
+			with open(self.options.trace, "w") as trace_file:
+				self.jukebox.tracing.dump(trace_file)
+		sys.stdout.close()
+		sys.stdout = self.stdout
+		shutil.rmtree(self.state_dir, ignore_errors=True)
+
+	#-------------------------------------------------------------------
+	# helpers
+
+	def card_uids(self):
+		return [uid for (uid, index) in self.jukebox.library.entries()]
+
+	def present_card(self, uid):
+		self.jukebox.hw.rfid.present_card(uid)
+
+	def remove_card(self):
+		self.jukebox.hw.rfid.remove_card()
+
+	# press the button connected to the given channel, returns the time of the press
+	def press(self, channel):
+		# the same button is pressed repeatedly, this must not trigger hidden options
+		self.jukebox.button_press_sequence[:] = []
+		start = monotonic()
+		self.jukebox.hw.gpio.press(channel)
+		return start
+
+	# whether the given LCD frame shows the given directory and (the visible part of) the given title
+	def shows_title(self, rows, directory, title):
+		width = self.jukebox.display_width
+		if directory is not None and rows[0] != directory.ljust(width)[:width]:
+			return False
+		if len(title) <= width:
+			return rows[1] == title.ljust(width)
+		return rows[1] in title + self.jukebox.title_separator + title
+
+	def expected_title(self):
+		return self.jukebox.prepare_for_display(self.mpd_server.current_title() or "")
+
+	# wait for the given stages (list of (name, kind, match)) in order, returns the
+	# list of (name, timestamp) of the stages that happened before the first missing stage
+	def wait_for_stages(self, start, stages, timestamps=None):
+		timestamps = list(timestamps or [])
+		after = start
+		if timestamps:
+			after = timestamps[-1][1]
+		for name, kind, match in stages:
+			timestamp = self.recorder.wait_for(kind, after, match)
+			if timestamp is None:
+				break
+			timestamps.append((name, timestamp))
+			after = timestamp
+		return timestamps
+
+	# rows shown on the display at the given time (None if nothing has been shown yet)
+	def shown_at(self, timestamp):
+		lcd = self.jukebox.hw.lcd
+		with lcd.lock:
+			frames = list(lcd.frames)
+		rows = None
+		for frame_timestamp, frame_rows in frames:
+			if frame_timestamp > timestamp:
+				break
+			rows = frame_rows
+		return rows
+
+	# wait for the display stage with the given name after the given stages,
+	# the display scheduler does not write rows that are already shown (e.g. the title
+	# after play/pause), in this case the stage is counted at the time of the last stage
+	def wait_for_display(self, name, match, timestamps):
+		after = timestamps[-1][1]
+		rows = self.shown_at(after)
+		if rows is not None and match(rows):
+			return timestamps + [(name, after)]
+		return self.wait_for_stages(after, [(name, "lcd", match)], timestamps)
+
+	# add the stage timestamps of one run, runs with missing stages are counted as failed
+	def add_sample(self, samples, start, timestamps):
+		samples["runs"] += 1
+		if len(timestamps) < len(samples["order"]):
+			failed_stage = samples["order"][len(timestamps)]
+			samples["failed_stages"][failed_stage] = samples["failed_stages"].get(failed_stage, 0) + 1
+			return
+		previous = start
+		for name, timestamp in timestamps:
+			samples["latency"].setdefault(name, []).append(timestamp - start)
+			samples["stage"].setdefault(name, []).append(timestamp - previous)
+			previous = timestamp
+
+	def store_path(self, path, samples):
+		result = {
+			"runs": samples["runs"],
+			"stages": samples["order"],
+			"failures": sum(samples["failed_stages"].values()),
+			"failed_stages": samples["failed_stages"],
+			"latency": {},
+			"stage": {},
+		}
+		for name in samples["order"]:
+			result["latency"][name] = summarize(samples["latency"].get(name, []))
+			result["stage"][name] = summarize(samples["stage"].get(name, []))
+		self.results["paths"][path] = result
+
+	def new_samples(self, stage_names):
+		return {"runs": 0, "failed_stages": {}, "latency": {}, "stage": {}, "order": stage_names}
+
+	#-------------------------------------------------------------------
+	# latency paths
+
+	# place a card on the reader and wait until its directory is played and shown
+	def run_card_path(self):
+		uids = self.card_uids()
+		samples = self.new_samples(["uid", "ping", "mpd_play", "lcd_title"])
+		for run in range(self.options.warmup + self.options.runs):
+			uid = uids[run % len(uids)]
+			index = self.jukebox.library.lookup(uid)
+			self.recorder.clear()
+			start = monotonic()
+			self.present_card(uid)
+			timestamps = self.wait_for_stages(start, [
+				("uid", "uid", lambda args: args[0] == uid),
+				("ping", "ping", None),
+				("mpd_play", "mpd", lambda command: command[0] == "play"),
+			])
+			title = self.expected_title()
+			name = self.jukebox.prepare_for_display(self.jukebox.library.names[index])
+			if len(timestamps) == 3:
+				timestamps = self.wait_for_display("lcd_title", lambda rows: self.shows_title(rows, name, title), timestamps)
+			self.remove_card()
+			if run >= self.options.warmup:
+				self.add_sample(samples, start, timestamps)
+			time.sleep(self.options.settle_time)
+		self.store_path("card", samples)
+
+	# press the given button and wait for the MPD command and the display update
+	def run_button_path(self, path, channel, commands, lcd_match):
+		samples = self.new_samples(["mpd_command", "lcd"])
+		spacing = max(self.jukebox.bounce_time / 1000.0, self.jukebox.button_press_sleep_time) + 0.05
+		for run in range(self.options.warmup + self.options.runs):
+			self.recorder.clear()
+			start = self.press(channel)
+			timestamps = self.wait_for_stages(start, [("mpd_command", "mpd", lambda command: command[0] in commands)])
+			if timestamps:
+				timestamps = self.wait_for_display("lcd", lcd_match(), timestamps)
+			if run >= self.options.warmup:
+				self.add_sample(samples, start, timestamps)
+			time.sleep(max(0, spacing - (monotonic() - start)))
+		self.store_path(path, samples)
+
+	def current_title_match(self):
+		title = self.expected_title()
+		return lambda rows: self.shows_title(rows, None, title)
+
+	# alternately press volume up and down and wait for the display and MPD
+	def run_volume_path(self):
+		samples = self.new_samples(["lcd", "mpd_setvol"])
+		spacing = max(self.jukebox.bounce_time_volume_button / 1000.0, self.jukebox.volume_button_press_sleep_time) + 0.05
+		for run in range(self.options.warmup + self.options.runs):
+			channel = self.jukebox.gpio_volume_up if run % 2 == 0 else self.jukebox.gpio_volume_down
+			self.recorder.clear()
+			start = self.press(channel)
+			timestamps = self.wait_for_stages(start, [
+				("lcd", "lcd", lambda rows: rows[1].startswith(self.jukebox.prepare_for_display(u"Lautstärke"))),
+				("mpd_setvol", "mpd", lambda command: command[0] == "setvol"),
+			])
+			if run >= self.options.warmup:
+				self.add_sample(samples, start, timestamps)
+			time.sleep(max(0, spacing - (monotonic() - start)))
+		self.store_path("volume", samples)
+
+	#-------------------------------------------------------------------
+	# throughput
+
+	# swipe different cards in quick succession, each card is held for swipe_time seconds
+	def run_swipe_throughput(self):
+		uids = self.card_uids()
+		count = self.options.burst
+		self.recorder.clear()
+		start = monotonic()
+		for i in range(count):
+			self.present_card(uids[i % len(uids)])
+			time.sleep(self.options.swipe_time)
+			self.remove_card()
+			time.sleep(self.options.swipe_gap)
+		stimulus_end = monotonic()
+
+		# wait until the jukebox is idle again
+		completion = max(self.wait_until_quiet(), stimulus_end) - start
+		switches = self.recorder.count("mpd", start, lambda command: command[0] == "play")
+		self.results["throughput"]["card_swipes"] = {
+			"swipes": count,
+			"handled": self.recorder.count("uid", start),
+			"switches": switches,
+			"stimulus_duration_s": round(stimulus_end - start, 3),
+			"completion_s": round(completion, 3),
+			"switches_per_s": round(switches / completion, 3),
+		}
+
+	# press the next button and the volume buttons in quick succession
+	def run_press_throughput(self):
+		count = self.options.burst
+		for name, channel, commands in (("next_presses", self.jukebox.gpio_next, ("next",)),
+				("volume_presses", self.jukebox.gpio_volume_up, ("setvol",))):
+			time.sleep(self.options.settle_time)
+			self.recorder.clear()
+			start = monotonic()
+			for i in range(count):
+				self.press(channel)
+				time.sleep(self.options.press_gap)
+			stimulus_end = monotonic()
+			completion = max(self.wait_until_quiet(), stimulus_end) - start
+			handled = self.recorder.count("mpd", start, lambda command: command[0] in commands)
+			self.results["throughput"][name] = {
+				"presses": count,
+				"mpd_commands": handled,
+				"lcd_frames": self.recorder.count("lcd", start),
+				"stimulus_duration_s": round(stimulus_end - start, 3),
+				"completion_s": round(completion, 3),
+				"mpd_commands_per_s": round(handled / completion, 3),
+			}
+
+	# wait until no MPD command has been sent for quiet_time seconds,
+	# returns the timestamp of the last MPD command
+	def wait_until_quiet(self, quiet_time=1.0):
+		while True:
+			with self.recorder.condition:
+				commands = [timestamp for timestamp, kind, data in self.recorder.events if kind == "mpd"]
+			last = commands[-1] if commands else monotonic()
+			if monotonic() - last >= quiet_time:
+				return last
+			time.sleep(0.1)
+
+	#-------------------------------------------------------------------
+
+	def run(self):
+		paths = self.options.paths.split(",")
+		self.start()
+		try:
+			if "card" in paths:
+				self.run_card_path()
+			if "play_pause" in paths:
+				self.run_button_path("play_pause", self.jukebox.gpio_play_pause, ("play", "pause"), self.current_title_match)
+			if "next" in paths:
+				self.run_button_path("next", self.jukebox.gpio_next, ("next",), self.current_title_match)
+			if "prev" in paths:
+				self.run_button_path("prev", self.jukebox.gpio_prev, ("previous",), self.current_title_match)
+			if "volume" in paths:
+				self.run_volume_path()
+			if "throughput" in paths:
+				self.run_swipe_throughput()
+				self.run_press_throughput()
+		finally:
+			self.stop()
+
+		self.results["rfid"] = {}
+		for name, (operations, transfers) in self.jukebox.MIFAREReader.operations.items():
+			self.results["rfid"][name] = {
+				"operations": operations,
+				"spi_transfers": transfers,
+				"spi_transfers_per_operation": round(transfers / float(operations), 1),
+			}
+		self.results["revision"] = git_revision()
+		self.results["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+		self.results["python"] = platform.python_version()
+		self.results["machine"] = platform.machine()
+		self.results["config"] = {
+			"runs": self.options.runs,
+			"warmup": self.options.warmup,
+			"mpd_delay_ms": self.options.mpd_delay,
+			"tracks": self.options.tracks,
+			"burst": self.options.burst,
+			"tracing": self.options.trace is not None,
+			"rfid_polling": self.options.rfid_polling,
+		}
+		return self.results
+
+
+def print_results(results, output):
+	output.write("Revision: %s\n" % results.get("revision"))
+	for path in sorted(results["paths"]):
+		result = results["paths"][path]
+		output.write("\n%s (%d Durchläufe, %d fehlgeschlagen)\n" % (path, result["runs"], result["failures"]))
+		for name, count in sorted(result["failed_stages"].items()):
+			output.write("  %d Mal fehlgeschlagen in Stufe %s\n" % (count, name))
+		output.write("  %-12s %10s %10s %10s   %10s %10s\n" % ("Stufe", "p50 ms", "p95 ms", "p99 ms", "Stufe p50", "Stufe p95"))
+		for name in result["stages"]:
+			latency = result["latency"][name]
+			stage = result["stage"][name]
+			if not latency["count"]:
+				output.write("  %-12s %10s\n" % (name, "-"))
+				continue
+			output.write("  %-12s %10.1f %10.1f %10.1f   %10.1f %10.1f\n" % (name, latency["p50"], latency["p95"], latency["p99"], stage["p50"], stage["p95"]))
+	for name in sorted(results["throughput"]):
+		output.write("\n%s: %s\n" % (name, json.dumps(results["throughput"][name], sort_keys=True)))
+	if results.get("rfid"):
+		output.write("\nSPI Transfers des RFID Lesers:\n")
+		for name, counts in sorted(results["rfid"].items()):
+			output.write("  %-12s %6d Operationen %8d Transfers %8.1f pro Operation\n" % (name, counts["operations"], counts["spi_transfers"], counts["spi_transfers_per_operation"]))
+
+# print the changes of the latencies compared to the given (older) results
+def print_comparison(old, new, output):
+	output.write("\nVergleich mit Revision %s (p50/p95 in ms):\n" % old.get("revision"))
+	for path in sorted(new["paths"]):
+		if path not in old["paths"]:
+			continue
+		for name in new["paths"][path]["stages"]:
+			latency = new["paths"][path]["latency"][name]
+			previous = old["paths"][path]["latency"].get(name)
+			if not previous or not previous.get("count") or not latency["count"]:
+				continue
+			changes = []
+			for key in ("p50", "p95"):
+				change = 0.0
+				if previous[key]:
+					change = (latency[key] - previous[key]) * 100.0 / previous[key]
+				changes.append("%8.1f -> %8.1f (%+6.1f%%)" % (previous[key], latency[key], change))
+			output.write("  %-10s %-12s %s\n" % (path, name, "   ".join(changes)))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Latenz-Benchmarks der Jukebox")
+	parser.add_argument("--runs", type=int, default=30, help="Anzahl der Messungen pro Pfad")
+	parser.add_argument("--warmup", type=int, default=2, help="Anzahl der nicht gewerteten Messungen pro Pfad")
+	parser.add_argument("--paths", default="card,play_pause,next,prev,volume,throughput", help="auszuführende Pfade")
+	parser.add_argument("--mpd-delay", type=float, default=0, help="Verzögerung (in ms) des Fake MPD vor jeder Antwort")
+	parser.add_argument("--tracks", type=int, default=10, help="Anzahl der Titel pro Ordner")
+	parser.add_argument("--settle-time", type=float, default=0.5, help="Wartezeit (in s) zwischen zwei Karten")
+	parser.add_argument("--burst", type=int, default=20, help="Anzahl der Karten/Knopfdrücke der Durchsatzmessung")
+	parser.add_argument("--swipe-time", type=float, default=0.3, help="Dauer (in s) einer Karte auf dem Leser bei der Durchsatzmessung")
+	parser.add_argument("--swipe-gap", type=float, default=0.1, help="Pause (in s) zwischen zwei Karten bei der Durchsatzmessung")
+	parser.add_argument("--press-gap", type=float, default=0.05, help="Pause (in s) zwischen zwei Knopfdrücken bei der Durchsatzmessung")
+	parser.add_argument("--output", default="benchmark_result.json", help="JSON Datei für die Ergebnisse")
+	parser.add_argument("--compare", help="JSON Datei mit Ergebnissen einer anderen Version")
+	parser.add_argument("--log", default=os.devnull, help="Datei für die Ausgaben der Jukebox")
+	parser.add_argument("--trace", help="Tracing aktivieren und die aufgezeichneten Stufen in diese Datei schreiben")
+	parser.add_argument("--rfid-polling", action="store_true", help="RFID Leser abfragen statt auf seine IRQ Leitung zu warten")
+	options = parser.parse_args()
+
+	results = Benchmark(options).run()
+	with open(options.output, "w") as output_file:
+		json.dump(results, output_file, indent=1, sort_keys=True)
+	print_results(results, sys.stdout)
+	if options.compare:
+		with open(options.compare) as compare_file:
+			print_comparison(json.load(compare_file), results, sys.stdout)
+	sys.stdout.flush()
@@ -0,0 +1,452 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Fake MPD server for benchmarks and for running the jukebox without MPD.
+#
+# Speaks the subset of the MPD text protocol used by the jukebox (see
+# mpd_client.py): status, currentsong, playback commands, queue and stored
+# playlists, listallinfo, setvol, update, command lists and idle/noidle. No
+# audio is played, the "database" consists of generated tracks for the given
+# directories.
+#
+# Every processed command is reported to the registered command listeners
+# with a monotonic timestamp, thus benchmarks running in the same process can
+# measure when a command has arrived at MPD.
+#
+# Standalone usage (e.g. together with "jukebox.py --simulate"):
+#   python benchmark/fake_mpd.py --port 6600
+#
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from clock import monotonic
+
+# error codes of the MPD protocol
+ACK_ERROR_ARG = 2
+ACK_ERROR_NO_EXIST = 50
+ACK_ERROR_UNKNOWN = 5
+
+PLAYER_COMMANDS = ("play", "pause", "stop", "next", "previous", "seekcur")
+QUEUE_COMMANDS = ("clear", "add", "load")
+
+
+class CommandError(Exception):
+
+	def __init__(self, code, message):
+		Exception.__init__(self, message)
+		self.code = code
+
+
+# split a command line into the command and its (possibly quoted) arguments
+def parse_command(line):
+	words = []
+	i = 0
+	while i < len(line):
+		if line[i] == ' ':
+			i += 1
+			continue
+		if line[i] == '"':
+			i += 1
+			word = []
+			while i < len(line) and line[i] != '"':
+				if line[i] == '\\' and i + 1 < len(line):
+					i += 1
+				word.append(line[i])
+				i += 1
+			i += 1
+			words.append(''.join(word))
+		else:
+			start = i
+			while i < len(line) and line[i] != ' ':
+				i += 1
+			words.append(line[start:i])
+	if not words:
+		return None, []
+	return words[0], words[1:]
+
+
+# one track of the generated database
+class Track:
+
+	def __init__(self, directory, number, title):
+		self.file = "%s/%02d.mp3" % (directory, number)
+		self.title = title
+		self.duration = 180.0
+		self.mtime = "2020-01-01T00:00:00Z"
+
+
+class FakeMPDServer:
+
+	# directories: names of the directories of the generated database
+	# tracks_per_directory: number of tracks generated for every directory
+	# response_delay: time (in s) the server waits before processing a command,
+	#                 e.g. to resemble MPD on a Raspberry Pi
+	def __init__(self, directories, tracks_per_directory=10, host="127.0.0.1", port=0, response_delay=0):
+		self.database = {}
+		for directory in directories:
+			self.database[directory] = [Track(directory, i + 1, self.track_title(directory, i + 1)) for i in range(tracks_per_directory)]
+		self.response_delay = response_delay
+		self.lock = threading.RLock()
+		self.queue = []
+		self.stored_playlists = {}
+		self.state = "stop"
+		self.song = None
+		self.elapsed = 0.0
+		self.play_started = None
+		self.volume = 50
+		self.repeat = False
+		self.command_listeners = []
+		self.connections = []
+		self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.server.bind((host, port))
+		self.server.listen(5)
+		self.host, self.port = self.server.getsockname()
+		self.running = False
+
+	# titles alternate between ones that fit on the display and ones that are scrolled
+	@staticmethod
+	def track_title(directory, number):
+		if number % 2:
+			return "Lied %d" % number
+		return "Lied %d aus dem Ordner %s mit langem Titel" % (number, directory)
+
+	def start(self):
+		self.running = True
+		thread = threading.Thread(target=self._accept)
+		thread.daemon = True
+		thread.start()
+
+	def stop(self):
+		self.running = False
+		try:
+			self.server.close()
+		except socket.error:
+			pass
+		with self.lock:
+			connections = list(self.connections)
+		for connection in connections:
+			connection.close()
+
+	def _accept(self):
+		while self.running:
+			try:
+				client, address = self.server.accept()
+			except socket.error:
+				return
+			connection = Connection(self, client)
+			with self.lock:
+				self.connections.append(connection)
+			thread = threading.Thread(target=connection.run)
+			thread.daemon = True
+			thread.start()
+
+	def remove_connection(self, connection):
+		with self.lock:
+			if connection in self.connections:
+				self.connections.remove(connection)
+
+	# report the given changed subsystems to all idle connections
+	def notify(self, subsystems):
+		with self.lock:
+			connections = list(self.connections)
+		for connection in connections:
+			connection.notify(subsystems)
+
+	# title of the track that is currently selected (None if no track is selected)
+	def current_title(self):
+		with self.lock:
+			if self.song is None or self.song >= len(self.queue):
+				return None
+			return self.queue[self.song].title
+
+	#-------------------------------------------------------------------
+	# commands
+
+	# process a single command, returns the response as list of (key, value) pairs
+	def execute(self, name, args):
+		if self.response_delay:
+			time.sleep(self.response_delay)
+		with self.lock:
+			function = getattr(self, "cmd_" + name, None)
+			if function is None:
+				raise CommandError(ACK_ERROR_UNKNOWN, "unknown command \"%s\"" % name)
+			try:
+				response, changed = function(*args)
+			except TypeError:
+				raise CommandError(ACK_ERROR_ARG, "wrong number of arguments for \"%s\"" % name)
+		timestamp = monotonic()
+		if changed:
+			self.notify(changed)
+		for listener in self.command_listeners:
+			listener(timestamp, name, args)
+		return response
+
+	def _elapsed(self):
+		if self.state == "play":
+			return self.elapsed + monotonic() - self.play_started
+		return self.elapsed
+
+	def _select(self, song, elapsed=0.0):
+		if song < 0 or song >= len(self.queue):
+			raise CommandError(ACK_ERROR_ARG, "Bad song index")
+		self.song = song
+		self.elapsed = elapsed
+		self.play_started = monotonic()
+		self.state = "play"
+
+	def _tracks(self, uri):
+		uri = uri.rstrip("/")
+		if uri in self.database:
+			return list(self.database[uri])
+		for tracks in self.database.values():
+			for track in tracks:
+				if track.file == uri:
+					return [track]
+		raise CommandError(ACK_ERROR_NO_EXIST, "No such directory")
+
+	def cmd_ping(self):
+		return [], None
+
+	def cmd_status(self):
+		status = [("volume", str(self.volume)), ("repeat", "1" if self.repeat else "0"),
+			("playlistlength", str(len(self.queue))), ("state", self.state)]
+		if self.song is not None and self.state != "stop":
+			status.append(("song", str(self.song)))
+			status.append(("elapsed", "%.3f" % self._elapsed()))
+			status.append(("duration", "%.3f" % self.queue[self.song].duration))
+			if self.song + 1 < len(self.queue) or self.repeat:
+				status.append(("nextsong", str((self.song + 1) % len(self.queue))))
+		return status, None
+
+	def cmd_currentsong(self):
+		if self.song is None or self.song >= len(self.queue):
+			return [], None
+		track = self.queue[self.song]
+		return [("file", track.file), ("Title", track.title), ("Pos", str(self.song))], None
+
+	def cmd_play(self, position=None):
+		if position is not None:
+			self._select(int(position))
+		elif self.state == "pause":
+			self.play_started = monotonic()
+			self.state = "play"
+		elif self.queue:
+			self._select(self.song or 0)
+		return [], ["player"]
+
+	def cmd_pause(self, value="1"):
+		if value == "1" and self.state == "play":
+			self.elapsed = self._elapsed()
+			self.state = "pause"
+		elif value == "0" and self.state == "pause":
+			self.play_started = monotonic()
+			self.state = "play"
+		return [], ["player"]
+
+	def cmd_stop(self):
+		self.state = "stop"
+		self.elapsed = 0.0
+		return [], ["player"]
+
+	def cmd_next(self):
+		if self.queue and self.song is not None:
+			self._select((self.song + 1) % len(self.queue))
+		return [], ["player"]
+
+	def cmd_previous(self):
+		if self.queue and self.song is not None:
+			self._select((self.song - 1) % len(self.queue))
+		return [], ["player"]
+
+	def cmd_seekcur(self, position):
+		if self.state == "stop":
+			raise CommandError(ACK_ERROR_ARG, "Not playing")
+		self.elapsed = float(position)
+		self.play_started = monotonic()
+		return [], ["player"]
+
+	def cmd_clear(self):
+		self.queue = []
+		self.song = None
+		self.state = "stop"
+		return [], ["playlist", "player"]
+
+	def cmd_add(self, uri):
+		self.queue.extend(self._tracks(uri))
+		return [], ["playlist"]
+
+	def cmd_load(self, name):
+		if name not in self.stored_playlists:
+			raise CommandError(ACK_ERROR_NO_EXIST, "No such playlist")
+		self.queue.extend(self.stored_playlists[name])
+		return [], ["playlist"]
+
+	def cmd_playlistadd(self, name, uri):
+		self.stored_playlists.setdefault(name, []).extend(self._tracks(uri))
+		return [], ["stored_playlist"]
+
+	def cmd_rm(self, name):
+		if name not in self.stored_playlists:
+			raise CommandError(ACK_ERROR_NO_EXIST, "No such playlist")
+		del self.stored_playlists[name]
+		return [], ["stored_playlist"]
+
+	def cmd_listallinfo(self, uri):
+		response = [("directory", uri.rstrip("/"))]
+		for track in self._tracks(uri):
+			response.extend([("file", track.file), ("Last-Modified", track.mtime), ("Title", track.title),
+				("Time", str(int(track.duration))), ("duration", "%.3f" % track.duration)])
+		return response, None
+
+	def cmd_update(self, uri=None):
+		return [("updating_db", "1")], ["update"]
+
+	def cmd_repeat(self, value):
+		self.repeat = (value == "1")
+		return [], ["options"]
+
+	def cmd_setvol(self, volume):
+		self.volume = max(0, min(100, int(volume)))
+		return [], ["mixer"]
+
+
+# a single client connection
+class Connection:
+
+	def __init__(self, server, sock):
+		self.server = server
+		self.sock = sock
+		self.lock = threading.Lock()
+		self.idle = None     # subsystems the client waits for (None if not idle)
+		self.pending = set() # subsystems changed since the last idle command
+
+	def send(self, data):
+		with self.lock:
+			self._send(data)
+
+	def _send(self, data):
+		try:
+			self.sock.sendall(data.encode("utf-8"))
+		except socket.error:
+			pass
+
+	def close(self):
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+		self.sock.close()
+
+	def notify(self, subsystems):
+		with self.lock:
+			self.pending.update(subsystems)
+			self._send_idle_response()
+
+	# answer a pending idle command if subsystems it waits for have changed
+	# NOTE: may only be called with the connection lock acquired
+	def _send_idle_response(self, force=False):
+		if self.idle is None:
+			return
+		changed = [subsystem for subsystem in sorted(self.pending) if not self.idle or subsystem in self.idle]
+		if not changed and not force:
+			return
+		for subsystem in changed:
+			self.pending.discard(subsystem)
+		self.idle = None
+		self._send("".join("changed: %s\n" % subsystem for subsystem in changed) + "OK\n")
+
+	def _format(self, pairs):
+		return "".join("%s: %s\n" % (key, value) for key, value in pairs)
+
+	def _error(self, error, index, name):
+		return "ACK [%d@%d] {%s} %s\n" % (error.code, index, name, error)
+
+	def run(self):
+		self.send("OK MPD 0.21.0\n")
+		stream = self.sock.makefile("rb")
+		command_list = None
+		list_ok = False
+		try:
+			for line in iter(stream.readline, b""):
+				line = line.decode("utf-8").rstrip("\n")
+				if command_list is not None:
+					if line == "command_list_end":
+						self._run_command_list(command_list, list_ok)
+						command_list = None
+					else:
+						command_list.append(line)
+					continue
+				if line in ("command_list_begin", "command_list_ok_begin"):
+					command_list = []
+					list_ok = (line == "command_list_ok_begin")
+					continue
+				name, args = parse_command(line)
+				if name == "idle":
+					with self.lock:
+						self.idle = args
+						self._send_idle_response()
+					continue
+				if name == "noidle":
+					with self.lock:
+						self._send_idle_response(True)
+					continue
+				if name == "close":
+					break
+				try:
+					self.send(self._format(self.server.execute(name, args)) + "OK\n")
+				except CommandError as e:
+					self.send(self._error(e, 0, name))
+		except socket.error:
+			pass
+		finally:
+			self.server.remove_connection(self)
+			self.close()
+
+	def _run_command_list(self, lines, list_ok):
+		output = []
+		for index, line in enumerate(lines):
+			name, args = parse_command(line)
+			try:
+				output.append(self._format(self.server.execute(name, args)))
+			except CommandError as e:
+				output.append(self._error(e, index, name))
+				self.send("".join(output))
+				return
+			if list_ok:
+				output.append("list_OK\n")
+		output.append("OK\n")
+		self.send("".join(output))
+
+
+# directories of the library file of the jukebox
+def library_directories(library_file):
+	with open(library_file) as data_file:
+		return [entry['directory'] for entry in json.load(data_file)]
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Fake MPD Server für die Jukebox")
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=6600)
+	parser.add_argument("--library", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "library.json"))
+	parser.add_argument("--tracks", type=int, default=10, help="Anzahl der Titel pro Ordner")
+	parser.add_argument("--delay", type=float, default=0, help="Verzögerung (in ms) vor jeder Antwort")
+	options = parser.parse_args()
+
+	server = FakeMPDServer(library_directories(options.library), options.tracks, options.host, options.port, options.delay / 1000.0)
+	server.start()
+	print("Fake MPD lauscht auf %s:%d" % (server.host, server.port))
+	try:
+		while True:
+			time.sleep(3600)
+	except KeyboardInterrupt:
+		server.stop()
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Microbenchmark of the LCD output: the second row is scrolled just like the
+# display thread does it and each scroll step is written to the simulated LCD
+# * full:         home and rewrite of both rows (write_to_lcd before lcd_renderer.py)
+# * differential: only the changed cells (lcd_renderer.LCDRenderer)
+#
+# Reported are the I2C transactions per scroll step and the resulting time the
+# I2C bus is busy per step, i.e. the maximum number of scroll steps per second.
+#
+# Usage:
+#   python benchmark/lcd_benchmark.py [--steps 1000] [--i2c-khz 100] [--output result.json]
+#
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import lcd_renderer
+import marquee
+import simulation
+
+cols = 16
+title_separator = " * "
+first_row = u"Kinderlieder"
+title = u"Lied 2 aus dem Ordner tag-01 mit langem Titel"
+
+# Bits on the bus per I2C transaction to the PCF8574:
+# start, address byte + ack, data byte + ack, stop
+bits_per_transaction = 20
+
+# all scroll steps of the title (see display_thread_callback of jukebox.py)
+def scroll_frames(steps):
+	frames = marquee.render_frames(title, cols, title_separator)
+	for i in range(steps):
+		yield [first_row, frames[i % len(frames)]]
+
+def write_full(lcd, framebuffer):
+	lcd.home()
+	for row in framebuffer:
+		lcd.write_string(row.ljust(cols)[:cols])
+		lcd.write_string('\r\n')
+
+def run(name, steps, i2c_khz):
+	# the full rewrite relies on the automatic line breaks of RPLCD, the renderer moves the cursor itself
+	lcd = simulation.SimulatedLCD(cols, 2, max_frames=1, auto_linebreaks=(name == "full"))
+	if name == "full":
+		write = lambda framebuffer: write_full(lcd, framebuffer)
+	else:
+		renderer = lcd_renderer.LCDRenderer(lcd, cols, 2)
+		write = renderer.render
+
+	# the first frame is written completely by both
+	frames = scroll_frames(steps + 1)
+	write(next(frames))
+	lcd.i2c_transactions = 0
+	lcd.commands = 0
+	lcd.characters_written = 0
+
+	start = time.time()
+	for framebuffer in frames:
+		write(framebuffer)
+	duration = time.time() - start
+
+	transactions = lcd.i2c_transactions / float(steps)
+	bus_time = transactions * bits_per_transaction / (i2c_khz * 1000.0)
+	return {
+		"i2c_transactions_per_step": round(transactions, 2),
+		"commands_per_step": round(lcd.commands / float(steps), 2),
+		"characters_per_step": round(lcd.characters_written / float(steps), 2),
+		"bus_time_per_step_ms": round(bus_time * 1000, 3),
+		"max_steps_per_s": round(1 / bus_time, 1),
+		"cpu_time_per_step_us": round(duration * 1000000 / steps, 1),
+	}
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark der LCD Ausgabe")
+	parser.add_argument("--steps", type=int, default=1000, help="Anzahl der Scroll-Schritte")
+	parser.add_argument("--i2c-khz", type=float, default=100, help="Takt des I2C Busses in kHz")
+	parser.add_argument("--output", help="JSON Datei für die Ergebnisse")
+	options = parser.parse_args()
+
+	results = {}
+	for name in ("full", "differential"):
+		results[name] = run(name, options.steps, options.i2c_khz)
+		print("%-13s %s" % (name, json.dumps(results[name], sort_keys=True)))
+	if options.output:
+		with open(options.output, "w") as output_file:
+			json.dump(results, output_file, indent=1, sort_keys=True)
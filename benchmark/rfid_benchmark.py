@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Microbenchmark of the SPI communication with the RFID reader: a card is put on
+# the reader and read (wait for the card, anticollision, select incl. CRC) just
+# like the jukebox does it, against the simulated MFRC522 and SPI backend of
+# simulation.py
+# * single: one SPI transfer per register access and FIFO byte
+# * burst:  FIFO and multiple registers in one SPI transfer (MFRC522 burst_transfers)
+# both with a persistent reader session and with the chip initialised again for
+# every card (as the jukebox did before, incl. a second REQA after the wake-up).
+#
+# Reported are the SPI transfers (i.e. spidev system calls) and bytes per card
+# read and the resulting time per read at the configured SPI speed.
+#
+# Usage:
+#   python benchmark/rfid_benchmark.py [--reads 200] [--spi-khz 1000] [--polling] [--output result.json]
+#
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import MFRC522
+import simulation
+
+card_uid = [176, 223, 243, 121]
+
+# wait for the card, read its UID and select it
+def read_card(reader, reinit):
+	if reinit:
+		reader.needs_init = True
+	reader.MFRC522_WaitForCard()
+	if reinit:
+		reader.MFRC522_Init()
+		reader.MFRC522_Request(reader.PICC_REQIDL)
+	(status, uid) = reader.MFRC522_Anticoll()
+	if status == reader.MI_OK:
+		reader.MFRC522_SelectTag(uid)
+	return status
+
+def run(name, reads, spi_khz, reinit, irq_completion):
+	gpio = simulation.SimulatedGPIO()
+	chip = simulation.SimulatedMFRC522(gpio)
+	spi = simulation.SimulatedSPI(chip)
+	reader = MFRC522.MFRC522(spd=int(spi_khz * 1000), gpio=gpio, spi_backend=spi,
+		irq_completion=irq_completion, burst_transfers=(name == "burst"))
+
+	transfers = 0
+	bytes_transferred = 0
+	duration = 0
+	ok = 0
+	for i in range(reads):
+		chip.remove_card()
+		chip.present_card(card_uid)
+		spi.reset_statistics()
+		start = time.time()
+		if read_card(reader, reinit) == reader.MI_OK:
+			ok += 1
+		duration += time.time() - start
+		transfers += spi.transfers
+		bytes_transferred += spi.bytes_transferred
+
+	return {
+		"reads_ok": ok,
+		"spi_transfers_per_read": round(transfers / float(reads), 1),
+		"spi_bytes_per_read": round(bytes_transferred / float(reads), 1),
+		"time_per_read_ms": round(duration * 1000 / reads, 2),
+	}
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark der SPI Kommunikation mit dem RFID Leser")
+	parser.add_argument("--reads", type=int, default=200, help="Anzahl der Lesevorgänge")
+	parser.add_argument("--spi-khz", type=float, default=1000, help="Takt des SPI Busses in kHz")
+	parser.add_argument("--polling", action="store_true", help="Register abfragen statt auf die IRQ Leitung zu warten")
+	parser.add_argument("--output", help="JSON Datei für die Ergebnisse")
+	options = parser.parse_args()
+
+	results = {}
+	for reinit in (True, False):
+		for name in ("single", "burst"):
+			key = "%s_%s" % (name, "reinit" if reinit else "session")
+			results[key] = run(name, options.reads, options.spi_khz, reinit, not options.polling)
+			print("%-15s %s" % (key, json.dumps(results[key], sort_keys=True)))
+	if options.output:
+		with open(options.output, "w") as output_file:
+			json.dump(results, output_file, indent=1, sort_keys=True)
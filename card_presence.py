@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Keeps track of the RFID card on the reader: when it arrives, while it stays
+# and when it leaves.
+#
+# Once a card has been read (and thus selected) it is put into HALT state. A halted
+# card does not answer the REQA sent by MFRC522_WaitForCard anymore, hence a
+# card lying on the reader is not read over and over again. Whether it is
+# still there is checked periodically with a WUPA (which wakes up halted cards)
+# followed by a select with the known UID, afterwards it is halted again.
+# In between the reader keeps waiting for a REQA answer, i.e. a new card (or the
+# card that has been lifted and thus has lost its power) is read right away.
+#
+# A card counts as removed
+# * if it has not answered for removal_time seconds (i.e. a card that is lifted
+#   shortly or does not answer once is not removed and read again) or
+# * right away if another card answers instead.
+#
+# wait() blocks until the next change and is run by the RFID thread of the
+# jukebox (or a worker thread of its event loop).
+#
+
+import clock
+
+ARRIVED = "arrived"
+REMOVED = "removed"
+
+# results of a presence check
+SEEN = "seen"
+GONE = "gone"
+REPLACED = "replaced"
+
+
+class CardPresence:
+
+	# reader: MFRC522 reader
+	# read_uid: function waiting for a card (at most the given timeout in s, None waits forever),
+	#           selecting it and returning its UID (None if no card could be read)
+	# check_interval: time (in s) between two checks whether the card is still on the reader
+	# removal_time: time (in s) without an answer after which the card counts as removed
+	def __init__(self, reader, read_uid, check_interval=0.5, removal_time=1):
+		self.reader = reader
+		self.read_uid = read_uid
+		self.check_interval = check_interval
+		self.removal_time = removal_time
+		self.card = None      # UID of the card on the reader (None if there is none)
+		self.arrived = None   # UID of a card whose arrival has not been reported yet
+		self.last_seen = 0
+		self.checks = 0
+
+	# Block until a card has arrived or the card on the reader has been removed,
+	# returns (ARRIVED or REMOVED, UID of the card).
+	def wait(self):
+		while True:
+			if self.card is None:
+				uid = self.arrived or self.read_uid(None)
+				self.arrived = None
+				if uid is None:
+					continue
+				self.card = uid
+				self.last_seen = clock.monotonic()
+				self.reader.MFRC522_Halt()
+				return (ARRIVED, uid)
+
+			uid = self.read_uid(self.check_interval)
+			if uid is None:
+				result = self._check()
+			elif uid == self.card:
+				# the card has been lifted shortly
+				self.reader.MFRC522_Halt()
+				result = SEEN
+			else:
+				self.arrived = uid
+				result = REPLACED
+			if result == SEEN:
+				self.last_seen = clock.monotonic()
+			elif result == REPLACED or clock.monotonic() - self.last_seen >= self.removal_time:
+				uid = self.card
+				self.card = None
+				return (REMOVED, uid)
+
+	# whether the card is still on the reader (SEEN, GONE or REPLACED)
+	def _check(self):
+		self.checks += 1
+		(status, bits) = self.reader.MFRC522_Request(self.reader.PICC_REQALL)
+		if status != self.reader.MI_OK:
+			return GONE
+		if self.reader.MFRC522_SelectUID(self.card) != self.reader.MI_OK:
+			# Another card has answered, it has been woken up by the WUPA. It only
+			# answers the next REQA after a reset of the reader (which powers it off).
+			self.reader.needs_init = True
+			return REPLACED
+		self.reader.MFRC522_Halt()
+		return SEEN
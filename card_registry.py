@@ -0,0 +1,205 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Registry of the RFID cards known to the jukebox (see library.json).
+#
+# The UIDs (4, 7 or 10 bytes) are packed into integers, i.e. a card is looked
+# up with a single dictionary access which directly yields the index of its
+# directory. Cards with a 7 or 10 byte UID that have been registered with the
+# first four bytes read by older versions of the jukebox (cascade tag 0x88 and
+# three UID bytes) are still found.
+#
+# Parsing library.json takes long for thousands of cards, hence the registry is
+# stored in a compact binary file next to it (see save and load):
+#   header:      magic, version, modification time and size of library.json,
+#                number of directories and cards
+#   directories: directory and name as UTF-8, each preceded by its length
+#   cards:       arrays of the upper and lower 64 bits of the packed UIDs
+#                and of the directory indexes
+# The file is only used as long as library.json has not been changed.
+#
+# A registry is not changed after it has been created, i.e. it is a snapshot of
+# the library. A changed library file results in a new registry (see diff).
+#
+
+import binascii
+import json
+import os
+import struct
+
+CASCADE_TAG = 0x88
+
+MAGIC = b"JBCR"
+VERSION = 1
+HEADER = struct.Struct("<4sBdQII")
+STRING_LENGTH = struct.Struct("<H")
+MASK_64 = (1 << 64) - 1
+
+UID_LENGTHS = (4, 7, 10)
+
+# raised if the library file contains an invalid entry
+class LibraryError(ValueError):
+	pass
+
+# UID given as "176,223,243,121" -> [176, 223, 243, 121]
+def parse_uid(text):
+	return [int(byte) for byte in text.split(",")]
+
+# [176, 223, 243, 121] -> "176,223,243,121"
+def format_uid(uid):
+	return ",".join(str(byte) for byte in uid)
+
+# UID (list of bytes) as integer, UIDs of different lengths are never equal
+def pack_uid(uid):
+	return int(binascii.hexlify(bytearray([len(uid)] + list(uid))), 16)
+
+def unpack_uid(key):
+	digits = "%x" % key
+	return list(bytearray(binascii.unhexlify(digits.zfill(len(digits) + len(digits) % 2))))[1:]
+
+
+class CardRegistry:
+
+	# directories: names of the directories ("tag-*")
+	# names: name shown for each directory
+	# cards: dictionary mapping the packed UIDs (see pack_uid) to the index of their directory
+	def __init__(self, directories, names, cards):
+		self.directories = tuple(directories)
+		self.names = tuple(names)
+		self.directory_index = dict((directory, index) for index, directory in enumerate(self.directories))
+		self.cards = cards
+
+	def __len__(self):
+		return len(self.cards)
+
+	# name of the given directory (None if it is not part of the library)
+	def name(self, directory):
+		index = self.directory_index.get(directory)
+		if index is None:
+			return None
+		return self.names[index]
+
+	# index of the directory associated with the card with the given UID (None if the card is unknown)
+	def lookup(self, uid):
+		index = self.cards.get(pack_uid(uid))
+		if index is None and len(uid) > 4:
+			index = self.cards.get(pack_uid([CASCADE_TAG] + list(uid[0:3])))
+		return index
+
+	# list of (UID, directory index) of all cards, ordered by UID
+	def entries(self):
+		return sorted((unpack_uid(key), index) for key, index in self.cards.items())
+
+	# store the registry in the given file, stamp: (modification time, size) of the library file
+	def save(self, path, stamp):
+		data = [HEADER.pack(MAGIC, VERSION, stamp[0], stamp[1], len(self.directories), len(self.cards))]
+		for directory, name in zip(self.directories, self.names):
+			for text in (directory, name):
+				encoded = text.encode("utf-8")
+				data.append(STRING_LENGTH.pack(len(encoded)))
+				data.append(encoded)
+		keys = sorted(self.cards)
+		data.append(struct.pack("<%dQ" % len(keys), *[key >> 64 for key in keys]))
+		data.append(struct.pack("<%dQ" % len(keys), *[key & MASK_64 for key in keys]))
+		data.append(struct.pack("<%dH" % len(keys), *[self.cards[key] for key in keys]))
+
+		tmp_path = path + ".tmp"
+		with open(tmp_path, "wb") as tmp_file:
+			tmp_file.write(b"".join(data))
+		os.rename(tmp_path, path)
+
+
+# (modification time, size) of the given file
+def file_stamp(path):
+	info = os.stat(path)
+	return (info.st_mtime, info.st_size)
+
+# Create the registry from the entries of library.json ("uid", "directory" and "name"),
+# directories with several cards are only listed once. Raises LibraryError for invalid
+# entries, UIDs that are not 4, 7 or 10 bytes long and UIDs associated with several directories.
+def from_library(entries):
+	directories = []
+	names = []
+	indexes = {}
+	cards = {}
+	if not isinstance(entries, list):
+		raise LibraryError("Bibliothek ist keine Liste")
+	for number, entry in enumerate(entries, 1):
+		try:
+			directory = entry['directory']
+			name = entry['name']
+			uid = parse_uid(entry['uid'])
+		except (KeyError, TypeError, AttributeError, ValueError):
+			raise LibraryError("Eintrag "+str(number)+" der Bibliothek ist ungültig")
+		if len(uid) not in UID_LENGTHS or not all(0 <= byte <= 255 for byte in uid):
+			raise LibraryError("Eintrag "+str(number)+" der Bibliothek hat eine ungültige UID: "+format_uid(uid))
+
+		index = indexes.get(directory)
+		if index is None:
+			index = indexes[directory] = len(directories)
+			directories.append(directory)
+			names.append(name)
+		key = pack_uid(uid)
+		if cards.get(key, index) != index:
+			raise LibraryError("UID "+format_uid(uid)+" ist mehreren Ordnern zugeordnet")
+		cards[key] = index
+	return CardRegistry(directories, names, cards)
+
+# Changes between two registries, returns (added directories, removed directories,
+# directories whose name has changed, number of cards added, removed or associated with another directory)
+def diff(old, new):
+	added = [directory for directory in new.directories if directory not in old.directory_index]
+	removed = [directory for directory in old.directories if directory not in new.directory_index]
+	renamed = [directory for directory in new.directories
+		if directory in old.directory_index and old.name(directory) != new.name(directory)]
+	changed_cards = len(set(old.cards) ^ set(new.cards))
+	for key in set(old.cards) & set(new.cards):
+		if old.directories[old.cards[key]] != new.directories[new.cards[key]]:
+			changed_cards += 1
+	return (added, removed, renamed, changed_cards)
+
+# Load the registry stored in the given file, returns None if the file is missing,
+# invalid or if it has been created from another version of the library file (stamp).
+def load(path, stamp):
+	try:
+		with open(path, "rb") as data_file:
+			data = data_file.read()
+		(magic, version, mtime, size, directory_count, card_count) = HEADER.unpack_from(data, 0)
+		if magic != MAGIC or version != VERSION or (mtime, size) != stamp:
+			return None
+
+		offset = HEADER.size
+		strings = []
+		for i in range(2 * directory_count):
+			(length,) = STRING_LENGTH.unpack_from(data, offset)
+			offset += STRING_LENGTH.size
+			strings.append(data[offset:offset + length].decode("utf-8"))
+			offset += length
+
+		if len(data) != offset + card_count * (8 + 8 + 2):
+			return None
+		upper = struct.unpack_from("<%dQ" % card_count, data, offset)
+		lower = struct.unpack_from("<%dQ" % card_count, data, offset + 8 * card_count)
+		indexes = struct.unpack_from("<%dH" % card_count, data, offset + 16 * card_count)
+
+		cards = dict(zip([(high << 64) | low for high, low in zip(upper, lower)], indexes))
+		return CardRegistry(strings[0::2], strings[1::2], cards)
+	except (IOError, OSError, struct.error, UnicodeDecodeError):
+		return None
+
+# Registry of the given library file, it is loaded from cache_path if the library file has not
+# been changed since the cache has been written, otherwise the cache is written again.
+# Raises IOError if the file cannot be read and ValueError (e.g. LibraryError) if it is invalid.
+def load_library(library_path, cache_path):
+	stamp = file_stamp(library_path)
+	registry = load(cache_path, stamp)
+	if registry is not None:
+		return registry
+
+	with open(library_path) as data_file:
+		registry = from_library(json.load(data_file))
+	try:
+		registry.save(cache_path, stamp)
+	except (IOError, OSError):
+		pass # e.g. read-only file system, the library file is parsed again next time
+	return registry
@@ -0,0 +1,32 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Monotonic clock for timeouts and durations.
+#
+# time.time() jumps whenever the system clock is set, which happens on the
+# raspberry (which has no real time clock) as soon as NTP is reachable after boot.
+# Python 2 has no time.monotonic, hence clock_gettime is called via ctypes.
+#
+
+import ctypes
+import ctypes.util
+import time
+
+CLOCK_MONOTONIC = 1
+
+class _timespec(ctypes.Structure):
+	_fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+def _ctypes_monotonic():
+	ts = _timespec()
+	if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+		return time.time()
+	return ts.tv_sec + ts.tv_nsec * 1e-9
+
+try:
+	monotonic = time.monotonic # python 3
+except AttributeError:
+	_librt = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c"), use_errno=True)
+	_clock_gettime = _librt.clock_gettime
+	_clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+	monotonic = _ctypes_monotonic
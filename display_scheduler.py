@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Display scheduler of the jukebox.
+#
+# Everything that changes the display on its own is a timed event:
+# * message expiry: a short message (e.g. the volume) is replaced by the
+#   contents shown before (e.g. the current title)
+# * scroll frame:   the next frame of a scrolled text is shown (see marquee.py)
+# * backlight off:  the backlight is switched off after some time without updates
+#
+# The events are timers of an event loop (see event_loop.py), i.e. they are kept
+# in its priority queue and the loop sleeps exactly until the next deadline or
+# until show/show_message is called by another thread. All state is only
+# accessed on the loop, hence no locks, pause flags or polling are needed.
+# The scheduler either runs on the main loop of the jukebox or on a loop of its own
+# (run by the display thread).
+#
+# While a short message is shown there is no scroll event and new contents are only
+# remembered, i.e. the message stays on the display for its whole duration without
+# any wake-up in between (unless it is replaced by another message).
+#
+
+MESSAGE_EXPIRY = "message expiry"
+SCROLL_FRAME = "scroll frame"
+BACKLIGHT_OFF = "backlight off"
+
+
+class DisplayScheduler:
+
+	# loop: event loop the scheduler runs on
+	# write: function writing the given rows to the display
+	# backlight: function switching the backlight on (True) or off (False)
+	# marquee_cache: frames of the scrolled texts (marquee.MarqueeCache)
+	# width: number of characters per row
+	# separator: shown between the end and the beginning of a scrolled text
+	# scroll_interval: time (in s) each frame of a scrolled text is shown
+	# backlight_timeout: time (in s) without updates after which the backlight is
+	#                    switched off, None keeps the backlight switched on
+	def __init__(self, loop, write, backlight, marquee_cache, width=16, separator=" * ", scroll_interval=0.5, backlight_timeout=None):
+		self.loop = loop
+		self.write = write
+		self.backlight = backlight
+		self.marquee_cache = marquee_cache
+		self.width = width
+		self.separator = separator
+		self.scroll_interval = scroll_interval
+		self.backlight_timeout = backlight_timeout
+		self.timers = {} # event -> handle of the scheduled timer
+		self.rows = None # shown if there is no short message (e.g. the current title)
+		self.scrolling = False # whether the second row of self.rows is scrolled
+		self.position = 0 # index of the frame of the scrolled row
+		self.message = None # rows of the short message currently shown
+		self.backlight_on = True
+
+	#-------------------------------------------------------------------
+	# may be called by any thread
+
+	# show the given rows, a too long second row is scrolled if scrolling is True,
+	# while a short message is shown the rows are shown once it has expired
+	def show(self, rows, scrolling=True):
+		self.loop.call_soon_threadsafe(self._show, list(rows), scrolling)
+
+	# show the given rows for duration seconds (without scrolling),
+	# afterwards the previous contents are shown again
+	def show_message(self, rows, duration):
+		self.loop.call_soon_threadsafe(self._show_message, list(rows), duration)
+
+	#-------------------------------------------------------------------
+	# run on the loop
+
+	def _show(self, rows, scrolling):
+		scrolling = scrolling and len(rows[1]) > self.width
+		self._touch()
+		if rows == self.rows and scrolling == self.scrolling:
+			return # e.g. MPD reported a change but the title is still the same, keep scrolling
+		self.rows = rows
+		self.scrolling = scrolling
+		self.position = 0
+		if self.message is not None:
+			return
+		self._start_scrolling()
+		self._refresh()
+
+	def _show_message(self, rows, duration):
+		self.message = rows
+		self._cancel(SCROLL_FRAME)
+		self._schedule(MESSAGE_EXPIRY, self.loop.time() + duration, self._message_expired)
+		self._touch()
+		self._refresh()
+
+	def _message_expired(self):
+		self.message = None
+		self.position = 0
+		self._start_scrolling()
+		self._refresh()
+
+	def _start_scrolling(self):
+		self._cancel(SCROLL_FRAME)
+		if self.scrolling:
+			deadline = self.loop.time() + self.scroll_interval
+			self._schedule(SCROLL_FRAME, deadline, self._scroll, deadline)
+
+	def _scroll(self, deadline):
+		self.position += 1
+		self._refresh()
+
+		# The frames are shown at fixed intervals regardless of how long writing
+		# took. If the loop has fallen behind, the next frame is not shown right away.
+		deadline = max(deadline + self.scroll_interval, self.loop.time())
+		self._schedule(SCROLL_FRAME, deadline, self._scroll, deadline)
+
+	# switch the backlight on (if needed) and restart the backlight timeout
+	def _touch(self):
+		if self.backlight_timeout is None:
+			return
+		if not self.backlight_on:
+			self.backlight_on = True
+			self.backlight(True)
+		self._schedule(BACKLIGHT_OFF, self.loop.time() + self.backlight_timeout, self._backlight_off)
+
+	def _backlight_off(self):
+		self.backlight_on = False
+		self.backlight(False)
+
+	def _schedule(self, event, deadline, callback, *args):
+		self._cancel(event)
+		self.timers[event] = self.loop.call_at(deadline, self._fire, event, callback, args)
+
+	def _fire(self, event, callback, args):
+		del self.timers[event]
+		callback(*args)
+
+	def _cancel(self, event):
+		handle = self.timers.pop(event, None)
+		if handle is not None:
+			handle.cancel()
+
+	# write the message, the current frame of the scrolled row or the rows
+	def _refresh(self):
+		if self.message is not None:
+			self.write(self.message)
+		elif self.rows is None:
+			return
+		elif self.scrolling:
+			frames = self.marquee_cache.frames(self.rows[1], self.width, self.separator)
+			self.write([self.rows[0], frames[self.position % len(frames)]])
+		else:
+			self.write(self.rows)
@@ -0,0 +1,216 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Single threaded event loop (similar to the asyncio event loop of python 3,
+# which is not available for the python 2 interpreter the jukebox runs with).
+#
+# Instead of one thread per task that coordinates with the other threads via
+# locks and sleeps in polling loops, all tasks are run as callbacks on one loop:
+# * call_soon/call_later/call_at schedule a callback (timers are kept in a heap,
+#   the loop sleeps exactly until the next timer is due),
+# * add_reader calls a callback whenever a file descriptor (e.g. the MPD socket) is readable,
+# * call_soon_threadsafe may be called from other threads (e.g. GPIO callbacks),
+#   it wakes up the loop via a pipe,
+# * run_in_executor runs blocking calls (e.g. waiting for an RFID card) on a small
+#   pool of worker threads and passes the result back to the loop.
+#
+
+import errno
+import fcntl
+import heapq
+import os
+import select
+import sys
+import threading
+import traceback
+
+try:
+	import Queue as queue # python 2
+except ImportError:
+	import queue
+
+from clock import monotonic
+
+
+class Handle:
+
+	def __init__(self, callback, args):
+		self.callback = callback
+		self.args = args
+		self.cancelled = False
+
+	def cancel(self):
+		self.cancelled = True
+
+	def run(self):
+		self.callback(*self.args)
+
+
+class TimerHandle(Handle):
+
+	def __init__(self, when, sequence, callback, args):
+		Handle.__init__(self, callback, args)
+		self.when = when
+		self.sequence = sequence # keeps timers with equal deadline in order
+
+	def __lt__(self, other):
+		return (self.when, self.sequence) < (other.when, other.sequence)
+
+
+class EventLoop:
+
+	# executor_workers: number of threads for blocking calls run by run_in_executor
+	def __init__(self, executor_workers=2):
+		self._ready = []
+		self._timers = []
+		self._timer_sequence = 0
+		self._readers = {}
+		self._threadsafe = []
+		self._threadsafe_lock = threading.Lock()
+		self._running = False
+		self._wakeup_read, self._wakeup_write = os.pipe()
+		for fd in (self._wakeup_read, self._wakeup_write):
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+		self._executor_queue = queue.Queue()
+		self._executor_workers = executor_workers
+		self._executor_threads = []
+
+	def time(self):
+		return monotonic()
+
+	#-------------------------------------------------------------------
+	# scheduling
+
+	def call_soon(self, callback, *args):
+		handle = Handle(callback, args)
+		self._ready.append(handle)
+		return handle
+
+	def call_at(self, when, callback, *args):
+		self._timer_sequence += 1
+		handle = TimerHandle(when, self._timer_sequence, callback, args)
+		heapq.heappush(self._timers, handle)
+		return handle
+
+	def call_later(self, delay, callback, *args):
+		return self.call_at(self.time() + delay, callback, *args)
+
+	# the only scheduling method that may be called from other threads
+	def call_soon_threadsafe(self, callback, *args):
+		handle = Handle(callback, args)
+		with self._threadsafe_lock:
+			self._threadsafe.append(handle)
+		self._wakeup()
+		return handle
+
+	def _wakeup(self):
+		try:
+			os.write(self._wakeup_write, b"x")
+		except OSError as e:
+			if e.errno != errno.EAGAIN:
+				raise
+
+	#-------------------------------------------------------------------
+	# file descriptors
+
+	# call the given callback whenever the given file descriptor is readable
+	def add_reader(self, fd, callback, *args):
+		self._readers[fd] = Handle(callback, args)
+
+	def remove_reader(self, fd):
+		return self._readers.pop(fd, None) is not None
+
+	#-------------------------------------------------------------------
+	# blocking calls
+
+	# Run function(*args) on a worker thread and call callback(result, exception)
+	# on the loop afterwards (exception is None if the function succeeded).
+	def run_in_executor(self, callback, function, *args):
+		if not self._executor_threads:
+			for i in range(self._executor_workers):
+				thread = threading.Thread(target=self._executor_worker)
+				thread.daemon = True
+				thread.start()
+				self._executor_threads.append(thread)
+		self._executor_queue.put((callback, function, args))
+
+	def _executor_worker(self):
+		while True:
+			callback, function, args = self._executor_queue.get()
+			try:
+				result = function(*args)
+			except Exception as e:
+				self.call_soon_threadsafe(callback, None, e)
+			else:
+				self.call_soon_threadsafe(callback, result, None)
+
+	#-------------------------------------------------------------------
+	# running the loop
+
+	def _run_handle(self, handle):
+		if handle.cancelled:
+			return
+		try:
+			handle.run()
+		except Exception:
+			sys.stderr.write("Fehler in Callback "+repr(handle.callback)+":\n")
+			traceback.print_exc()
+
+	def _run_once(self):
+		with self._threadsafe_lock:
+			self._ready.extend(self._threadsafe)
+			self._threadsafe = []
+
+		# drop cancelled timers at the top of the heap
+		while self._timers and self._timers[0].cancelled:
+			heapq.heappop(self._timers)
+
+		if self._ready:
+			timeout = 0
+		elif self._timers:
+			timeout = max(0, self._timers[0].when - self.time())
+		else:
+			timeout = None # sleep until a file descriptor gets readable or another thread wakes us up
+
+		fds = [self._wakeup_read] + list(self._readers.keys())
+		try:
+			readable, _, _ = select.select(fds, [], [], timeout)
+		except (select.error, OSError) as e:
+			if e.args[0] != errno.EINTR:
+				raise
+			readable = []
+
+		for fd in readable:
+			if fd == self._wakeup_read:
+				try:
+					os.read(self._wakeup_read, 4096)
+				except OSError as e:
+					if e.errno != errno.EAGAIN:
+						raise
+			elif fd in self._readers:
+				self._ready.append(self._readers[fd])
+
+		now = self.time()
+		while self._timers and self._timers[0].when <= now:
+			self._ready.append(heapq.heappop(self._timers))
+
+		# callbacks scheduled by the callbacks run now are run in the next iteration
+		ready = self._ready
+		self._ready = []
+		for handle in ready:
+			self._run_handle(handle)
+
+	def run_forever(self):
+		self._running = True
+		while self._running:
+			self._run_once()
+
+	# stop the loop, may be called from any thread
+	def stop(self):
+		def set_stopped():
+			self._running = False
+		self.call_soon_threadsafe(set_stopped)
+
+	def close(self):
+		os.close(self._wakeup_read)
+		os.close(self._wakeup_write)
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Selects the hardware backends of the jukebox on startup:
+# * RealHardware: RPi.GPIO, the spi module and the I2C LCD of RPLCD (on the raspberry)
+# * SimulatedHardware: the simulated backends of simulation.py, used if the
+#   jukebox is started with "--simulate" or the environment variable
+#   JUKEBOX_SIMULATION=1, allows running the jukebox headless on any Linux machine
+#
+# Both provide the same attributes:
+# * gpio: module like object with the RPi.GPIO interface
+# * spi: module like object with the interface of the spi module (used by MFRC522.py)
+# * create_lcd(cols, rows): creates the LCD object (RPLCD CharLCD interface)
+#
+
+import os
+import sys
+
+SIMULATION_ARGUMENT = "--simulate"
+SIMULATION_VARIABLE = "JUKEBOX_SIMULATION"
+
+# whether the simulated hardware has been requested on the command line or via environment
+def simulation_requested(argv=None):
+	if argv is None:
+		argv = sys.argv
+	return SIMULATION_ARGUMENT in argv or os.environ.get(SIMULATION_VARIABLE, "0") == "1"
+
+
+class RealHardware:
+
+	simulated = False
+
+	def __init__(self):
+		import RPi.GPIO
+		import spi
+		self.gpio = RPi.GPIO
+		self.spi = spi
+
+	def create_lcd(self, cols, rows):
+		from RPLCD import i2c
+		options = {}
+		# the cursor is positioned explicitly by the renderer (see lcd_renderer.py)
+		return i2c.CharLCD('PCF8574', 0x27, port=1, charmap='A00', cols=cols, rows=rows, expander_params=options, auto_linebreaks=False)
+
+
+class SimulatedHardware:
+
+	simulated = True
+
+	# irq_pin: GPIO channel the IRQ line of the RFID reader is connected to
+	def __init__(self, irq_pin=24):
+		import simulation
+		self.gpio = simulation.SimulatedGPIO()
+		self.rfid = simulation.SimulatedMFRC522(self.gpio, irq_pin)
+		self.spi = simulation.SimulatedSPI(self.rfid)
+		self.lcd = None
+
+	def create_lcd(self, cols, rows):
+		import simulation
+		self.lcd = simulation.SimulatedLCD(cols, rows, auto_linebreaks=False)
+		return self.lcd
+
+
+def create(simulate):
+	if simulate:
+		return SimulatedHardware()
+	return RealHardware()
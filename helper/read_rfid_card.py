@@ -21,12 +21,17 @@
 #    along with MFRC522-Python.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import RPi.GPIO as GPIO
-import MFRC522
+import os
 import signal
 import sys
 import time
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import RPi.GPIO as GPIO
+import MFRC522
+import card_registry
+
 continue_reading = True
 
 # Capture SIGINT for cleanup when the script is aborted
@@ -50,20 +55,18 @@ def main():
 
     # This loop keeps checking for chips. If one is near it will get the UID and authenticate
     while continue_reading:
-        # Wait for card
+        # Wait for card, afterwards it has already answered the REQA
+        # (another REQA would send it back to IDLE state)
         MIFAREReader.MFRC522_WaitForCard()
-    
-        # Scan for card
-        (status,TagType) = MIFAREReader.MFRC522_Request(MIFAREReader.PICC_REQIDL)
 
-        # Get the UID of the card
-        (status,uid) = MIFAREReader.MFRC522_Anticoll()
+        # Get the complete UID of the card (4, 7 or 10 bytes)
+        (status,uid) = MIFAREReader.MFRC522_ReadUID()
 
         # If we have the UID, continue
         if status == MIFAREReader.MI_OK:
 
-            # Print UID
-            print "Card UID: %s,%s,%s,%s" % (uid[0], uid[1], uid[2], uid[3])
+            # Print UID in the format of library.json
+            print "Card UID: %s" % card_registry.format_uid(uid)
         
             time.sleep(1.5)
 
@@ -0,0 +1,47 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Show the contents of the track index of the jukebox (see track_index.py)
+# without asking MPD.
+# Without parameters all directories are listed with their name and number of
+# tracks, if a directory is given its cards and tracks are listed.
+#
+# Usage:
+#   python helper/track_index_query.py [--db library.db] [tag-01]
+#
+
+import argparse
+import os
+import sqlite3
+import sys
+
+jukebox_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, jukebox_dir)
+
+import track_index
+
+parser = argparse.ArgumentParser(description="Inhalt des Titelindex der Jukebox anzeigen")
+parser.add_argument("--db", default=os.path.join(jukebox_dir, "library.db"), help="Datenbank des Titelindex")
+parser.add_argument("directory", nargs="?", help="Ordner, dessen Titel angezeigt werden")
+options = parser.parse_args()
+
+if not os.path.exists(options.db):
+	sys.exit("Titelindex "+options.db+" nicht gefunden")
+try:
+	index = track_index.TrackIndex(options.db, read_only=True)
+except sqlite3.Error as e:
+	sys.exit("Titelindex "+options.db+" kann nicht gelesen werden: "+str(e))
+
+if options.directory is None:
+	for directory, name, track_count in index.directories():
+		print("%-20s %4d Titel  %s" % (directory, track_count, name))
+else:
+	for uid in index.cards(options.directory):
+		print("Karte: "+uid)
+	for number, (file, title, duration) in enumerate(index.tracks(options.directory), 1):
+		if duration is None:
+			length = "--:--"
+		else:
+			length = "%d:%02d" % divmod(int(duration), 60)
+		print("%3d %s %s (%s)" % (number, length, title or "", file))
+index.close()
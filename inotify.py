@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Minimal binding of the Linux inotify API via ctypes,
+# hence no additional python module needs to be installed on the raspberry.
+#
+# Usage:
+#   notifier = Inotify()
+#   wd = notifier.add_watch("/home/pi/Jukebox/media", IN_CREATE | IN_DELETE)
+#   for (wd, mask, cookie, name) in notifier.read_events(timeout=1):
+#       ...
+#
+# read_events can be interrupted by another thread, e.g. in order to stop the
+# reading thread: it returns as soon as the given file descriptor is readable
+# (see PipeEvent.fileno in pipe_event.py).
+#
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+# event types (see "man 7 inotify")
+IN_ACCESS        = 0x00000001
+IN_MODIFY        = 0x00000002
+IN_ATTRIB        = 0x00000004
+IN_CLOSE_WRITE   = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN          = 0x00000020
+IN_MOVED_FROM    = 0x00000040
+IN_MOVED_TO      = 0x00000080
+IN_CREATE        = 0x00000100
+IN_DELETE        = 0x00000200
+IN_DELETE_SELF   = 0x00000400
+IN_MOVE_SELF     = 0x00000800
+
+# flags set by the kernel
+IN_UNMOUNT       = 0x00002000
+IN_Q_OVERFLOW    = 0x00004000
+IN_IGNORED       = 0x00008000
+IN_ISDIR         = 0x40000000
+
+# flags for inotify_init1
+IN_CLOEXEC       = 0o2000000
+
+# event header: int wd, uint32 mask, uint32 cookie, uint32 len
+EVENT_HEADER = struct.Struct("iIII")
+
+_libc = None
+
+def _get_libc():
+	global _libc
+	if _libc is None:
+		name = ctypes.util.find_library("c")
+		if name is None:
+			raise OSError(errno.ENOSYS, "libc nicht gefunden")
+		libc = ctypes.CDLL(name, use_errno=True)
+		if not hasattr(libc, "inotify_init1"):
+			raise OSError(errno.ENOSYS, "inotify wird nicht unterstützt")
+		_libc = libc
+	return _libc
+
+def _encode_path(path):
+	if isinstance(path, bytes):
+		return path
+	return path.encode("utf-8")
+
+def _decode_name(name):
+	if isinstance(name, str):
+		return name # python 2
+	return name.decode("utf-8", "replace")
+
+
+class Inotify:
+
+	def __init__(self):
+		self._libc = _get_libc()
+		self.fd = self._libc.inotify_init1(IN_CLOEXEC)
+		if self.fd < 0:
+			self._raise_errno()
+
+	def _raise_errno(self):
+		error = ctypes.get_errno()
+		raise OSError(error, os.strerror(error))
+
+	def fileno(self):
+		return self.fd
+
+	# watch the given path for the given events, returns the watch descriptor
+	def add_watch(self, path, mask):
+		wd = self._libc.inotify_add_watch(self.fd, _encode_path(path), mask)
+		if wd < 0:
+			self._raise_errno()
+		return wd
+
+	def rm_watch(self, wd):
+		self._libc.inotify_rm_watch(self.fd, wd)
+
+	# Wait at most timeout seconds (forever if None) for events and
+	# return them as list of (wd, mask, cookie, name) tuples.
+	# Returns an empty list if no event has occurred within the timeout
+	# or if the optional interrupt (object with fileno()) has become readable.
+	def read_events(self, timeout=None, interrupt=None):
+		fds = [self.fd]
+		if interrupt is not None:
+			fds.append(interrupt)
+		readable, _, _ = select.select(fds, [], [], timeout)
+		if self.fd not in readable:
+			return []
+
+		data = os.read(self.fd, 64 * 1024)
+		events = []
+		offset = 0
+		while offset + EVENT_HEADER.size <= len(data):
+			wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+			offset += EVENT_HEADER.size
+			name = data[offset:offset + length].rstrip(b"\0")
+			offset += length
+			events.append((wd, mask, cookie, _decode_name(name)))
+		return events
+
+	def close(self):
+		if self.fd >= 0:
+			os.close(self.fd)
+			self.fd = -1
@@ -3,32 +3,62 @@
 #
 # This script runs the following threads:
 # * display thread: 
-#   - prints contents of display_current to the display,
-#   - this thread is also responsible for scrolling the text
+#   - runs the display scheduler (see display_scheduler.py) which shows
+#     the current title, scrolls it and replaces short messages after their duration
 # * RFID thread:
 #	- listens for an interrupt caused by reading an RFID tag
 #   - on detection of an RFID tag play contents of associated directory
+#   - checks whether the tag is still on the reader (see card_presence.py),
+#     optionally pauses when it is removed and resumes when it is put back
+# * media watcher thread:
+#   - waits for changes of the "tag-*" directories (e.g. uploaded files)
+#   - updates the MPD database only for the changed directories
+# * track scanner thread:
+#   - reads the tracks of the directories whose playlists have been (re-)built
+#     from the MPD database into the track index (see track_index.py)
+# * warm cache thread:
+#   - keeps the beginning of the first track and of the resume track of every
+#     directory in memory (see warm_cache.py)
+# * prefetch thread:
+#   - reads the next track into the page cache shortly before the current one ends
+#     (see prefetch.py)
+# * MPD listener thread:
+#   - waits for MPD to report changes of the player, the mixer or the playlist
+#   - updates the display if the track has changed on its own
+#     (i.e. the previous track has ended) or the volume has been changed
 # * main thread
 #
+# All commands are sent to MPD over a persistent connection (see mpd_client.py),
+# no mpc processes are spawned.
+#
 # The following actions are taken when a button is pressed:
 # * play/pause button:
-#   - execute "mpc -q play/pause" as subprocess
-#   - updates contents of display_current to the currently running track
+#   - send "play"/"pause" to MPD
+#   - shows the currently running track on the display
 # * next button:
-#   - execute "mpc -q next" as subprocess
-#   - updates contents of display_current to the currently running track
+#   - send "next" to MPD
+#   - shows the currently running track on the display
 # * previous button:
-#   - execute "mpc -q prev" as subprocess
-#   - updates contents of display_current to the currently running track
+#   - send "previous" to MPD
+#   - shows the currently running track on the display
 # * volume up button:
-#   - executes "mpc -q volume +2" as subprocess
-#   - update the contents of display_current to hold the text "Lauter"
-#     and the current volume
-#   - store previous display contents and timestamp of when to display them again
+#   - increase the volume by 2% (see volume_control.py)
+#   - show the text "Lauter" and the current volume for a short time,
+#     afterwards the display shows the current track again
 # * volume down button:
-#   - executes "mpc -q volume -2" as subprocess
+#   - decrease the volume by 2%
 #   - the rest is analgous to the volume up action
 #
+# If use_event_loop is enabled, the display, the RFID reader, the MPD listener
+# and the button callbacks are not run in separate threads but as callbacks on a
+# single event loop run by the main thread (see event_loop.py). Waiting for an
+# RFID card blocks, hence it is run on a worker thread of the loop.
+#
+# The buttons, the RFID reader and the LCD can be simulated (see simulation.py),
+# e.g. for running the jukebox on a PC without the hardware. In this case start
+# the jukebox with "--simulate" (or set JUKEBOX_SIMULATION=1) and enter commands
+# for the simulated hardware on stdin (e.g. "card 176,223,243,121", "next", "lcd").
+#
 # Furthermore, immediately after each button press it is checked
 # if the sequences of recently pressed buttons matches one of the
 # predefined "hidden options".
@@ -38,17 +68,39 @@
 # * volume down - volume up - volume down - volume up: disable/enable the display
 #
 
-import RPi.GPIO as GPIO
-from RPLCD import i2c, gpio
+import hardware
+import simulation
 import MFRC522
+import mpd_client
+import media_watcher
+import volume_control
+import event_loop
+import state_store
+import tracing
+import log_writer
+import lcd_renderer
+import marquee
+import lcd_text
+import display_scheduler
+import card_presence
+import card_registry
+import library_watcher
+import track_index
+import warm_cache
+import prefetch
 import time
 import subprocess
 from threading import Thread, Lock
 import threading
-import logging
 import sys
-import string
 import json
+import os
+import signal
+import sqlite3
+try:
+	from StringIO import StringIO # python 2
+except ImportError:
+	from io import StringIO
 
 ########################################################################
 # CONFIGURATION
@@ -57,25 +109,78 @@ import json
 print("###########################################")
 print("Jukebox startet...")
 
+# real or simulated hardware
+simulate_hardware = hardware.simulation_requested()
+hw = hardware.create(simulate_hardware)
+GPIO = hw.gpio
+if simulate_hardware:
+	print("Hardware wird simuliert")
+
 GPIO.setwarnings(False)
 
 reload(sys)
 sys.setdefaultencoding('utf8')
 
-this_script_dir = sys.path[0]+"/"
+this_script_dir = os.path.dirname(os.path.abspath(__file__))+"/"
 
 # library information are stored in this JSON file
 library_file = this_script_dir+"library.json"
+# compact form of the library which is loaded much faster (see card_registry.py),
+# it is written again whenever library.json has been changed
+library_cache_file = this_script_dir+"library.cache"
+# library.json is watched and loaded again after it has been changed (see library_watcher.py)
+library_watcher_enabled = True
+# The library and the titles, durations and modification times of all tracks are kept in this
+# SQLite database (see track_index.py). It is updated in the background, the display and the
+# resume logic look up tracks there instead of asking MPD.
+track_index_enabled = True
+track_index_file = this_script_dir+"library.db"
+track_db = None
+
+# The beginning of the first track and the part of the resume track played next of every
+# directory are kept in memory (see warm_cache.py), i.e. MPD does not wait for the SD card
+# when a card is put on the reader. Requires the track index. Locking the memory requires
+# root or a sufficient LimitMEMLOCK in jukebox.service, otherwise the parts are only read ahead.
+# The hits and misses are written to the log on SIGUSR2 and when the jukebox is stopped.
+warm_cache_enabled = True
+warm_cache_seconds = 10					# how much (in s) of each track is kept in memory
+warm_cache_budget = 32*1024*1024		# maximum memory (in bytes) used for the tracks
+warm_cache_lock_pages = True			# whether to lock the tracks into memory
+warm_cache_thread = None
+
+# The next track is read into the page cache prefetch_window seconds before the current
+# track ends (see prefetch.py), hence MPD does not wait for the SD card when it advances
+# to the next track. Requires the track index. The bytes read are written to the log
+# together with the statistics of the warm cache.
+prefetch_enabled = True
+prefetch_window = 30					# how long (in s) before the end of the track to read the next one
+prefetch_max_bytes = 16*1024*1024		# maximum number of bytes read of each track
+prefetch_workers = 1					# maximum number of tracks read at the same time
+prefetcher = None
 
 # directory containing the "tag-*" directories which in turn contain the audio files
 # NOTE: /etc/mpd.conf should contain 'music_directory "/home/pi/Jukebox/media"'
-media_dir = "/home/pi/Jukebox/media/"
-suonds_dir = media_dir+"sounds"
-
-# will be filled with contents from JSON library
-media_directories = [] # example: ["/home/pi/Jukebox/media/tag-01", "/home/pi/Jukebox/media/tag-02"]
-media_titles = {}      # example: {"tag-01" : "Kitafrösche", "tag-02" : "Bobo"}
-uid_to_tag = {}        # example: { "176,223,243,121" : "tag-01", "64,128,53,131" : "tag-02"}
+media_dir = this_script_dir+"media/"
+suonds_dir = media_dir+"sounds/"
+
+# The media directory is watched for changes. The MPD database is only updated for
+# the "tag-*" directories that changed and only after no further changes happened for
+# media_update_settle_time seconds. Playing a directory never triggers a database update.
+media_watcher_enabled = True
+media_update_settle_time = 5
+
+# For each entry of the library a stored MPD playlist with this prefix is created
+# (e.g. "jukebox-tag-01"), thus switching to a directory requires a single "load"
+# instead of MPD walking the whole directory again.
+# NOTE: mpd.conf needs to define a playlist_directory
+playlist_prefix = "jukebox-"
+playlists_pending = set()	# directories whose playlists are rebuilt after the running database update has finished
+playlists_pending_lock = Lock()
+
+# Registry of the RFID cards, their directories and the names of the directories loaded from
+# library.json (see card_registry.py). It is never changed but replaced as a whole when
+# library.json has been changed, i.e. functions using it more than once keep a reference.
+library = None
 
 # sounds
 ping_sound = suonds_dir+"ping.mp3"				# sound to play when a registered RFID card is recognized 
@@ -84,14 +189,10 @@ ping_sound = suonds_dir+"ping.mp3"				# sound to play when a registered RFID car
 startup_sound = ping_sound
 play_startup_sound = True 							# whether to play the startup sound right after boot
 
-initial_volume = "90"	# mpc percentage of initial volume
+initial_volume = 90	# mpc percentage of initial volume
 mpc_begin_volume = 50		# if the mpc volume is 50% display a volume of 0% at the LCD
 scale_volume = 100/(100-mpc_begin_volume)
 
-# display status
-PAUSE=1
-UNPAUSE=0
-
 # via button sequences specific "hidden" functions can be triggered
 PLAY_PAUSE = 0
 PREV = 1
@@ -109,8 +210,25 @@ sequence_display = [VOLUME_DOWN, PREV, PLAY_PAUSE, VOLUME_UP]		# sequence for di
 sequence_ip = [PREV, PREV, PREV, PREV, PREV]      					# show the IP address on the display
 back_to_initial_volume = [VOLUME_DOWN, VOLUME_UP, VOLUME_DOWN, VOLUME_UP] # set volume to initial volume
 
-# current (and initial) start media directory 
-media_current_dir_index = 0
+# current media directory (e.g. "tag-01"), initially the first directory of the library
+media_current_dir = None
+
+# The position (track and time) within each directory is remembered and the directory
+# is resumed at this position when its RFID card is detected again.
+# The positions are kept in memory and written to state_file every
+# state_flush_interval seconds (only if they have changed) to spare the SD card.
+resume_enabled = True
+state_file = this_script_dir+"state.json"
+state_flush_interval = 30
+
+# persistent connection to MPD used for all commands,
+# connection parameters default to MPD_HOST/MPD_PORT (just like mpc)
+mpd = mpd_client.MPDClient()
+
+# the volume is kept locally, changes are sent to MPD by a separate thread,
+# volume button presses within volume_coalesce_time seconds are sent as a single change
+volume_coalesce_time = 0.1
+volume_controller = volume_control.VolumeController(mpd, volume_coalesce_time)
 
 # define GPIO pins of the buttons
 gpio_play_pause=4	# red button
@@ -155,16 +273,30 @@ title_separator =  " * "
 jukebox_off_text = ["  Jukebox ist   ", " ausgeschaltet  "]
 
 # create lcd object
-options = {}
-lcd = i2c.CharLCD('PCF8574', 0x27, port=1, charmap='A00', cols=16, rows=2, expander_params=options)
+lcd = hw.create_lcd(16, 2)
 lcd_lock = Lock()
 
+# umlauts and ß are shown with custom glyphs, they are uploaded to the display once (see lcd_text.py)
+lcd_text.upload_glyphs(lcd)
+
+# texts prepared for the display, the 1024 most recently used ones are kept
+text_preparer = lcd_text.TextPreparer(1024)
+
+# only the characters that differ from the current display contents are written (see lcd_renderer.py)
+display_renderer = lcd_renderer.LCDRenderer(lcd, 16, 2)
+
 # RFID reader configuration
 rfid_enabled = True			# the RFID reader can be disabled in this case the RFID reader thread is not created
 rfid_reader_running = False	# whether the RFID reader thread is running
-rfid_sleep_time = 1			# how long to wait (in seconds) until to accept a next card
+rfid_sleep_time = 1			# how long (in seconds) a card may not answer until it counts as removed,
+							# a card put back on the reader within this time is not read again
+rfid_check_interval = 0.5	# how often (in seconds) to check whether the card is still on the reader
+rfid_pause_on_removal = False	# pause when the card is removed, resume when it is put back
+rfid_irq_completion = True	# wait for the IRQ line of the reader instead of polling its registers over SPI
+rfid_paused_uid = None		# UID of the card whose removal has paused the playback
 if rfid_enabled:
-	MIFAREReader = MFRC522.MFRC522()
+	MIFAREReader = MFRC522.MFRC522(gpio=GPIO, spi_backend=hw.spi, irq_completion=rfid_irq_completion)
+	card_tracker = card_presence.CardPresence(MIFAREReader, lambda timeout: read_rfid_uid(timeout), rfid_check_interval, rfid_sleep_time)
 	rfid_reader_running = True
 
 #-----------------------------------------------------------------------
@@ -172,43 +304,33 @@ if rfid_enabled:
 
 display_width = 16							# number of characters the display can show
 display_enabled = True						# whether the display is used 
-display_running = True						# whether the display thread is running
 display_scrolling_always_disabled = False	# whether to deactivate scrolling of scrolling, 
 											# by default the second display line containing the title is scrolled
 display_scrolling_enabled = True			# whether to stop scrolling of second display line,
 											# this is only used for *temporarily* disabling the scrolling, 
-											# this is used when showing the volume after increasing or decreasing it
-											# or in case the playback has been paused
-display_current = list(display_initial)		# array holding the text to show in display
-display_current_lock = Lock()				# lock access to any display related variables
-display_previous = list(display_current)	# in case the display temporarily shows status information (e.g. volume info)
-											# this variable holds the contents of the display before showing the status
-											# informations
+											# this is used in case the playback has been paused
+marquee_cache = marquee.MarqueeCache(16)	# frames of the recently scrolled texts
 display_sleep=0.5							# sleep time (in s) for text scrolling,
 											# this value defines the speed of text scrolling
 											# the larger the value the slower the scrolling
-display_thread_paused = False				# whether the diyplay is interrupted,
-											# this variable is only set by the function set_display_thread_paused
-											# and read by the display thread callback function
-display_thread_paused_lock = Lock()
-display_event_skip_wait = False				# whether the display thread shall skip waiting for the display event to be triggered
-display_event_skip_wait_lock = Lock()
-title_changed_observer_running = True		# If enabled an observer thread is run that periodically checks whether
-											# the currently playing track coincides with the track shown on the display.
-											# Those may diverge if the track has automatically changed (without RFID tag or button press).
-											# This may happen if the selected track has ended and the next track in the same
-											# directory is automatically started.
-current_track = ""							# holds the currently played track,
-											# updated on according button press, RFID card or by observer thread
-title_changed_observer_sleep=2				# number of seconds to wait until new comparison of currently played track and diplay contents.
+display_backlight_timeout = None			# time (in s) without display updates after which the backlight
+											# is switched off, None keeps the backlight switched on
+mpd_listener_subsystems = ["player", "mixer", "playlist", "update"]
+											# MPD subsystems the listener thread waits for.
+											# The currently playing track may diverge from the track shown on the display
+											# if the track has automatically changed (without RFID tag or button press).
+											# This happens if the selected track has ended and the next track in the same
+											# directory is automatically started. MPD reports this as a "player" change.
+											# "update" is reported when a database update has started or finished,
+											# after that the stored playlists of the updated directories are rebuilt.
+current_track = ""							# holds the file of the currently played track,
+											# updated on according button press, RFID card or by the MPD listener thread
 
 show_ip_address_on_startup = False			# whether to show the IP address right after booting on display
 no_ip_text = "nicht verbunden"
 enable_volume_info_output = True			# whether to output the new volume on the display on volum button press
 show_volume_change_time_ms = 1500 			# how long to short info messages (in ms)
 show_ip_time_ms = 4500						# how long to show the IP address at the display (in ms)
-show_previous_timestamp = -1				# if set to a positive number, display the contents
-                            				# of the previous display again at this time
 
 
 #-----------------------------------------------------------------------
@@ -216,25 +338,49 @@ show_previous_timestamp = -1				# if set to a positive number, display the conte
 
 print_library = False		# print library contents at the beginning to console
 print_button_info = True	# print pressed button to console
-debug_output = True			# whether to enable/disable debug output
+log_level = log_writer.INFO	# minimum level of the messages to output, log_writer.DEBUG enables debug output
 
-display_previous_scrolling_status = display_scrolling_enabled
+# log thread writing the messages in batches,
+# the same message is written at most 5 times within 10 seconds
+log = log_writer.LogWriter(lambda: sys.stdout, log_level, rate_limit=5, rate_period=10)
+log.start()
+
+# Tracing of the stages of the RFID reader, MPD and the display (see tracing.py).
+# The recorded stages are written to the log when the jukebox receives SIGUSR1.
+# Tracing can also be enabled by starting the jukebox with "--trace".
+tracing_enabled = "--trace" in sys.argv
+tracing_buffer_size = 2000
+trace_pending_title = None	# (directory, title) set by update_display_current,
+							# the first time write_to_lcd shows this title is traced
 
 # lock for performing a sequence of operations with the mpc command
-# lock the variables media_current_dir_index, playing and sequences of calls to mpc
+# lock the variables media_current_dir, playing and sequences of calls to mpc
 # that should better not be "interrupted"
 mpc_lock = Lock()
 
 # list of threads created during execution
 threads = []
+display_thread = None
+
+# run display, RFID reader, MPD listener and button callbacks on a single event loop instead of threads
+use_event_loop = False
+main_loop = None
+if use_event_loop:
+	main_loop = event_loop.EventLoop()
 
 # whether the jukebox is playing a track or it is currently paused
 playing = False
 library_loaded = False
 
-# event that can be triggered and causes the display thread to update its contents
-display_event = threading.Event()
-display_event_lock = Lock()
+# The display scheduler shows the contents, scrolls them and replaces short messages
+# (see display_scheduler.py). It runs on the event loop or on a loop of its own run
+# by the display thread.
+if use_event_loop:
+	display_loop = main_loop
+else:
+	display_loop = event_loop.EventLoop()
+display = display_scheduler.DisplayScheduler(display_loop, lambda rows: write_to_lcd(rows), lambda on: set_backlight(on),
+	marquee_cache, display_width, title_separator, display_sleep, display_backlight_timeout)
 
 ########################################################################
 # FUNCTIONS
@@ -253,19 +399,19 @@ def get_ip_address():
 
 	return ip
 
-# unbuffered printing is required for correctly printing when running this script as systemd service
-def my_print(print_str):
-	logging.debug(print_str)
-	print "thread"+str(threading.current_thread().ident)+": "+print_str
-	sys.stdout.flush()
+# The message is only queued, the log thread writes it to stdout (see log_writer.py).
+# Thus the caller never waits for stdout to be flushed (e.g. to journald when
+# running this script as systemd service), even if it holds a lock.
+# limit: whether the message may be suppressed if it is repeated too often
+def my_print(print_str, level=log_writer.INFO, limit=True):
+	log.log(level, print_str, limit)
 
 def print_button_info(button):
 	if print_button_info:
 		my_print(button + " Knopf gedrückt")
 
 def debug_output(print_str):
-	if debug_output:
-		my_print(print_str)
+	my_print(print_str, log_writer.DEBUG)
 
 # convert the given string to unicode string (if it not already a unicode string)
 def to_unicode(str):
@@ -276,20 +422,22 @@ def to_unicode(str):
 		return text
 	return text
 
-# prepare the given text for being displayed on the LCD
+# prepare the given text for being displayed on the LCD (see lcd_text.py),
+# i.e. remove unprintable characters and replace umlauts by their custom glyphs
 def prepare_for_display(str):
-		# replace ß
-		str=str.replace("ß", "ss")
-
-		# remove non-printable characters
-		# source: https://stackoverflow.com/questions/92438/stripping-non-printable-characters-from-a-string-in-python
-		special_chars = "äÄöÖüÜ"
-		str=''.join([x for x in str if(x in string.printable and x != '\n' and x != '\r') or (x in special_chars) ])
-		
-		return to_unicode(str)
+	return text_preparer.prepare(to_unicode(str))
 
 def play_ping_sound():
-	subprocess.Popen(["mpg123", "-q", ping_sound])
+	play_sound(ping_sound)
+
+# play the given sound file independently of mpd
+def play_sound(sound_file):
+	trace_start = tracing.begin()
+	try:
+		subprocess.Popen(["mpg123", "-q", sound_file])
+	except OSError as e:
+		my_print("Fehler beim Abspielen von "+sound_file+": "+str(e), log_writer.ERROR)
+	tracing.end("sound.start", trace_start, sound_file)
 	
 
 # print library contents (library needs to be loaded before)
@@ -301,230 +449,256 @@ def print_library():
 	if not library_loaded:
 		return
 
-	my_print("Inhalt der Bibliothek:")
-	my_print("-------------------------------------------")
-	for uid in uid_to_tag:
-			dir_name = uid_to_tag[uid]
-			my_print("Ordner: "+ dir_name)
-			my_print("Titel: "+media_titles[dir_name])
-			my_print("UID: "+uid)
-			my_print("-------------------------------------------")
+	my_print("Inhalt der Bibliothek:", limit=False)
+	my_print("-------------------------------------------", limit=False)
+	snapshot = library
+	for (uid, index) in snapshot.entries():
+			my_print("Ordner: "+ snapshot.directories[index], limit=False)
+			my_print("Titel: "+snapshot.names[index], limit=False)
+			my_print("UID: "+card_registry.format_uid(uid), limit=False)
+			my_print("-------------------------------------------", limit=False)
 	
 
 # load library from JSON file
 def load_library():
-	global media_directories
-	global media_titles
-	global uid_to_tag
+	global library
 	global library_loaded
 
-	with open(library_file) as data_file:
-	    library_as_json = json.load(data_file)
-	    data_file.close()
-
-	for entry in library_as_json:
-		name = prepare_for_display(entry['name'])
-		media_directories.append(entry['directory'])
-		media_titles[entry['directory']] = name
-		uid_to_tag[entry['uid']] = entry['directory']
+	library = card_registry.load_library(library_file, library_cache_file)
+	update_track_index(library)
 
-	my_print("Bibliothek mit "+str(len(media_titles))+" Einträgen erfolgreich geladen.")
+	my_print("Bibliothek mit "+str(len(library.directories))+" Einträgen und "+str(len(library))+" Karten erfolgreich geladen.")
 	library_loaded = True
 
+# called by the library watcher thread once library.json has been changed and loaded again,
+# the new library replaces the previous one at once
+def library_changed_callback(registry, error):
+	global library
+
+	if error is not None:
+		my_print("Geänderte Bibliothek nicht geladen, die bisherige wird weiter verwendet: "+str(error), log_writer.ERROR)
+		return
+
+	(added, removed, renamed, changed_cards) = card_registry.diff(library, registry)
+	library = registry
+	update_track_index(registry)
+	if warm_cache_thread is not None:
+		warm_cache_thread.remove(removed)
+	my_print("Bibliothek neu geladen: "+str(len(added))+" neue, "+str(len(removed))+" entfernte, "
+		+str(len(renamed))+" umbenannte Ordner, "+str(changed_cards)+" geänderte Karten")
+
+	# only the new directories need a playlist
+	if added:
+		build_playlists(added)
+	if media_current_dir in renamed:
+		update_display_current(True)
+
+# store the tags and cards of the given registry in the track index
+def update_track_index(registry):
+	if track_db is None:
+		return
+	try:
+		track_db.update_library(registry)
+	except sqlite3.Error as e:
+		my_print("Fehler beim Aktualisieren des Titelindex: "+str(e), log_writer.ERROR)
+
+# called by the track scanner thread once a directory has been scanned
+def track_scanned_callback(directory, changed, error):
+	if error is not None:
+		my_print("Titel von Ordner "+directory+" nicht indiziert: "+str(error), log_writer.WARNING)
+		return
+	if changed:
+		my_print("Titelindex von Ordner "+directory+" aktualisiert: "+str(changed)+" geänderte Titel", log_writer.DEBUG)
+	if warm_cache_thread is not None and (changed or not warm_cache_thread.is_warm(directory)):
+		warm_cache_thread.warm([directory])
+
+# parts of the tracks of the given directory to keep in memory (called by the warm cache thread):
+# the beginning of the first track and the part of the resume track starting at the resume position
+def get_warm_cache_regions(directory):
+	try:
+		tracks = track_db.tracks(directory)
+		if not tracks:
+			return []
+		selected = [(tracks[0], 0)]
+		position = get_resume_position(directory)
+		if position is not None and position['song'] < len(tracks):
+			selected.append((tracks[position['song']], position['elapsed']))
+		regions = []
+		for (file, title, duration), elapsed in selected:
+			regions.append(warm_cache.track_region(media_dir+file, duration, elapsed, warm_cache_seconds))
+		return regions
+	except (sqlite3.Error, OSError) as e:
+		my_print("Titel von Ordner "+directory+" nicht vorgeladen: "+str(e), log_writer.WARNING)
+		return []
+
+# Read the next track shortly before the current one ends given the MPD status,
+# nothing is read while the playback is paused or stopped.
+# NOTE: this method may only be called if mpc_lock is already acquired
+def schedule_prefetch(status):
+	if prefetcher is None:
+		return
+	if status.get('state') != 'play' or 'nextsong' not in status:
+		prefetcher.cancel()
+		return
+	(track, track_count) = lookup_track(media_current_dir, int(status['nextsong']))
+	if track is None or track_count != int(status.get('playlistlength', -1)):
+		prefetcher.cancel() # the queue does not match the index
+		return
+	duration = status.get('duration')
+	if duration is None:
+		(current, track_count) = lookup_track(media_current_dir, int(status['song']))
+		duration = current[2] if current is not None else None
+	remaining = 0
+	if duration is not None:
+		remaining = float(duration) - float(status.get('elapsed', 0))
+	prefetcher.schedule(media_dir+track[0], max(0, remaining - prefetch_window))
+
+# write the hits and misses of the warm cache and the bytes read by the prefetcher to the log
+def print_cache_statistics():
+	megabyte = 1024.0 * 1024
+	if prefetcher is not None:
+		statistics = prefetcher.statistics()
+		my_print("Vorab gelesene Titel: %d Titel mit %.1f MB gelesen, davon %.1f MB nicht im Cache, %d abgebrochen, %d Lesefehler" % (
+			statistics['files'], statistics['bytes_read'] / megabyte, statistics['bytes_saved'] / megabyte,
+			statistics['aborted'], statistics['failures']))
+	if warm_cache_thread is None:
+		return
+	statistics = warm_cache_thread.statistics()
+	my_print("Vorgeladene Titel: %d Treffer, %d Fehlschläge, %d Ordner mit %.1f MB (%.1f MB gesperrt) von %.1f MB, %d verdrängt, %d Lesefehler" % (
+		statistics['hits'], statistics['misses'], statistics['directories'], statistics['bytes'] / megabyte,
+		statistics['locked_bytes'] / megabyte, statistics['budget'] / megabyte, statistics['evictions'], statistics['failures']))
+
+# (track, number of tracks of the directory) according to the track index, the track is given
+# as (file, title, duration) or None if there is no track at this position,
+# (None, 0) if the index is disabled or the directory has not been indexed yet
+def lookup_track(directory, position):
+	if track_db is None:
+		return (None, 0)
+	try:
+		return (track_db.track_at(directory, position), track_db.track_count(directory))
+	except sqlite3.Error as e:
+		my_print("Fehler beim Abfragen des Titelindex: "+str(e), log_writer.ERROR)
+		return (None, 0)
+
+# Meta data (file and Title) of the current song given the MPD status. It is taken from the
+# track index if the queue holds as many tracks as the current directory has according to
+# the index (i.e. the directory has not changed since the queue was loaded), otherwise
+# it is requested from MPD.
+# NOTE: this method may only be called if mpc_lock is already acquired
+def get_current_song(status):
+	if 'song' in status:
+		(track, track_count) = lookup_track(media_current_dir, int(status['song']))
+		if track is not None and track_count == int(status.get('playlistlength', -1)):
+			return {'file': track[0], 'Title': track[1] or ''}
+	return mpd.currentsong()
+
+# name of the current directory as shown on the display
+def get_current_media_title():
+	return prepare_for_display(library.name(media_current_dir) or "")
+
 # write the framebuffer out to the given LCD
 def write_to_lcd(framebuffer):
 	global lcd
 	global lcd_lock
+	global trace_pending_title
 	if not display_enabled:
 		return
 
-	num_cols = 16
 	lcd_lock.acquire()
 	try:
-		lcd.home()
-		for row in framebuffer:
-			lcd.write_string(row.ljust(num_cols)[:num_cols])
-			lcd.write_string('\r\n')
+		display_renderer.render(framebuffer)
 	finally:
 		lcd_lock.release()
 
+	if trace_pending_title is not None:
+		directory, title = trace_pending_title
+		if framebuffer[0] == directory and framebuffer[1] in title + title_separator + title:
+			trace_pending_title = None
+			tracing.event("lcd.title", lcd_text.readable(framebuffer[1]))
+
 
 # enable/disable display scrolling
 def set_display_scrolling(value):
 	if display_scrolling_always_disabled:
 		return
 
-	global lcd_lock
 	global display_scrolling_enabled
 	display_scrolling_enabled = value
 
-	# for some reason we need to clear the lcd
-	lcd_lock.acquire()
-	try:
-		lcd.clear()
-	finally:
-		lcd_lock.release()
-
 # get current volume
 def get_current_volume():
+	return volume_controller.get_volume()
 
-	cmd = "mpc | grep 'volume:' | awk -F'%' '{print $1}' | awk -F':' '{print $2}' | tr -d '[:space:]'"
-	mpc_volume = int(subprocess.check_output(cmd, shell=True))
-	return mpc_volume
-
-# clear the contents of display_current
-# NOTE: this method may only be called if the display lock is already acquired
-def clear_display_current():
-	global display_current
-	display_current[0] = '                '
-	display_current[1] = '                '
-	
-def trigger_display_event():
-	global display_event
-	try:
-		display_event_lock.acquire()
-		display_event.set()
-	finally:
-		display_event_lock.release()
-
-# thread safe setting of display thread status (paused or unpaused)
-def set_display_thread_paused(status):
-	global display_thread_paused
-	global display_thread_paused_lock
-	global display_event_skip_wait
-
-	try:
-		display_thread_paused_lock.acquire()
-		if status == PAUSE:
-			display_thread_paused = True
-		elif status == UNPAUSE:
-			display_thread_paused = False
-	finally:
-		display_thread_paused_lock.release()
-
-	try:
-		display_event_skip_wait_lock.acquire()
-		display_event_skip_wait = True
-	finally:
-		display_event_skip_wait_lock.release()
-
-# threadsafe getting of display thread status
-def get_display_thread_paused():
-	try:
-		display_thread_paused_lock.acquire()
-		paused = display_thread_paused
-	finally:
-		display_thread_paused_lock.release()
-	return paused
-
+# switch the backlight of the LCD on or off
+def set_backlight(on):
+	if not display_enabled:
+		return
 
-# threadsafe getting of display array contents
-def get_display_current():
-	display_framebuffer = ['','']
+	lcd_lock.acquire()
 	try:
-		display_current_lock.acquire()
-		display_framebuffer[0] = display_current[0]
-		display_framebuffer[1] = display_current[1]
+		lcd.backlight_enabled = on
 	finally:
-		display_current_lock.release()
-	return display_framebuffer
-
+		lcd_lock.release()
 
 # Prints the given message for the given number of ms on the display.
-# Remembers the previously shown text and shows that text after
-# duration_in_ms ms has ellapsed.
+# Afterwards the display shows the current track again (the display
+# scheduler shows the message for its whole duration).
 def display_short_message(message_row_1, message_row_2, duration_in_ms):
-	global display_current_lock
-	global display_previous
-	global display_previous_scrolling_status
-	global display_current
-	global show_previous_timestamp
-
 	my_print("Zeige Nachricht für "+str(duration_in_ms)+"ms auf dem Display:")
 	my_print(message_row_1)
 	my_print(message_row_2)
 
-	display_current_lock.acquire()
-	try:
-		# only update display_previous if a short message is currently not shown
-		if show_previous_timestamp == -1:
-			display_previous = list(display_current) # need to copy the list in display_current
-			display_previous_scrolling_status = display_scrolling_enabled
-
-		clear_display_current()
-		display_current[0] = message_row_1
-		display_current[1] = message_row_2
-
-		# show previous display contents at this timestamp
-		show_previous_timestamp = duration_in_ms + int(round(time.time() * 1000))
-		set_display_scrolling(False)
-		trigger_display_event()
-
-		set_display_thread_paused(UNPAUSE)
-
-	finally:
-		display_current_lock.release()
+	display.show_message([prepare_for_display(message_row_1), prepare_for_display(message_row_2)], duration_in_ms / 1000.0)
 
 
 # handle a button press, i.e.:
 # * increase/decrease volume
-# * pause display thread
-# * change contents of display to current volume
-# * disable display scrolling
-# * unpause display thread
-# * trigger display thread to proceed
+# * show the new volume for a short time
 def handle_volume_button_press(text, up):
 
+	# only changes the local volume, it is sent to MPD in the background
 	if up:
-		subprocess.Popen(["mpc", "-q", "volume", "+2"])
+		new_volume = volume_controller.change(+2)
 	else:
-		subprocess.Popen(["mpc", "-q", "volume", "-2"])
+		new_volume = volume_controller.change(-2)
+	if new_volume < 0:
+		my_print("Lautstärke unbekannt", log_writer.WARNING)
+		return
 
-	new_volume=get_current_volume()
+	show_volume(text, new_volume)
 
+# show the given volume for a short time on the display
+def show_volume(text, new_volume):
 	if not enable_volume_info_output:
 		return
 
 	# display own scale of volume instead of the direct mpc volume
 	display_volume = (new_volume - mpc_begin_volume)*scale_volume
 	display_short_message(text, u'Lautstärke: '+str(display_volume)+'%', show_volume_change_time_ms)
-	
-
-# check whether to show the previous display contents again
-# if so: update display array contents
-def check_and_show_previous():
-	global show_previous_timestamp
-	global display_current
-	global display_current_lock
-
-	current = int(round(time.time() * 1000))
-	if show_previous_timestamp >= 0 and current >= show_previous_timestamp:
-		display_current_lock.acquire()
-		try:
-			clear_display_current()
-			display_current = list(display_previous)
-		finally:
-			display_current_lock.release()
-		show_previous_timestamp = -1
-		set_display_scrolling(display_previous_scrolling_status)
-		trigger_display_event()
 
 
-# update the contents of display_current (the array, not the display itself) 
-# to the currently running track
-def update_display_current(update_display_title):
-	global display_current_lock
+# show the currently running track on the display,
+# song: meta data of the current song if already known (otherwise requested from MPD)
+def update_display_current(update_display_title, song=None):
 	global mpc_lock
 	global current_track
-	global display_event
+	global trace_pending_title
 
+	trace_start = tracing.begin()
 	title = ''
 	if update_display_title:
-		cmd="mpc current --format %title% | head -1"
 		try:
 			mpc_lock.acquire()
-			title = subprocess.check_output(cmd, shell=True)
-			title = prepare_for_display(title)
+			if song is None:
+				song = mpd.currentsong()
+			title = prepare_for_display(song.get('Title', ''))
+
+			# Store the currently running track in order to notice when it changes on its own.
+			# This happens if a track is finished and automatically the next one in the
+			# playlist is played.
+			current_track = song.get('file', '')
+		except mpd_client.MPDError as e:
+			my_print("Fehler beim Abfragen des aktuellen Titels: "+str(e), log_writer.ERROR)
 		finally:
 			mpc_lock.release()
 
@@ -535,27 +709,14 @@ def update_display_current(update_display_title):
 	# get information about current track
 	try:
 		mpc_lock.acquire()
-		directory = media_titles[media_directories[media_current_dir_index]]
+		directory = get_current_media_title()
 	finally:
 		mpc_lock.release()
 
-	# update display_current
-	set_display_thread_paused(PAUSE)
-	display_current_lock.acquire()
-	try:
-		clear_display_current()
-		display_current[0] = directory
-		display_current[1] = title
-	finally:
-		display_current_lock.release()
-	set_display_thread_paused(UNPAUSE)
-	trigger_display_event() # fire event for waking up display thread
-
-	# Store the currently running track in order to periodically update it with mpc current.
-	# This is required since the track may change by itself without a button press happening.
-	# This in turn happens if a track is finished and automatically the next one in the 
-	# playlist is played.
-	current_track="mpc current --format %file% | head -1"
+	if trace_start is not None:
+		trace_pending_title = (directory, title)
+	display.show([directory, title], display_scrolling_enabled and not display_scrolling_always_disabled)
+	tracing.end("display.update", trace_start, lcd_text.readable(title))
 
 
 # print the given sequence of button presses
@@ -594,8 +755,8 @@ def sequences_match(long_list, short_list):
 # check if currently pressed button sequence matches any of the predefined sequences
 def matching_sequence_found():
 	global display_enabled
-	global media_current_dir_index
 	global button_press_sequence
+	global playing
 
 	# hidden option: show IP address at display
 	if(sequences_match(button_press_sequence, sequence_ip)):
@@ -612,12 +773,10 @@ def matching_sequence_found():
 		button_press_sequence[:] = []
 		try:
 			mpc_lock.acquire();
-			media_current_dir_index = (media_current_dir_index + 1) % len(media_directories)
-			subprocess.Popen(["mpc", "stop"])
+			snapshot = library
+			index = snapshot.directory_index.get(media_current_dir, -1)
+			switch_media_directory(snapshot.directories[(index + 1) % len(snapshot.directories)], False)
 			playing = False
-			subprocess.Popen(["mpc", "clear"])
-			subprocess.Popen(["mpc", "update"])
-			subprocess.Popen(["mpc", "add", media_dir+media_directories[media_current_dir_index]])
 		finally:
 			mpc_lock.release();
 		update_display_current(True) # TODO was False, check if it still works	
@@ -659,178 +818,301 @@ def shutdown_display():
 	finally:
 		lcd_lock.release()
 
-def get_current_media_dir(dir_name):
-	i = 0
-	for item in media_directories:
-		if item == dir_name:
-			return i
-		i = i+1
-	return -1
+# called by the media watcher thread with the list of "tag-*" directories
+# for which an update of the MPD database has been started
+def media_updated_callback(directories):
+	my_print("Datenbank wird aktualisiert für: "+", ".join(directories))
+	with playlists_pending_lock:
+		playlists_pending.update(directories)
+
+# name of the stored playlist holding the contents of the given media directory
+def get_playlist_name(directory):
+	return playlist_prefix + directory
+
+# (re-)create the stored playlists of the given media directories
+def build_playlists(directories):
+	for directory in directories:
+		name = get_playlist_name(directory)
+		try:
+			mpd.rm(name)
+		except mpd_client.MPDCommandError:
+			pass # playlist does not exist yet
+		try:
+			mpd.playlistadd(name, directory)
+		except mpd_client.MPDError as e:
+			my_print("Fehler beim Erstellen der Playlist "+name+": "+str(e), log_writer.ERROR)
+	my_print(str(len(directories))+" Playlist(s) erstellt")
+
+	# the playlists contain the current tracks of the directories, update the index accordingly
+	if track_db is not None:
+		track_scanner_thread.scan(directories)
+
+# rebuild the playlists of all directories that have been updated in the meantime,
+# does nothing while a database update is still running
+def build_pending_playlists():
+	try:
+		if 'updating_db' in mpd.status():
+			return
+	except mpd_client.MPDError as e:
+		my_print("Fehler beim Abfragen des Status: "+str(e), log_writer.ERROR)
+		return
+
+	with playlists_pending_lock:
+		directories = sorted(playlists_pending)
+		playlists_pending.clear()
+	if directories:
+		build_playlists(directories)
+
+# remember the position within the given media directory,
+# status is the MPD status while the directory is played
+def remember_resume_position(directory, status):
+	if not resume_enabled or directory is None:
+		return
+	if status.get('state') not in ('play', 'pause') or 'song' not in status:
+		return
+	position = {'song': int(status['song']), 'elapsed': round(float(status.get('elapsed', 0)), 1)}
+	resume_store.set(directory, position)
+
+# remembered position within the given media directory (None if there is none)
+def get_resume_position(directory):
+	if not resume_enabled:
+		return None
+	position = resume_store.get(directory)
+	if not isinstance(position, dict) or 'song' not in position:
+		return None
+	position.setdefault('elapsed', 0)
+
+	# check the position against the track index instead of letting MPD fail on it
+	(track, track_count) = lookup_track(directory, position['song'])
+	if track is None and track_count > 0:
+		my_print("Gespeicherte Position in Ordner "+directory+" ungültig: nur "+str(track_count)+" Titel", log_writer.WARNING)
+		resume_store.remove(directory)
+		return None
+	if track is not None and track[2] is not None and position['elapsed'] >= track[2]:
+		position['elapsed'] = 0
+	return position
+
+# called by the state store thread right before the state is written
+def sample_resume_position():
+	if not playing:
+		return
+	try:
+		mpc_lock.acquire()
+		remember_resume_position(media_current_dir, mpd.status())
+	finally:
+		mpc_lock.release()
+
+# Replace the queue with the contents of the given media directory
+# and optionally start playing it. All MPD commands are sent as one command list,
+# i.e. they are run in order within a single round trip. Returns True on success.
+# NOTE: this method may only be called if mpc_lock is already acquired
+def switch_media_directory(directory, start_playing):
+	global media_current_dir
+
+	start = time.time()
+
+	# continue at the position where the directory has been left the last time
+	resume = None
+	play_commands = []
+	if start_playing:
+		resume = get_resume_position(directory)
+		if resume is None:
+			play_commands.append(("play",))
+		else:
+			my_print("Setze Ordner "+directory+" bei Titel "+str(resume['song']+1)+" fort")
+			play_commands.append(("play", resume['song']))
+			play_commands.append(("seekcur", resume['elapsed']))
+
+	# The status is requested within the same command list in order to remember
+	# the position within the directory played so far without an additional round trip.
+	responses = None
+	try:
+		try:
+			responses = mpd.command_list([("status",), ("stop",), ("clear",), ("load", get_playlist_name(directory))] + play_commands)
+		except mpd_client.MPDCommandError as e:
+			if e.command != "load":
+				raise
+			# the playlist has not been created yet, add the directory itself
+			my_print("Playlist für Ordner "+directory+" nicht verfügbar: "+str(e), log_writer.WARNING)
+			responses = mpd.command_list([("status",), ("stop",), ("clear",), ("add", directory)] + play_commands)
+			with playlists_pending_lock:
+				playlists_pending.add(directory)
+	except mpd_client.MPDCommandError as e:
+		if resume is None or e.command not in ("play", "seekcur"):
+			my_print("Fehler beim Wechseln in Ordner "+directory+": "+str(e), log_writer.ERROR)
+			return False
+		# the remembered position does not exist anymore (e.g. files have been removed)
+		my_print("Gespeicherte Position in Ordner "+directory+" ungültig: "+str(e), log_writer.WARNING)
+		resume_store.remove(directory)
+		try:
+			mpd.play()
+		except mpd_client.MPDError as e:
+			my_print("Fehler beim Wechseln in Ordner "+directory+": "+str(e), log_writer.ERROR)
+			return False
+	except mpd_client.MPDError as e:
+		my_print("Fehler beim Wechseln in Ordner "+directory+": "+str(e), log_writer.ERROR)
+		return False
+
+	if responses is not None:
+		remember_resume_position(media_current_dir, mpd_client.pairs_to_dict(responses[0]))
+	# keep the part of the directory left behind in memory where it will be resumed
+	if warm_cache_thread is not None and media_current_dir not in (None, directory):
+		warm_cache_thread.warm([media_current_dir])
+	media_current_dir = directory
+
+	duration_in_ms = int(round((time.time() - start) * 1000))
+	my_print("Wechsel in Ordner "+directory+" in "+str(duration_in_ms)+"ms abgeschlossen")
+	return True
 
 
 ########################################################################
 # THREAD FUNCTIONS
 ########################################################################
 
-# function run by the separate display thread
-# updates the current contents of the LCD with the currently playing track
-def display_thread_callback():
-	global display_running
-	global display_current
-	global display_current_lock
-	global show_previous_timestamp
-	global display_event
-	global display_event_skip_wait
+# function run by the thread that handles reading RFID tags,
+# whenever a known tag is recognized the player switches
+# to the directory associated with the tag and selects the
+# first song to be played next
+def rfid_thread_callback():
+	while rfid_reader_running:
+		(event, uid) = card_tracker.wait()
+		handle_card_event(event, uid)
+
+# wait for an RFID card, select it and return its UID (list of 4, 7 or 10 bytes, None if no
+# valid UID could be read or no card has been detected within the given timeout in s),
+# NOTE: this function blocks until a card is detected if timeout is None
+def read_rfid_uid(timeout=None):
+	# the card has already answered the REQA of MFRC522_WaitForCard, i.e. it can be selected right away
+	if not MIFAREReader.MFRC522_WaitForCard(timeout):
+		return None
+	tracing.start_trace("rfid.wake")
+	my_print("RFID-Karte gelesen", limit=False)
+
+	(status,uid) = MIFAREReader.MFRC522_ReadUID()
+	tracing.event("rfid.anticoll", uid if status == MIFAREReader.MI_OK else "Fehler")
+	if status != MIFAREReader.MI_OK:
+		return None
+	if not any(uid):
+		return None
+	return uid
+
+# called whenever a card has been put on or removed from the reader (see card_presence.py)
+def handle_card_event(event, uid):
+	global playing
+	global rfid_paused_uid
 
-	if not display_enabled:
-		shutdown_display()
+	if event == card_presence.REMOVED:
+		tracing.event("rfid.removed", card_registry.format_uid(uid))
+		my_print("RFID-Karte entfernt", limit=False)
+		if rfid_pause_on_removal and playing and card_is_playing(uid):
+			try:
+				mpc_lock.acquire()
+				mpd.pause()
+				playing = False
+			finally:
+				mpc_lock.release()
+			rfid_paused_uid = uid
+			set_display_scrolling(False)
+			update_display_current(True)
 		return
 
-	while display_running:
-		paused = get_display_thread_paused()
-		if paused:
-			time.sleep(0.1)
-			continue
-		# Triggering the display event may have been missed.
-		# This is the case, if the display event is triggered while 
-		# the display thread (that executes this function) is currently 
-		# somewhere after the call of display_event.wait()
-		# but before the next call of display_event.wait().
-		# This may only happen if the display thread has been paused.
-		# In those cases the variable display_event_skip_wait is
-		# set to true.
-		skip_wait = False
+	paused_uid = rfid_paused_uid
+	rfid_paused_uid = None
+	if uid == paused_uid and card_is_playing(uid):
+		# the card is put back, continue where its removal has paused the playback
+		my_print("RFID-Karte zurück, Wiedergabe wird fortgesetzt", limit=False)
 		try:
-			display_event_skip_wait_lock.acquire()
-			skip_wait = display_event_skip_wait
+			mpc_lock.acquire()
+			mpd.play()
+			playing = True
 		finally:
-			display_event_skip_wait_lock.release()
-		if skip_wait:
-			try:
-				display_event_skip_wait_lock.acquire()
-				display_event_skip_wait = True
-			finally:
-				display_event_skip_wait_lock.release()
-		else:
-			display_event.wait()
-			display_event.clear()
-		check_and_show_previous()
-		if not display_scrolling_enabled:
-			write_to_lcd(display_current)
-			continue
-
-		#
-		# Show contents of display array on the display.
-		# If the text of the second row is longer than the
-		# display width, then the text is scrolled over the display.
-		#
-
-		display_framebuffer = get_display_current()
-
-		# if text fits on the display or if the scrolling is disabled, just print the text
-		if len(display_framebuffer[1]) <= display_width or not display_scrolling_enabled:
-				write_to_lcd(display_framebuffer)
-				continue
-		
-		# iterate over text of the second row
-		i = 0
-		paused = False
-		display_contents_changed = True
-		display_current_copy = get_display_current()
-		while not paused:
-			
-			# check whether to show the previous display contents again (may update display_current)
-			display_contents_before = get_display_current()
-			check_and_show_previous()
-			display_current_copy = get_display_current()
-			if i != 0 and display_contents_before != display_current_copy: # TODO check if array comparsion works
-				i = 0
-
-			# do not scroll short texts or if the scrolling is disabled in general
-			if len(display_current_copy[1]) <= display_width or not display_scrolling_enabled:
-				write_to_lcd(display_current_copy)
-				continue # go back to waiting for display event
-			# text is too long => scroll it
-			text_length = len(display_current_copy[1] + title_separator)
-			second_row = display_current_copy[1] + title_separator + display_current_copy[1]
-
-			#
-			# Example with an 8 characters display: 
-			#
-			# s c r o l l   t e x t   *   s c r o l l
-			#    |i _ _ _ _ _ _ _|_ _ _ _ _ _ _ _
-			#     0 1 2 3 4 5 6 7 0 1 2 3 4 5 6 7
-			#
-
-			# update LCD
-			display_current_copy[1] = second_row[i:i+display_width]
-			write_to_lcd(display_current_copy)
-			i = (i+1) % text_length
-			time.sleep(display_sleep)
-			paused = get_display_thread_paused()
+			mpc_lock.release()
+		set_display_scrolling(True)
+		update_display_current(True)
+	elif playing and card_is_playing(uid):
+		my_print("Ordner der RFID-Karte wird bereits abgespielt", limit=False)
+	else:
+		handle_rfid_uid(uid)
 
-# function run by the thread that handles reading RFID tags,
-# whenever a known tag is recognized the player switches
-# to the directory associated with the tag and selects the
-# first song to be played next
-def rfid_thread_callback():
-	global rfid_reader_running
-	global uid_to_tag
-	global media_titles
-	global media_directories
+# whether the directory associated with the given UID is the current directory
+def card_is_playing(uid):
+	snapshot = library
+	index = snapshot.lookup(uid)
+	return index is not None and snapshot.directories[index] == media_current_dir
+
+# switch to the directory associated with the given UID
+def handle_rfid_uid(uid):
 	global playing
-	global media_current_dir_index
-	global MIFAREReader
-	
-	while rfid_reader_running:
-		MIFAREReader.MFRC522_WaitForCard()
-
-		(status,TagType) = MIFAREReader.MFRC522_Request(MIFAREReader.PICC_REQIDL)
-		if status == MIFAREReader.MI_OK:
-			my_print("RFID-Karte gelesen")
-
-		(status,uid) = MIFAREReader.MFRC522_Anticoll()
-		if status == MIFAREReader.MI_OK:
-			uid_str = str(uid[0])+","+str(uid[1])+","+str(uid[2])+","+str(uid[3])
-			if uid_str == "0,0,0,0":
-				continue
-			elif uid_str not in uid_to_tag.keys():
-				my_print("Karte mit dieser UID nicht von der Jukebox erfasst.")
-			else:
-				my_print("UID: "+uid_str)
-				my_print("Wechsle in Ordner "+uid_to_tag[uid_str]+" ("+media_titles[uid_to_tag[uid_str]]+")")
-				play_ping_sound()
-				try:
-					mpc_lock.acquire();
-					subprocess.Popen(["mpc", "-q", "stop"])
-					playing = False
-					subprocess.Popen(["mpc", "-q", "clear"])
-					subprocess.Popen(["mpc", "-q", "update"])
-					media_current_dir_index = get_current_media_dir(uid_to_tag[uid_str])
-					subprocess.Popen(["mpc", "-q", "add", media_dir+media_directories[media_current_dir_index]])
-					subprocess.Popen(["mpc", "-q", "play"])
-				finally:
-					mpc_lock.release();
-
-				set_display_scrolling(True)
-				playing = True
-				set_display_thread_paused(UNPAUSE)
-				update_display_current(True)
 
+	# the library may be replaced in the meantime, the card is handled with the one it has been found in
+	snapshot = library
+	index = snapshot.lookup(uid)
+	tracing.event("rfid.lookup", snapshot.directories[index] if index is not None else None)
+	if index is None:
+		my_print("Karte mit dieser UID nicht von der Jukebox erfasst.")
+		return
 
-# check whether current title has changed and in case it has, initiate display update
-def title_changed_observer_callback():
-	while title_changed_observer_running:
+	directory = snapshot.directories[index]
+	my_print("UID: "+card_registry.format_uid(uid), limit=False)
+	my_print("Wechsle in Ordner "+directory+" ("+snapshot.names[index]+")")
+	play_ping_sound()
+	if warm_cache_thread is not None:
+		warm_cache_thread.used(directory)
+	try:
+		mpc_lock.acquire();
+		playing = False
+		switched = switch_media_directory(directory, True)
+	finally:
+		mpc_lock.release();
+	if not switched:
+		return
 
-		# if the jukebox is not playing, the title cannot change automatically
-		if not playing:
-			continue
+	set_display_scrolling(True)
+	playing = True
+	update_display_current(True)
 
-		mpc_current_track="mpc current --format %file% | head -1"
-		if mpc_current_track != current_track:
-			update_display_current(True)
 
-		time.sleep(title_changed_observer_sleep)
+# called by the MPD listener thread with the list of subsystems MPD reported as changed,
+# initiates a display update if the current title or the volume has changed
+def mpd_changed_callback(changed):
+	global playing
+
+	tracing.event("mpd.changed", changed)
+	if 'player' in changed or 'playlist' in changed:
+		try:
+			mpc_lock.acquire()
+			status = mpd.status()
+			song = get_current_song(status)
+			playing = (status.get('state') == 'play')
+			remember_resume_position(media_current_dir, status)
+			schedule_prefetch(status)
+		except mpd_client.MPDError as e:
+			my_print("Fehler beim Abfragen des Status: "+str(e), log_writer.ERROR)
+			return
+		finally:
+			mpc_lock.release()
+
+		if song.get('file', '') != current_track:
+			update_display_current(True, song)
+
+	if 'update' in changed:
+		build_pending_playlists()
+
+	if 'mixer' in changed:
+		try:
+			mixer_volume = mpd.get_volume()
+		except mpd_client.MPDError as e:
+			my_print("Fehler beim Abfragen der Lautstärke: "+str(e), log_writer.ERROR)
+			return
+
+		# volume changes caused by the volume buttons are already shown
+		previous_volume = volume_controller.get_volume()
+		if volume_controller.update_from_mixer(mixer_volume):
+			if mixer_volume > previous_volume:
+				text = 'Lauter'
+			else:
+				text = 'Leiser'
+			show_volume(text, mixer_volume)
 
 #-----------------------------------------------------------------------
 # CALLBACK FUNCTIONS FOR BUTTON PRESSES
@@ -852,6 +1134,7 @@ def play_pause_callback(channel):
 		if not proceed_handling(prev_callback_play_pause, button_press_sleep_time):
 			return 	
 		prev_callback_play_pause = time.time()
+		tracing.start_trace("button", "play/pause")
 
 		global button_press_sequence
 		global playing
@@ -863,7 +1146,7 @@ def play_pause_callback(channel):
 			my_print(u'>> \"Pause Knopf\" gedrückt')
 			try:
 				mpc_lock.acquire();
-				subprocess.Popen(["mpc", "-q", "pause"])
+				mpd.pause()
 				playing = False
 			finally:
 				mpc_lock.release();
@@ -872,7 +1155,7 @@ def play_pause_callback(channel):
 			my_print(u'>> \"Play Knopf\" gedrückt')
 			try:
 				mpc_lock.acquire();
-				subprocess.Popen(["mpc", "-q", "play"])
+				mpd.play()
 				playing = True
 			finally:
 				mpc_lock.release();
@@ -891,6 +1174,7 @@ def next_callback(channel):
 		if not proceed_handling(prev_callback_next, button_press_sleep_time):
 			return 	
 		prev_callback_next = time.time()
+		tracing.start_trace("button", "next")
 
 		global button_press_sequence
 		global playing
@@ -901,7 +1185,7 @@ def next_callback(channel):
 
 		try:
 			mpc_lock.acquire();
-			subprocess.Popen(["mpc", "-q", "next"])
+			mpd.next()
 			playing = True
 		finally:
 			mpc_lock.release();
@@ -923,6 +1207,7 @@ def prev_callback(channel):
 			return 	
 
 		prev_callback_prev = time.time()
+		tracing.start_trace("button", "prev")
 
 		global button_press_sequence
 		global playing
@@ -931,7 +1216,7 @@ def prev_callback(channel):
 			return
 		try:
 			mpc_lock.acquire();
-			subprocess.Popen(["mpc", "-q", "prev"])
+			mpd.previous()
 			playing = True
 		finally:
 			mpc_lock.release();
@@ -953,6 +1238,7 @@ def volume_up_callback(channel):
 	if not proceed_handling(prev_callback_volume_up, volume_button_press_sleep_time):
 		return 	
 	prev_callback_volume_up = time.time()
+	tracing.start_trace("button", "volume up")
 
 	global button_press_sequence
 	my_print(u'>> \"Lautstärke erhöhen Knopf\" gedrückt')
@@ -973,6 +1259,7 @@ def volume_down_callback(channel):
 	if not proceed_handling(prev_callback_volume_down, volume_button_press_sleep_time):
 		return 	
 	prev_callback_volume_down = time.time()
+	tracing.start_trace("button", "volume down")
 
 	global button_press_sequence
 	my_print(u'>> \"Lautstärke verringern Knopf\" gedrückt')
@@ -982,6 +1269,31 @@ def volume_down_callback(channel):
 
 	handle_volume_button_press('Leiser', False)
 
+########################################################################
+# EVENT LOOP FUNCTIONS
+########################################################################
+
+# wait for the next RFID card event on a worker thread of the event loop
+def rfid_loop_read():
+	if rfid_reader_running:
+		main_loop.run_in_executor(rfid_loop_card_event, card_tracker.wait)
+
+# called on the event loop once an RFID card has been put on or removed from the reader
+def rfid_loop_card_event(result, error):
+	if error is not None:
+		my_print("Fehler beim Lesen der RFID-Karte: "+str(error), log_writer.ERROR)
+	else:
+		handle_card_event(*result)
+	rfid_loop_read()
+
+# in event loop mode the button callbacks are run on the loop instead of the GPIO threads
+def button_callback(callback):
+	if main_loop is None:
+		return callback
+	def dispatch(channel):
+		main_loop.call_soon_threadsafe(callback, channel)
+	return dispatch
+
 ########################################################################
 # MAIN
 ########################################################################
@@ -989,77 +1301,238 @@ def volume_down_callback(channel):
 # define button callbacks
 bounce_time = 1000
 bounce_time_volume_button = 400
-GPIO.add_event_detect(gpio_play_pause,GPIO.RISING, callback=play_pause_callback, bouncetime=bounce_time)
-GPIO.add_event_detect(gpio_next,GPIO.RISING, callback=next_callback, bouncetime=bounce_time)
-GPIO.add_event_detect(gpio_prev,GPIO.RISING, callback=prev_callback, bouncetime=bounce_time)
-GPIO.add_event_detect(gpio_volume_up,GPIO.RISING, callback=volume_up_callback, bouncetime=bounce_time_volume_button)
-GPIO.add_event_detect(gpio_volume_down,GPIO.RISING, callback=volume_down_callback, bouncetime=bounce_time_volume_button)
-
-# load library
-load_library()
-print_library()
-
-# initialize audio player
-mpc_lock.acquire()
-my_print("Initialisiere mpc...")
-subprocess.Popen(["mpc", "-q", "stop"]) # just in case mpc is currently running
-subprocess.Popen(["mpc", "-q", "volume", initial_volume])
-subprocess.Popen(["mpc", "clear"])
-subprocess.Popen(["mpc", "update"])
-subprocess.Popen(["mpc", "add", media_dir+media_directories[media_current_dir_index]])
-subprocess.Popen(["mpc", "repeat", "on"])
-mpc_lock.release()
-
-# start display thread (only if scrolling is enabled)
-display_thread = Thread(target=display_thread_callback)
-display_thread.start()
-
-# show the IP address after startup for show_ip_time_ms seconds (if already connected)
-if show_ip_address_on_startup:
-	ip_address = get_ip_address()
-	if ip_address != no_ip_text: 
-		display_short_message("IP Adresse:", get_ip_address(), show_ip_time_ms)
 
-trigger_display_event()
+# start the jukebox: initialize MPD, the buttons and start all threads,
+# this is also used by the benchmarks (see benchmark/benchmark.py)
+def start_jukebox():
+	global resume_store
+	global display_thread
+	global media_watcher_thread
+	global media_watcher_enabled
+	global library_watcher_thread
+	global library_watcher_enabled
+	global rfid_thread
+	global mpd_listener_thread
+	global track_db
+	global track_index_enabled
+	global track_scanner_thread
+	global warm_cache_thread
+	global prefetcher
+
+	if tracing_enabled:
+		tracing.enable(tracing_buffer_size)
+
+	GPIO.add_event_detect(gpio_play_pause,GPIO.RISING, callback=button_callback(play_pause_callback), bouncetime=bounce_time)
+	GPIO.add_event_detect(gpio_next,GPIO.RISING, callback=button_callback(next_callback), bouncetime=bounce_time)
+	GPIO.add_event_detect(gpio_prev,GPIO.RISING, callback=button_callback(prev_callback), bouncetime=bounce_time)
+	GPIO.add_event_detect(gpio_volume_up,GPIO.RISING, callback=button_callback(volume_up_callback), bouncetime=bounce_time_volume_button)
+	GPIO.add_event_detect(gpio_volume_down,GPIO.RISING, callback=button_callback(volume_down_callback), bouncetime=bounce_time_volume_button)
+
+	# open the track index, the jukebox works without it (e.g. on a read-only file system)
+	if track_index_enabled:
+		try:
+			track_db = track_index.TrackIndex(track_index_file)
+			track_scanner_thread = track_index.TrackScanner(track_db, track_scanned_callback)
+			track_scanner_thread.start()
+		except sqlite3.Error as e:
+			my_print("Titelindex kann nicht geöffnet werden: "+str(e), log_writer.WARNING)
+			track_db = None
+			track_index_enabled = False
+
+	# start the warm cache thread, the directories are read once they have been indexed
+	if warm_cache_enabled and track_db is not None:
+		warm_cache_thread = warm_cache.WarmCache(get_warm_cache_regions, warm_cache_budget, warm_cache_lock_pages)
+		warm_cache_thread.start()
+
+	# start the prefetch threads, they follow the position reported by the MPD listener
+	if prefetch_enabled and track_db is not None:
+		prefetcher = prefetch.Prefetcher(prefetch_max_bytes, prefetch_workers)
+		prefetcher.start()
+
+	# load library
+	load_library()
+	print_library()
+
+	# load the remembered positions within the media directories
+	resume_store = state_store.StateStore(state_file, state_flush_interval, sample_resume_position)
+	if resume_enabled:
+		my_print(str(resume_store.load())+" gespeicherte Position(en) geladen")
+		resume_store.start()
+
+	# initialize audio player
+	mpc_lock.acquire()
+	my_print("Initialisiere mpd...")
+	try:
+		mpd.connect()
+		my_print("Verbunden mit MPD "+mpd.mpd_version)
+		mpd.stop() # just in case mpd is currently playing
+		volume_controller.set_volume(initial_volume) # sent to MPD once the volume thread is started
+		mpd.update()
+		mpd.repeat(True)
+
+		# Create the playlists right away so that RFID cards can be used immediately.
+		# They are created once more after the database update has finished.
+		build_playlists(library.directories)
+		with playlists_pending_lock:
+			playlists_pending.update(library.directories)
+		switch_media_directory(library.directories[0], False)
+	except mpd_client.MPDError as e:
+		my_print("Fehler beim Initialisieren von mpd: "+str(e), log_writer.ERROR)
+	finally:
+		mpc_lock.release()
 
-# start RFID thread
-if rfid_enabled:
-	rfid_thread = Thread(target=rfid_thread_callback)
-	rfid_thread.start()
+	# start display thread running the display scheduler
+	if not display_enabled:
+		shutdown_display()
+	elif not use_event_loop:
+		display_thread = Thread(target=display_loop.run_forever)
+		display_thread.start()
+	display.show(display_initial, False)
+
+	# show the IP address after startup for show_ip_time_ms seconds (if already connected)
+	if show_ip_address_on_startup:
+		ip_address = get_ip_address()
+		if ip_address != no_ip_text: 
+			display_short_message("IP Adresse:", get_ip_address(), show_ip_time_ms)
+
+	# start media watcher thread,
+	# the database is updated completely once on startup (see above) in case media
+	# have been changed while the jukebox was switched off
+	if media_watcher_enabled:
+		try:
+			media_watcher_thread = media_watcher.MediaWatcher(media_dir, media_updated_callback, settle_time=media_update_settle_time)
+			media_watcher_thread.start()
+		except OSError as e:
+			my_print("Medienverzeichnis kann nicht überwacht werden: "+str(e), log_writer.WARNING)
+			media_watcher_enabled = False
+
+	# start library watcher thread, new cards can be registered without restarting the jukebox
+	if library_watcher_enabled:
+		try:
+			library_watcher_thread = library_watcher.LibraryWatcher(library_file, library_cache_file, library_changed_callback)
+			library_watcher_thread.start()
+		except OSError as e:
+			my_print("Bibliothek kann nicht überwacht werden: "+str(e), log_writer.WARNING)
+			library_watcher_enabled = False
+
+	# start RFID thread,
+	# it may block while waiting for a card, hence it does not keep the jukebox from terminating
+	if rfid_enabled:
+		if use_event_loop:
+			main_loop.call_soon(rfid_loop_read)
+		else:
+			rfid_thread = Thread(target=rfid_thread_callback)
+			rfid_thread.daemon = True
+			rfid_thread.start()
+
+	# thread sending volume changes to MPD
+	volume_controller.start()
 
-# thread for checking whether the current title has changed
-# without a button press, in case it has changed initiate a display update
-title_changed_observer_thread = Thread(target=title_changed_observer_callback)
-title_changed_observer_thread.start()
+	# thread waiting for MPD to report changes, in case the current title
+	# has changed without a button press it initiates a display update
+	if use_event_loop:
+		mpd_listener_thread = mpd_client.MPDLoopIdleListener(main_loop, mpd_changed_callback, mpd_listener_subsystems)
+	else:
+		mpd_listener_thread = mpd_client.MPDIdleListener(mpd_changed_callback, mpd_listener_subsystems)
+	mpd_listener_thread.start()
 
-# play startup sound
-if play_startup_sound:
-	subprocess.Popen(["mpg123", "-q", startup_sound])
+	# the database update started during initialization may already have finished
+	build_pending_playlists()
+
+# write the recorded stages to the log (called on SIGUSR1), they are passed to the
+# log thread as one message, i.e. they are not interleaved with other messages
+def dump_trace(signum=None, frame=None):
+	if not tracing.enabled:
+		my_print("Tracing ist deaktiviert")
+		return
+	output = StringIO()
+	tracing.dump(output)
+	my_print(output.getvalue().rstrip("\n"), limit=False)
+
+# write the statistics of the warm cache and of the prefetcher to the log (called on SIGUSR2)
+def dump_cache_statistics(signum=None, frame=None):
+	print_cache_statistics()
+
+# stop all threads started by start_jukebox
+def stop_jukebox():
+	global rfid_reader_running
+
+	my_print("Jukebox wird beendet...")
+
+	# join all previously started threads
+	if display_thread is not None:
+		display_loop.stop()
+		display_thread.join()
+	write_to_lcd(jukebox_off_text)
+
+	if rfid_enabled:
+		rfid_reader_running = False
+
+	mpd_listener_thread.stop()
+	if not use_event_loop:
+		mpd_listener_thread.join()
+
+	volume_controller.stop()
+	volume_controller.join()
+
+	# write the remembered positions one last time
+	if resume_enabled:
+		resume_store.stop()
+		resume_store.join()
+
+	if media_watcher_enabled:
+		media_watcher_thread.stop()
+		media_watcher_thread.join()
+
+	if library_watcher_enabled:
+		library_watcher_thread.stop()
+		library_watcher_thread.join()
+
+	print_cache_statistics()
+	if prefetcher is not None:
+		prefetcher.stop()
+		prefetcher.join()
+
+	if warm_cache_thread is not None:
+		warm_cache_thread.stop()
+		warm_cache_thread.join()
+
+	if track_index_enabled:
+		track_scanner_thread.stop()
+		track_scanner_thread.join()
+		track_db.close()
 
-try:
-	time.sleep(99999999999)
-except KeyboardInterrupt:  
 	GPIO.cleanup()
 
-my_print("Jukebox wird beendet...")
+	# write the remaining messages
+	log.stop()
+	log.join()
 
-display_current_lock.acquire()
-try:
-	clear_display_current()
-	display_current = jukebox_off_text
-finally:
-	display_current_lock.release()
-trigger_display_event()
 
-# join all previously started threads
-display_running = False
-display_thread.join()
+if __name__ == "__main__":
+	start_jukebox()
+	signal.signal(signal.SIGUSR1, dump_trace)
+	signal.signal(signal.SIGUSR2, dump_cache_statistics)
 
-if rfid_enabled:
-	rfid_reader_running = False
-	rfid_thread.join()
+	# read commands for the simulated hardware from stdin
+	if simulate_hardware:
+		console_buttons = {"play": gpio_play_pause, "prev": gpio_prev, "next": gpio_next, "up": gpio_volume_up, "down": gpio_volume_down}
+		console_thread = Thread(target=simulation.run_console, args=(hw, console_buttons, sys.stdin, sys.stdout))
+		console_thread.daemon = True
+		console_thread.start()
 
-title_changed_observer_running = False
-title_changed_observer_thread.join()
+	# play startup sound
+	if play_startup_sound:
+		play_sound(startup_sound)
+
+	try:
+		if use_event_loop:
+			main_loop.run_forever()
+		else:
+			# signals (e.g. SIGUSR1, SIGUSR2) interrupt the sleep
+			while True:
+				time.sleep(3600)
+	except KeyboardInterrupt:  
+		pass
 
-GPIO.cleanup()
+	stop_jukebox()
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Differential renderer for the character LCD (HD44780 behind a PCF8574 I2C expander).
+#
+# Every byte sent to the display costs six I2C transactions (two nibbles, each
+# with enable high/low), hence rewriting the whole display (home + 32 characters)
+# on every scroll step keeps the I2C bus busy for a considerable amount of time
+# and clearing the display takes even longer.
+#
+# The renderer keeps a shadow copy of what is shown on the display and only writes
+# the cells that changed. Runs of changed cells are written with a single cursor
+# move; an unchanged cell between two changed ones is rewritten instead of moving
+# the cursor twice (both cost one byte). The display is never cleared.
+#
+
+class LCDRenderer:
+
+	# lcd: CharLCD of RPLCD (or simulation.SimulatedLCD)
+	# cols, rows: size of the display
+	def __init__(self, lcd, cols=16, rows=2):
+		self.lcd = lcd
+		self.cols = cols
+		self.rows = rows
+		self.shadow = None # characters currently shown, None if unknown
+		self.cursor = None # (row, col) of the cursor, None if unknown
+		# statistics
+		self.frames = 0
+		self.cells_written = 0
+		self.cursor_moves = 0
+
+	# forget what is shown, i.e. the next frame is written completely
+	# (e.g. if the display has been reset or written by someone else)
+	def invalidate(self):
+		self.shadow = None
+		self.cursor = None
+
+	# show the given rows (too long rows are cut, too short ones are padded with spaces)
+	def render(self, framebuffer):
+		try:
+			self._render(framebuffer)
+		except Exception:
+			# the display contents are unknown after a failed write
+			self.invalidate()
+			raise
+
+	def _render(self, framebuffer):
+		if self.shadow is None:
+			self.shadow = [[None] * self.cols for i in range(self.rows)]
+		self.frames += 1
+
+		for row in range(self.rows):
+			text = u''
+			if row < len(framebuffer):
+				text = framebuffer[row]
+				if isinstance(text, bytes):
+					text = text.decode("utf-8")
+			text = text.ljust(self.cols)[:self.cols]
+			shadow = self.shadow[row]
+
+			col = 0
+			while col < self.cols:
+				if text[col] == shadow[col]:
+					col += 1
+					continue
+				end = col + 1
+				while end < self.cols:
+					if text[end] != shadow[end]:
+						end += 1
+					elif end + 1 < self.cols and text[end + 1] != shadow[end + 1]:
+						end += 2
+					else:
+						break
+				self._write(row, col, text[col:end])
+				col = end
+
+	def _write(self, row, col, text):
+		if self.cursor != (row, col):
+			self.lcd.cursor_pos = (row, col)
+			self.cursor_moves += 1
+		self.lcd.write_string(text)
+		self.cells_written += len(text)
+		self.shadow[row][col:col + len(text)] = list(text)
+
+		# the LCD wraps the cursor after the last column, it is moved explicitly next time
+		col += len(text)
+		if col < self.cols:
+			self.cursor = (row, col)
+		else:
+			self.cursor = None
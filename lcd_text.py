@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Preparation of texts (titles, names of the library) for the character LCD.
+#
+# The A00 character ROM of the HD44780 contains ä, ö, ü and ß (see ROM_CHARACTERS),
+# they are written as the characters the A00 charmap of RPLCD (see hardware.py)
+# sends as these ROM codes: the umlauts unchanged, ß as β (the charmap has no ß).
+# The ROM has no upper case umlauts, hence Ä, Ö and Ü are shown with custom glyphs
+# instead. The glyphs are uploaded to the CGRAM of the display once (upload_glyphs)
+# and are written as the characters "\x00" to "\x02" afterwards, the other five
+# CGRAM locations remain free.
+#
+# Characters are mapped with a translation table (unicode.translate):
+# * printable ASCII characters are kept, tabs become spaces
+# * lower case umlauts are kept, ß becomes β, upper case umlauts are replaced by their custom glyph
+# * accented characters are replaced by their base character (é -> e)
+# * all other characters are removed
+# The table only contains the characters seen so far, each new character is
+# looked up once. Prepared texts are kept in a bounded LRU cache, thus the
+# title of a track is usually prepared only once.
+#
+
+import collections
+import string
+import threading
+import unicodedata
+
+# character -> character written for it, sent by RPLCD as code 0xE1, 0xEF, 0xF5 respectively 0xE2
+ROM_CHARACTERS = {u"ä": u"ä", u"ö": u"ö", u"ü": u"ü", u"ß": u"\u03b2"}
+
+# character -> (CGRAM location, 5x8 bitmap)
+GLYPHS = collections.OrderedDict([
+	(u"Ä", (0, (0b01010, 0b00000, 0b01110, 0b10001, 0b11111, 0b10001, 0b10001, 0b00000))),
+	(u"Ö", (1, (0b01010, 0b01110, 0b10001, 0b10001, 0b10001, 0b10001, 0b01110, 0b00000))),
+	(u"Ü", (2, (0b01010, 0b00000, 0b10001, 0b10001, 0b10001, 0b10001, 0b01110, 0b00000))),
+])
+
+# written character of a glyph or of the character ROM -> the character it shows
+GLYPH_CHARACTERS = dict((unichr(location), char) for char, (location, bitmap) in GLYPHS.items())
+GLYPH_CHARACTERS.update((written, char) for char, written in ROM_CHARACTERS.items())
+
+# upload the custom glyphs to the CGRAM of the given LCD,
+# NOTE: the display contents are unknown afterwards (the cursor has been moved)
+def upload_glyphs(lcd):
+	for char, (location, bitmap) in GLYPHS.items():
+		lcd.create_char(location, bitmap)
+
+# replace the glyphs of the given prepared text by the characters they show (e.g. for the log)
+def readable(text):
+	return u''.join(GLYPH_CHARACTERS.get(char, char) for char in text)
+
+
+# Translation table for unicode.translate, characters missing in the table
+# are looked up once and added afterwards.
+class TranslationTable(dict):
+
+	# characters of the character ROM that are written unchanged
+	characters = string.digits + string.ascii_letters + string.punctuation + " "
+
+	def __init__(self):
+		dict.__init__(self)
+		for char in self.characters:
+			self[ord(char)] = ord(char)
+		self[ord("\t")] = ord(" ")
+		for char, written in ROM_CHARACTERS.items():
+			self[ord(char)] = ord(written)
+		for char, (location, bitmap) in GLYPHS.items():
+			self[ord(char)] = location
+
+	def __missing__(self, code):
+		# keep the ASCII characters of the decomposed character (é -> e + accent)
+		decomposed = unicodedata.normalize("NFKD", unichr(code))
+		replacement = u''.join(char for char in decomposed if char in self.characters) or None
+		self[code] = replacement
+		return replacement
+
+
+class TextPreparer:
+
+	# size: number of prepared texts to keep
+	def __init__(self, size=1024):
+		self.size = size
+		self.table = TranslationTable()
+		self.cache = collections.OrderedDict() # text -> prepared text, least recently used first
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	# the given (unicode) text as it is written to the LCD
+	def prepare(self, text):
+		with self.lock:
+			prepared = self.cache.pop(text, None)
+			if prepared is not None:
+				self.cache[text] = prepared
+				self.hits += 1
+				return prepared
+
+			prepared = text.translate(self.table)
+			self.misses += 1
+			self.cache[text] = prepared
+			while len(self.cache) > self.size:
+				self.cache.popitem(last=False)
+		return prepared
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Watches the library file (library.json) and loads it again after it has been
+# changed, i.e. new cards can be registered without restarting the jukebox.
+#
+# The directory containing the file is watched instead of the file itself, since
+# editors and upload tools usually write a new file and rename it. Once the file
+# has not been changed for settle_time seconds it is parsed and validated on the
+# watcher thread (see card_registry.py). The new registry is only passed to the
+# callback if this succeeded, otherwise the error is passed and the jukebox keeps
+# using the previous one.
+#
+# The watcher thread sleeps until the directory changes, it only wakes up on its
+# own once a change is due to settle.
+#
+
+import os
+import threading
+import time
+
+import card_registry
+import inotify
+import pipe_event
+
+# changes of these kinds cause the library file to be loaded again
+WATCH_MASK = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_CREATE
+
+
+class LibraryWatcher(threading.Thread):
+
+	# library_file: path of library.json
+	# cache_file: path of the compact form of the library (see card_registry.load_library)
+	# callback: function called with the new registry and None or with None and the
+	#           error if the changed library file could not be loaded
+	def __init__(self, library_file, cache_file, callback, settle_time=1):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.library_file = os.path.abspath(library_file)
+		self.cache_file = cache_file
+		self.callback = callback
+		self.settle_time = settle_time
+		self.running = True
+		self.changed = None # time of the last change that has not been loaded yet
+		self.stopped = pipe_event.PipeEvent() # wakes up the thread waiting for events
+
+		self.notifier = inotify.Inotify() # raises OSError if inotify is not available
+		self.notifier.add_watch(os.path.dirname(self.library_file), WATCH_MASK)
+		self.file_name = os.path.basename(self.library_file)
+
+	def _load(self):
+		try:
+			registry = card_registry.load_library(self.library_file, self.cache_file)
+		except (IOError, OSError, ValueError) as e:
+			self.callback(None, e)
+			return
+		self.callback(registry, None)
+
+	def run(self):
+		while self.running:
+			timeout = None
+			if self.changed is not None:
+				timeout = max(0, self.changed + self.settle_time - time.time())
+			for wd, mask, cookie, name in self.notifier.read_events(timeout, self.stopped):
+				if name == self.file_name or mask & inotify.IN_Q_OVERFLOW:
+					self.changed = time.time()
+
+			if self.changed is not None and time.time() - self.changed >= self.settle_time:
+				self.changed = None
+				self._load()
+		self.notifier.close()
+
+	def stop(self):
+		self.running = False
+		self.stopped.set()
@@ -0,0 +1,203 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Non-blocking logging of the jukebox.
+#
+# Printing and flushing stdout directly from the button callbacks, the RFID thread
+# etc. blocks the caller until journald has taken the line, which may take tens of
+# milliseconds on the SD card (often while mpc_lock or the display lock is held).
+# LogWriter instead only appends the record to an in-memory queue, a background
+# thread writes the queued records in batches (one write and one flush per batch).
+#
+# * levels: records below the configured level are dropped right away
+# * rate limiting: the same debug or info message is written at most rate_limit
+#   times within rate_period seconds, further ones are counted and the count is
+#   written once the period has ended (warnings, errors and messages logged with
+#   limit=False, e.g. the contents of the library, are never suppressed)
+# * bounded memory: at most max_records records are queued, if the writer cannot
+#   keep up, new records are dropped and the number of dropped records is reported
+#
+# While nothing is queued the writer thread sleeps until the next record arrives
+# (see pipe_event.py, a waiting python 2 thread would poll otherwise).
+#
+
+import threading
+import time
+
+import pipe_event
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNUNG", ERROR: "FEHLER"}
+
+
+class LogWriter(threading.Thread):
+
+	# stream: function returning the stream to write to (e.g. lambda: sys.stdout)
+	# level: records below this level are dropped
+	# flush_interval: maximum time (in s) a record waits in the queue
+	# batch_size: the records are written right away once this many are queued
+	# max_records: maximum number of queued records
+	# rate_limit, rate_period: maximum number of equal messages within rate_period seconds
+	def __init__(self, stream, level=INFO, flush_interval=0.2, batch_size=50, max_records=1000, rate_limit=5, rate_period=10):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.stream = stream
+		self.level = level
+		self.flush_interval = flush_interval
+		self.batch_size = batch_size
+		self.max_records = max_records
+		self.rate_limit = rate_limit
+		self.rate_period = rate_period
+		self.records = []
+		self.dropped = 0
+		# message -> [start of the period, number of messages, number of suppressed messages,
+		#             level and thread of the last suppressed message]
+		self.rates = {}
+		self.lock = threading.Lock()
+		self.wakeup = pipe_event.PipeEvent() # set once records have to be written
+		self.running = True
+
+	#-------------------------------------------------------------------
+	# called by any thread, never blocks on I/O
+
+	# limit: whether the message may be suppressed by the rate limiting
+	def log(self, level, message, limit=True):
+		if level < self.level:
+			return
+		now = time.time()
+		thread = threading.current_thread().ident
+		with self.lock:
+			suppressed = 0
+			if limit and level < WARNING:
+				suppressed = self._rate_limited(message, now, level, thread)
+				if suppressed is None:
+					return
+			if len(self.records) >= self.max_records:
+				self.dropped += 1
+				return
+			self.records.append((now, level, thread, message, suppressed))
+			if len(self.records) == 1 or len(self.records) >= self.batch_size:
+				self.wakeup.set()
+
+	def debug(self, message):
+		self.log(DEBUG, message)
+
+	def info(self, message):
+		self.log(INFO, message)
+
+	def warning(self, message):
+		self.log(WARNING, message)
+
+	def error(self, message):
+		self.log(ERROR, message)
+
+	# Returns None if the message has to be suppressed, otherwise the number
+	# of equal messages that have been suppressed since it was written last.
+	# NOTE: may only be called with the lock acquired
+	def _rate_limited(self, message, now, level, thread):
+		rate = self.rates.get(message)
+		if rate is None or now - rate[0] >= self.rate_period:
+			if len(self.rates) >= self.max_records:
+				self._collect_suppressed(now, False)
+				if len(self.rates) >= self.max_records:
+					self._collect_suppressed(now, True)
+			suppressed = 0
+			if rate is not None:
+				suppressed = rate[2]
+			self.rates[message] = [now, 1, 0, level, thread]
+			return suppressed
+		if rate[1] >= self.rate_limit:
+			rate[2] += 1
+			rate[3] = level
+			rate[4] = thread
+			return None
+		rate[1] += 1
+		return 0
+
+	# Forget the messages whose period has ended (all messages if everything is set),
+	# the number of suppressed messages is queued as record.
+	# NOTE: may only be called with the lock acquired
+	def _collect_suppressed(self, now, everything):
+		for message, rate in list(self.rates.items()):
+			if everything or now - rate[0] >= self.rate_period:
+				del self.rates[message]
+				if rate[2]:
+					self.records.append((now, rate[3], rate[4], message, rate[2]))
+
+	# time (in s) the writer may wait before it has to write,
+	# None if it only has to wait for the next record
+	# NOTE: may only be called with the lock acquired
+	def _timeout(self, now):
+		if len(self.records) >= self.batch_size:
+			return 0
+		timeout = None
+		if self.records:
+			timeout = self.flush_interval
+		for rate in self.rates.values():
+			if rate[2]:
+				remaining = max(0, rate[0] + self.rate_period - now)
+				if timeout is None or remaining < timeout:
+					timeout = remaining
+		return timeout
+
+	#-------------------------------------------------------------------
+	# writer thread
+
+	def run(self):
+		while True:
+			with self.lock:
+				running = self.running
+				timeout = 0
+				if running:
+					timeout = self._timeout(time.time())
+			if timeout is None:
+				self.wakeup.wait()
+				self.wakeup.clear()
+				continue
+			if timeout > 0:
+				self.wakeup.wait(timeout)
+				self.wakeup.clear()
+			self.flush(not running)
+			if not running:
+				return
+
+	# write all queued records and the numbers of suppressed messages whose period
+	# has ended (of all suppressed messages if final is set)
+	def flush(self, final=False):
+		with self.lock:
+			self._collect_suppressed(time.time(), final)
+			records = self.records
+			dropped = self.dropped
+			self.records = []
+			self.dropped = 0
+		if not records and not dropped:
+			return
+
+		lines = []
+		for timestamp, level, thread, message, suppressed in records:
+			line = "%s.%03d thread%s: " % (time.strftime("%H:%M:%S", time.localtime(timestamp)), int(timestamp * 1000) % 1000, thread)
+			if level != INFO:
+				line += LEVEL_NAMES.get(level, str(level)) + ": "
+			line += message
+			if suppressed:
+				line += " (%d gleiche Meldung(en) unterdrückt)" % suppressed
+			lines.append(line + "\n")
+		if dropped:
+			lines.append("%d Meldung(en) verworfen, Warteschlange voll\n" % dropped)
+
+		try:
+			stream = self.stream()
+			stream.write("".join(lines))
+			stream.flush()
+		except (IOError, OSError, ValueError):
+			pass # nothing we could log this to
+
+	# write the remaining records and stop the thread
+	def stop(self):
+		with self.lock:
+			self.running = False
+		self.wakeup.set()
@@ -0,0 +1,50 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Frames of texts scrolled over the display (marquee).
+#
+# A text that is longer than the display is scrolled by showing its frames one
+# after another: "scroll text * scroll text" cut to the display width at every
+# position of the first "scroll text * ". All frames of a text are computed once
+# when the text is shown for the first time and kept in a small LRU cache, hence
+# a scroll step is only a lookup of the next frame.
+#
+
+import collections
+import threading
+
+# all frames of the given text scrolled over a display of the given width,
+# texts fitting on the display have a single frame
+def render_frames(text, width, separator):
+	if len(text) <= width:
+		return (text,)
+	looped = text + separator + text
+	return tuple(looped[position:position + width] for position in range(len(text + separator)))
+
+
+class MarqueeCache:
+
+	# size: number of texts whose frames are kept
+	def __init__(self, size=16):
+		self.size = size
+		self.cache = collections.OrderedDict() # (text, width, separator) -> frames, least recently used first
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def frames(self, text, width, separator):
+		key = (text, width, separator)
+		with self.lock:
+			frames = self.cache.pop(key, None)
+			if frames is not None:
+				self.cache[key] = frames
+				self.hits += 1
+				return frames
+
+		frames = render_frames(text, width, separator)
+		with self.lock:
+			self.misses += 1
+			self.cache[key] = frames
+			while len(self.cache) > self.size:
+				self.cache.popitem(last=False)
+		return frames
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Watches the media directory for changes and updates the MPD database
+# only for the "tag-*" directories that actually changed.
+#
+# Previously every RFID card and every directory change triggered a full
+# "mpc update", i.e. MPD rescanned the whole music directory on the slow
+# SD card while it was supposed to start playing. Now the card path never
+# triggers a rescan: the watcher thread collects the changed "tag-*"
+# directories and, once no further changes happened for settle_time seconds
+# (e.g. an upload via rsync has finished), issues one "update tag-XX" per
+# changed directory in the background.
+#
+# The watcher thread sleeps until something changes, it only wakes up on its
+# own once pending changes are due to settle.
+#
+
+import os
+import threading
+import time
+
+import inotify
+import mpd_client
+import pipe_event
+
+# changes of these kinds cause an update of the affected directory
+WATCH_MASK = (inotify.IN_CLOSE_WRITE | inotify.IN_CREATE | inotify.IN_DELETE |
+              inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO | inotify.IN_DELETE_SELF)
+
+
+class MediaWatcher(threading.Thread):
+
+	# media_dir: directory containing the "tag-*" directories (i.e. the music directory of MPD)
+	# callback: optional function called with the list of updated directories
+	def __init__(self, media_dir, callback=None, tag_prefix="tag-", settle_time=5, mpd=None):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.media_dir = media_dir.rstrip("/")
+		self.callback = callback
+		self.tag_prefix = tag_prefix
+		self.settle_time = settle_time
+		self.running = True
+		self.stopped = pipe_event.PipeEvent() # wakes up the thread waiting for events
+		if mpd is None:
+			mpd = mpd_client.MPDClient()
+		self.mpd = mpd
+
+		self.notifier = inotify.Inotify() # raises OSError if inotify is not available
+		self.watches = {}            # watch descriptor -> watched path
+		self.pending = {}            # tag directory -> timestamp of last change
+		self.pending_lock = threading.Lock()
+
+		self.root_wd = self.notifier.add_watch(self.media_dir, WATCH_MASK)
+		for name in os.listdir(self.media_dir):
+			if self._is_tag_dir(name):
+				self._watch_tree(os.path.join(self.media_dir, name))
+
+	def _is_tag_dir(self, name):
+		return name.startswith(self.tag_prefix) and os.path.isdir(os.path.join(self.media_dir, name))
+
+	# add watches for the given directory and all its subdirectories
+	def _watch_tree(self, path):
+		for dirpath, dirnames, filenames in os.walk(path):
+			try:
+				wd = self.notifier.add_watch(dirpath, WATCH_MASK)
+			except OSError:
+				continue # directory has already been removed again
+			self.watches[wd] = dirpath
+
+	# return the "tag-*" directory the given path belongs to (None for paths outside of tag directories)
+	def _tag_of(self, path):
+		relative = os.path.relpath(path, self.media_dir)
+		tag = relative.split(os.sep)[0]
+		if tag.startswith(self.tag_prefix):
+			return tag
+		return None
+
+	def _mark_changed(self, tag):
+		with self.pending_lock:
+			self.pending[tag] = time.time()
+
+	# mark all tag directories as changed (used if the kernel has dropped events)
+	def _mark_all_changed(self):
+		for name in os.listdir(self.media_dir):
+			if self._is_tag_dir(name):
+				self._mark_changed(name)
+
+	def _handle_event(self, wd, mask, name):
+		if mask & inotify.IN_Q_OVERFLOW:
+			self._mark_all_changed()
+			return
+
+		if mask & inotify.IN_IGNORED:
+			self.watches.pop(wd, None)
+			return
+
+		if wd == self.root_wd:
+			# a tag directory has been created, renamed or deleted
+			if not name.startswith(self.tag_prefix):
+				return
+			if mask & inotify.IN_ISDIR and mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+				self._watch_tree(os.path.join(self.media_dir, name))
+			self._mark_changed(name)
+			return
+
+		directory = self.watches.get(wd)
+		if directory is None:
+			return
+		path = os.path.join(directory, name)
+		if mask & inotify.IN_ISDIR and mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+			self._watch_tree(path)
+		tag = self._tag_of(path)
+		if tag is not None:
+			self._mark_changed(tag)
+
+	# return the tag directories that have not changed for settle_time seconds
+	# and remove them from the pending ones
+	def _take_settled(self):
+		now = time.time()
+		settled = []
+		with self.pending_lock:
+			for tag, timestamp in list(self.pending.items()):
+				if now - timestamp >= self.settle_time:
+					settled.append(tag)
+					del self.pending[tag]
+		return sorted(settled)
+
+	# seconds until the next pending tag directory has settled, None if nothing is pending
+	def _settle_timeout(self):
+		with self.pending_lock:
+			if not self.pending:
+				return None
+			return max(0, min(self.pending.values()) + self.settle_time - time.time())
+
+	# update the MPD database for the given directories
+	def _update(self, tags):
+		updated = []
+		for tag in tags:
+			try:
+				self.mpd.update(tag)
+				updated.append(tag)
+			except mpd_client.MPDCommandError:
+				# directory has been deleted, let MPD drop it by updating its parent
+				self.mpd.update()
+				updated.append(tag)
+		return updated
+
+	def run(self):
+		while self.running:
+			for wd, mask, cookie, name in self.notifier.read_events(self._settle_timeout(), self.stopped):
+				self._handle_event(wd, mask, name)
+
+			tags = self._take_settled()
+			if not tags:
+				continue
+			try:
+				updated = self._update(tags)
+			except mpd_client.MPDError:
+				# MPD not reachable, try again later
+				for tag in tags:
+					self._mark_changed(tag)
+				continue
+			if self.callback is not None and updated:
+				self.callback(updated)
+		self.notifier.close()
+
+	def stop(self):
+		self.running = False
+		self.stopped.set()
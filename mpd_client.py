@@ -0,0 +1,463 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Minimal client for the MPD text protocol.
+#
+# The jukebox used to fork one "mpc" process for every action
+# (play, pause, next, volume, ...). On a Raspberry Pi Zero every fork
+# costs tens of milliseconds and a burst of RAM. This module instead keeps
+# a single persistent socket connection to MPD and speaks the protocol
+# directly, so every action is a single round trip.
+#
+# If the connection breaks (e.g. MPD has been restarted) the client
+# reconnects transparently. A connection closed by MPD is noticed before a
+# command is sent. If it breaks after a command has been sent, the command is
+# only sent once more if running it twice does no harm (IDEMPOTENT_COMMANDS),
+# e.g. a "next" is never repeated since MPD may already have run it.
+#
+# Sequences of commands that need to be run in order and without other
+# commands in between (e.g. stop, clear, add, play) can be sent as one
+# command list, see MPDClient.command_list.
+#
+# MPDIdleListener uses a second connection that blocks on the "idle" command
+# and reports changes of the player, mixer, playlist etc. as soon as they happen.
+# MPDLoopIdleListener does the same without a thread on an event loop (see event_loop.py).
+#
+# Protocol reference: https://www.musicpd.org/doc/html/protocol.html
+#
+
+import os
+import re
+import select
+import socket
+import threading
+import time
+
+import tracing
+
+HELLO_PREFIX = "OK MPD "
+ERROR_PREFIX = "ACK "
+SUCCESS = "OK"
+LIST_SUCCESS = "list_OK"
+
+# commands that may be sent again after the connection broke while waiting for the response
+IDEMPOTENT_COMMANDS = frozenset(["status", "currentsong", "listallinfo", "ping", "idle",
+	"play", "pause", "stop", "seekcur", "clear", "setvol", "repeat", "update"])
+
+# raised whenever MPD cannot be talked to or answers with an error
+class MPDError(Exception):
+	pass
+
+# raised if the connection to MPD cannot be established or is lost
+class MPDConnectionError(MPDError):
+	pass
+
+# raised if MPD answers a command with "ACK [error@command_listNum] {current_command} message_text"
+class MPDCommandError(MPDError):
+
+	ACK_PATTERN = re.compile(r"^\[(\d+)@(\d+)\] \{([^}]*)\} ?(.*)$")
+
+	def __init__(self, message):
+		MPDError.__init__(self, message)
+		self.code = None
+		self.index = None     # position of the failed command within a command list
+		self.command = None   # name of the failed command
+		match = self.ACK_PATTERN.match(message)
+		if match:
+			self.code = int(match.group(1))
+			self.index = int(match.group(2))
+			self.command = match.group(3)
+
+
+# quote a single argument as required by the MPD protocol
+def escape_argument(arg):
+	arg = to_bytes(arg)
+	return b'"' + arg.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+
+# convert the given value to an UTF-8 encoded string
+def to_bytes(value):
+	if isinstance(value, bytes):
+		return value
+	if not isinstance(value, type(u"")):
+		value = u"%s" % value
+	return value.encode("utf-8")
+
+# convert a list of (key, value) pairs into a dictionary,
+# if a key occurs multiple times the last value is taken
+def pairs_to_dict(pairs):
+	result = {}
+	for key, value in pairs:
+		result[key] = value
+	return result
+
+# convert the response of a database command (e.g. listallinfo) into a list of
+# dictionaries, one per file, directories and playlists are skipped
+def pairs_to_files(pairs):
+	files = []
+	entry = None
+	for key, value in pairs:
+		if key == "file":
+			entry = {}
+			files.append(entry)
+		elif key in ("directory", "playlist"):
+			entry = None
+		if entry is not None:
+			entry[key] = value
+	return files
+
+
+class MPDClient:
+
+	def __init__(self, host=None, port=None, timeout=10):
+		# use the same defaults as mpc
+		if host is None:
+			host = os.environ.get("MPD_HOST", "localhost")
+		if port is None:
+			port = int(os.environ.get("MPD_PORT", 6600))
+		self.host = host
+		self.port = port
+		self.timeout = timeout
+		self.mpd_version = None
+		self._sock = None
+		self._rfile = None
+		self._sent = False # whether the running command has been sent
+		# only one command (or command list) may be sent over the connection at the same time
+		self._lock = threading.RLock()
+
+	# establish the connection (does nothing if already connected)
+	def connect(self):
+		with self._lock:
+			if self._sock is not None:
+				return
+			try:
+				if self.host.startswith("/"):
+					sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+					sock.settimeout(self.timeout)
+					sock.connect(self.host)
+				else:
+					sock = socket.create_connection((self.host, self.port), self.timeout)
+					sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			except (socket.error, socket.timeout) as e:
+				raise MPDConnectionError("Verbindung zu MPD fehlgeschlagen: " + str(e))
+			self._sock = sock
+			self._rfile = sock.makefile("rb")
+			hello = self._read_line()
+			if not hello.startswith(HELLO_PREFIX):
+				self.disconnect()
+				raise MPDConnectionError("Unerwartete Begrüßung von MPD: " + hello)
+			self.mpd_version = hello[len(HELLO_PREFIX):]
+
+	# close the connection (does nothing if not connected)
+	def disconnect(self):
+		with self._lock:
+			if self._rfile is not None:
+				try:
+					self._rfile.close()
+				except socket.error:
+					pass
+			if self._sock is not None:
+				try:
+					self._sock.close()
+				except socket.error:
+					pass
+			self._sock = None
+			self._rfile = None
+
+	def is_connected(self):
+		return self._sock is not None
+
+	def fileno(self):
+		return self._sock.fileno()
+
+	#-------------------------------------------------------------------
+	# low level protocol handling
+
+	def _write_line(self, line):
+		try:
+			self._sock.sendall(to_bytes(line) + b"\n")
+		except (socket.error, socket.timeout) as e:
+			raise MPDConnectionError("Senden an MPD fehlgeschlagen: " + str(e))
+		self._sent = True
+
+	def _read_line(self):
+		try:
+			line = self._rfile.readline()
+		except (socket.error, socket.timeout) as e:
+			raise MPDConnectionError("Lesen von MPD fehlgeschlagen: " + str(e))
+		if not line:
+			raise MPDConnectionError("Verbindung von MPD geschlossen")
+		if not isinstance(line, str):
+			line = line.decode("utf-8") # python 3
+		return line.rstrip("\n")
+
+	# read one response, i.e. all lines up to the terminating "OK" (or the given terminator),
+	# returns a list of (key, value) pairs
+	def _read_response(self, terminator=SUCCESS):
+		pairs = []
+		while True:
+			line = self._read_line()
+			if line == terminator:
+				return pairs
+			if line.startswith(ERROR_PREFIX):
+				raise MPDCommandError(line[len(ERROR_PREFIX):])
+			key, sep, value = line.partition(": ")
+			pairs.append((key, value))
+
+	def _format_command(self, name, args):
+		parts = [to_bytes(name)]
+		for arg in args:
+			parts.append(escape_argument(arg))
+		return b" ".join(parts)
+
+	# MPD does not send anything unless asked to, i.e. a connection that is readable
+	# before a command has been sent has been closed (e.g. MPD has been restarted)
+	def _disconnect_if_closed(self):
+		if self._sock is None:
+			return
+		try:
+			readable = select.select([self._sock], [], [], 0)[0]
+		except (select.error, socket.error):
+			readable = True
+		if readable:
+			self.disconnect()
+
+	# Run the given function on the connection. If the connection is broken, reconnect
+	# and run it once more, after the command has been sent only if it is idempotent.
+	def _execute(self, function, idempotent):
+		with self._lock:
+			for attempt in range(2):
+				self._disconnect_if_closed()
+				self.connect()
+				self._sent = False
+				try:
+					return function()
+				except MPDConnectionError:
+					self.disconnect()
+					if attempt == 1 or (self._sent and not idempotent):
+						raise
+
+	#-------------------------------------------------------------------
+	# public interface
+
+	# send a single command and return its response as list of (key, value) pairs
+	def command(self, name, *args):
+		trace_start = tracing.begin()
+		try:
+			return self._command(name, args)
+		finally:
+			tracing.end("mpd." + name, trace_start, args or None)
+
+	def _command(self, name, args):
+		line = self._format_command(name, args)
+		def run():
+			self._write_line(line)
+			return self._read_response()
+		return self._execute(run, name in IDEMPOTENT_COMMANDS)
+
+	# Send the given commands as one command list and return their responses
+	# (one list of (key, value) pairs per command). Each command is given as
+	# tuple of command name and arguments, e.g. [("clear",), ("add", "tag-01"), ("play",)].
+	# MPD runs the commands in order and stops at the first failing command,
+	# in this case MPDCommandError is raised and the remaining commands are not executed.
+	def command_list(self, commands):
+		trace_start = tracing.begin()
+		try:
+			return self._command_list(commands)
+		finally:
+			if trace_start is not None:
+				tracing.end("mpd.command_list", trace_start, " ".join(command[0] for command in commands))
+
+	def _command_list(self, commands):
+		lines = [b"command_list_ok_begin"]
+		for command in commands:
+			lines.append(self._format_command(command[0], command[1:]))
+		lines.append(b"command_list_end")
+		request = b"\n".join(lines)
+		def run():
+			self._write_line(request)
+			responses = []
+			for i in range(len(commands)):
+				responses.append(self._read_response(LIST_SUCCESS))
+			self._read_response()
+			return responses
+		return self._execute(run, all(command[0] in IDEMPOTENT_COMMANDS for command in commands))
+
+	# current status of the player (state, volume, song position, ...)
+	def status(self):
+		return pairs_to_dict(self.command("status"))
+
+	# meta data of the currently playing song (file, Title, Artist, ...)
+	def currentsong(self):
+		return pairs_to_dict(self.command("currentsong"))
+
+	def play(self, position=None):
+		if position is None:
+			self.command("play")
+		else:
+			self.command("play", position)
+
+	def pause(self):
+		self.command("pause", 1)
+
+	def stop(self):
+		self.command("stop")
+
+	def next(self):
+		self.command("next")
+
+	def previous(self):
+		self.command("previous")
+
+	def clear(self):
+		self.command("clear")
+
+	# add the given file or directory (relative to the music directory of MPD) to the queue
+	def add(self, uri):
+		self.command("add", uri)
+
+	# append the stored playlist with the given name to the queue
+	def load(self, name):
+		self.command("load", name)
+
+	# add the given file or directory to the stored playlist with the given name,
+	# the playlist is created if it does not exist yet
+	def playlistadd(self, name, uri):
+		self.command("playlistadd", name, uri)
+
+	# delete the stored playlist with the given name
+	def rm(self, name):
+		self.command("rm", name)
+
+	# update the music database, if no uri is given the whole database is updated
+	def update(self, uri=None):
+		if uri is None:
+			self.command("update")
+		else:
+			self.command("update", uri)
+
+	# meta data (file, Title, duration, Last-Modified, ...) of all files within the given
+	# directory and its subdirectories as stored in the database, in playlist order
+	def listallinfo(self, uri):
+		return pairs_to_files(self.command("listallinfo", uri))
+
+	# wait until one of the given subsystems (e.g. "player", "mixer", "playlist") changes,
+	# returns the list of changed subsystems (empty if the wait has been cancelled by noidle)
+	def idle(self, *subsystems):
+		return self._changed_subsystems(self._command("idle", subsystems)) # not traced, it may block for hours
+
+	# Non-blocking variant of idle: send_idle only sends the idle command,
+	# fetch_idle reads the response once the connection is readable.
+	# No other command may be sent in between.
+	def send_idle(self, *subsystems):
+		line = self._format_command("idle", subsystems)
+		self._execute(lambda: self._write_line(line), True)
+
+	def fetch_idle(self):
+		with self._lock:
+			return self._changed_subsystems(self._read_response())
+
+	def _changed_subsystems(self, pairs):
+		changed = []
+		for key, value in pairs:
+			if key == "changed":
+				changed.append(value)
+		return changed
+
+	# cancel a pending idle command,
+	# NOTE: this is the only method that may be called while another thread is blocked in idle
+	def noidle(self):
+		sock = self._sock
+		if sock is None:
+			return
+		try:
+			sock.sendall(b"noidle\n")
+		except socket.error:
+			pass
+
+	def repeat(self, enabled):
+		self.command("repeat", 1 if enabled else 0)
+
+	def setvol(self, volume):
+		self.command("setvol", int(volume))
+
+	# current volume in percent (-1 if MPD has no mixer)
+	def get_volume(self):
+		return int(self.status().get("volume", -1))
+
+
+# Thread that waits for changes reported by MPD and calls the given
+# callback with the list of changed subsystems. Since idle blocks the
+# connection, the listener uses its own connection.
+class MPDIdleListener(threading.Thread):
+
+	def __init__(self, callback, subsystems=("player", "mixer", "playlist"), host=None, port=None, reconnect_delay=2):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.callback = callback
+		self.subsystems = list(subsystems)
+		self.reconnect_delay = reconnect_delay
+		self.running = True
+		# no timeout: idle may block for hours while nothing happens
+		self.client = MPDClient(host, port, timeout=None)
+
+	def run(self):
+		while self.running:
+			try:
+				changed = self.client.idle(*self.subsystems)
+			except MPDError:
+				self.client.disconnect()
+				time.sleep(self.reconnect_delay)
+				continue
+			if changed and self.running:
+				self.callback(changed)
+		self.client.disconnect()
+
+	def stop(self):
+		self.running = False
+		self.client.noidle()
+
+
+# Waits for changes reported by MPD on the given event loop and calls the
+# given callback (on the loop) with the list of changed subsystems.
+class MPDLoopIdleListener:
+
+	def __init__(self, loop, callback, subsystems=("player", "mixer", "playlist"), host=None, port=None, reconnect_delay=2):
+		self.loop = loop
+		self.callback = callback
+		self.subsystems = list(subsystems)
+		self.reconnect_delay = reconnect_delay
+		self.running = False
+		self.client = MPDClient(host, port, timeout=None)
+
+	def start(self):
+		self.running = True
+		self._send_idle()
+
+	def _send_idle(self):
+		if not self.running:
+			return
+		try:
+			self.client.send_idle(*self.subsystems)
+		except MPDError:
+			self.client.disconnect()
+			self.loop.call_later(self.reconnect_delay, self._send_idle)
+			return
+		self.loop.add_reader(self.client.fileno(), self._readable)
+
+	def _readable(self):
+		self.loop.remove_reader(self.client.fileno())
+		try:
+			changed = self.client.fetch_idle()
+		except MPDError:
+			self.client.disconnect()
+			self.loop.call_later(self.reconnect_delay, self._send_idle)
+			return
+		if changed and self.running:
+			self.callback(changed)
+		self._send_idle()
+
+	def stop(self):
+		self.running = False
+		if self.client.is_connected():
+			self.loop.remove_reader(self.client.fileno())
+		self.client.disconnect()
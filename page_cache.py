@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Minimal binding of the Linux page cache API via ctypes (posix_fadvise, mmap,
+# mlock, mincore, ioprio_set), hence no additional python module needs to be
+# installed on the raspberry.
+#
+# PinnedRegion reads a part of a file into the page cache and keeps it there:
+# the part is mapped and locked into memory with mlock until it is released.
+# If locking is not permitted (see RLIMIT_MEMLOCK, i.e. "ulimit -l", or the
+# LimitMEMLOCK setting of the systemd service) the kernel is only asked to read
+# the part ahead (POSIX_FADV_WILLNEED), in this case it may be dropped from the
+# page cache again under memory pressure.
+#
+# Usage:
+#   region = PinnedRegion("/home/pi/Jukebox/media/tag-01/01.mp3", 0, 400000)
+#   ...
+#   region.release()
+#
+
+import ctypes
+import ctypes.util
+import errno
+import mmap
+import os
+import platform
+
+PAGE_SIZE = mmap.PAGESIZE
+
+# advice for posix_fadvise (see "man 2 posix_fadvise")
+POSIX_FADV_NORMAL     = 0
+POSIX_FADV_RANDOM     = 1
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED   = 3
+POSIX_FADV_DONTNEED   = 4
+
+PROT_READ = 0x1
+MAP_SHARED = 0x01
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+# I/O scheduling class "idle" for ioprio_set (see "man 2 ioprio_set")
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+# glibc has no wrapper for ioprio_set, number of the system call per architecture
+IOPRIO_SET_SYSCALLS = {"x86_64": 251, "i686": 289, "armv6l": 314, "armv7l": 314, "aarch64": 30}
+
+_libc = None
+
+def _get_libc():
+	global _libc
+	if _libc is None:
+		name = ctypes.util.find_library("c")
+		if name is None:
+			raise OSError(errno.ENOSYS, "libc nicht gefunden")
+		libc = ctypes.CDLL(name, use_errno=True)
+		libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_long, ctypes.c_long, ctypes.c_int]
+		libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+		libc.mmap.restype = ctypes.c_void_p
+		libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+		libc.mlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+		libc.munlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+		libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+		_libc = libc
+	return _libc
+
+def _raise_errno():
+	error = ctypes.get_errno()
+	raise OSError(error, os.strerror(error))
+
+# give the kernel advice about the future use of the given part of the file
+def fadvise(fd, offset, length, advice):
+	result = _get_libc().posix_fadvise(fd, offset, length, advice)
+	if result != 0:
+		raise OSError(result, os.strerror(result)) # posix_fadvise does not set errno
+
+# number of bytes of the given part of the file that are in the page cache
+def cached_bytes(fd, offset, length):
+	(start, length) = align(offset, length)
+	length = min(length, os.fstat(fd).st_size - start)
+	if length <= 0:
+		return 0
+	libc = _get_libc()
+	address = libc.mmap(None, length, PROT_READ, MAP_SHARED, fd, start)
+	if address == MAP_FAILED:
+		_raise_errno()
+	try:
+		pages = (length + PAGE_SIZE - 1) // PAGE_SIZE
+		vector = ctypes.create_string_buffer(pages)
+		if libc.mincore(address, length, vector) != 0:
+			_raise_errno()
+		return min(length, sum(1 for flags in vector.raw if ord(flags) & 1) * PAGE_SIZE)
+	finally:
+		libc.munmap(address, length)
+
+# let the calling thread only access the disk if no other process needs it
+# raises OSError if this is not supported
+def set_idle_io_priority():
+	number = IOPRIO_SET_SYSCALLS.get(platform.machine())
+	if number is None:
+		raise OSError(errno.ENOSYS, "ioprio_set wird nicht unterstützt")
+	if _get_libc().syscall(number, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) != 0:
+		_raise_errno()
+
+# (offset, length) extended to whole pages
+def align(offset, length):
+	start = offset - offset % PAGE_SIZE
+	end = offset + length
+	end += -end % PAGE_SIZE
+	return (start, end - start)
+
+
+class PinnedRegion:
+
+	# path: file to read
+	# offset, length: part of the file to read (in bytes), it is limited to the end of the file
+	# lock: whether to lock the part into memory, otherwise it is only read ahead
+	# raises OSError if the file cannot be read
+	def __init__(self, path, offset, length, lock=True):
+		self.path = path
+		self.address = None
+		self.locked = False
+		libc = _get_libc()
+		fd = os.open(path, os.O_RDONLY)
+		try:
+			file_size = os.fstat(fd).st_size
+			end = min(offset + length, file_size)
+			if end <= offset:
+				self.offset = offset
+				self.size = 0
+				return
+			(self.offset, self.size) = align(offset, end - offset)
+			self.size = min(self.size, file_size - self.offset) # pages beyond the end of the file cannot be locked
+			if lock:
+				self._lock(libc, fd)
+			if not self.locked:
+				fadvise(fd, self.offset, self.size, POSIX_FADV_WILLNEED)
+		finally:
+			os.close(fd) # a mapping stays valid after the file has been closed
+
+	def _lock(self, libc, fd):
+		address = libc.mmap(None, self.size, PROT_READ, MAP_SHARED, fd, self.offset)
+		if address == MAP_FAILED:
+			_raise_errno()
+		# mlock reads all pages that are not in the page cache yet
+		if libc.mlock(address, self.size) != 0:
+			libc.munmap(address, self.size)
+			return
+		self.address = address
+		self.locked = True
+
+	# unlock the region, its pages stay in the page cache until the kernel needs the memory
+	def release(self):
+		if self.address is not None:
+			libc = _get_libc()
+			libc.munlock(self.address, self.size)
+			libc.munmap(self.address, self.size)
+			self.address = None
+			self.locked = False
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Event (like threading.Event) whose wait blocks in select on a pipe.
+#
+# On python 2 threading.Event.wait and Condition.wait with a timeout do not
+# block: they poll the lock with sleeps of up to 50ms, i.e. every waiting thread
+# wakes up about 20 times per second (and notices a set event up to 50ms late).
+# PipeEvent.wait sleeps in the kernel until the event is set or the timeout
+# has passed.
+#
+
+import errno
+import os
+import select
+import threading
+
+import clock
+
+
+class PipeEvent:
+
+	def __init__(self):
+		self._read_fd, self._write_fd = os.pipe()
+		self._lock = threading.Lock()
+		self._set = False
+
+	# file descriptor that is readable while the event is set (e.g. for select)
+	def fileno(self):
+		return self._read_fd
+
+	def is_set(self):
+		return self._set
+
+	def set(self):
+		with self._lock:
+			if not self._set:
+				self._set = True
+				os.write(self._write_fd, b"x")
+
+	def clear(self):
+		with self._lock:
+			if self._set:
+				self._set = False
+				os.read(self._read_fd, 1)
+
+	# block until the event is set or timeout seconds have passed (None waits forever),
+	# returns whether the event is set
+	def wait(self, timeout=None):
+		if timeout is not None:
+			deadline = clock.monotonic() + timeout
+		while not self._set:
+			remaining = None
+			if timeout is not None:
+				remaining = deadline - clock.monotonic()
+				if remaining <= 0:
+					break
+			try:
+				select.select([self._read_fd], [], [], remaining)
+			except (select.error, OSError) as e:
+				if e.args[0] != errno.EINTR:
+					raise
+		return self._set
+
+	def close(self):
+		os.close(self._read_fd)
+		os.close(self._write_fd)
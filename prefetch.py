@@ -0,0 +1,157 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Reads the next track into the page cache shortly before the current track
+# ends, hence MPD does not stall on the SD card when it advances to the next
+# track on its own.
+#
+# The jukebox tells the prefetcher which file comes next and how long the
+# current track is still played (schedule), or that nothing is played (cancel).
+# Once the time has come a worker thread reads the file in chunks (at most
+# max_bytes). The workers run with the lowest CPU and I/O priority, i.e. they
+# only use the SD card while nobody else does. A read is aborted as soon as
+# another file has been scheduled or the prefetch has been cancelled.
+#
+# While nothing is scheduled the workers sleep on a pipe (see pipe_event.py),
+# otherwise until the file is due.
+#
+# Reported are the bytes read by the workers and how many of them have not been
+# in the page cache before, i.e. the I/O MPD has been spared (see statistics).
+#
+
+import os
+import threading
+
+import clock
+import page_cache
+import pipe_event
+
+CHUNK_SIZE = 256 * 1024
+
+
+class Prefetcher:
+
+	# max_bytes: maximum number of bytes read of each file
+	# workers: number of files read at the same time
+	def __init__(self, max_bytes, workers=1):
+		self.max_bytes = max_bytes
+		self.workers = workers
+		self.threads = []
+		self.running = False
+		self.lock = threading.Lock()
+		self.wakeup = pipe_event.PipeEvent() # set when the scheduled file has changed or on stop
+		self.wanted = None       # file scheduled last, reads of other files are aborted
+		self.pending = None      # (path, time) of the file to read next
+		self.active = set()      # files that are currently read
+		self.done = None         # file read last, it is not read again
+		self.files = 0
+		self.bytes_read = 0
+		self.bytes_saved = 0
+		self.aborted = 0
+		self.failures = 0
+
+	def start(self):
+		self.running = True
+		for i in range(self.workers):
+			thread = threading.Thread(target=self._run)
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def stop(self):
+		with self.lock:
+			self.running = False
+			self.wanted = None
+		self.wakeup.set()
+
+	def join(self):
+		for thread in self.threads:
+			thread.join()
+
+	# read the given file after delay seconds, replaces the file scheduled before
+	def schedule(self, path, delay):
+		with self.lock:
+			self.wanted = path
+			self.pending = None
+			if path not in self.active and path != self.done:
+				self.pending = (path, clock.monotonic() + delay)
+		self.wakeup.set()
+
+	# do not read the scheduled file, e.g. because the playback has been paused
+	def cancel(self):
+		with self.lock:
+			self.wanted = None
+			self.pending = None
+
+	# dictionary of the number of files read, aborted and failed reads,
+	# the bytes read and the bytes that have not been in the page cache before
+	def statistics(self):
+		with self.lock:
+			return {
+				'files': self.files,
+				'aborted': self.aborted,
+				'failures': self.failures,
+				'bytes_read': self.bytes_read,
+				'bytes_saved': self.bytes_saved,
+			}
+
+	# wait for the scheduled file to become due, returns its path or None if stopped
+	def _next(self):
+		while True:
+			self.wakeup.clear()
+			with self.lock:
+				if not self.running:
+					self.wakeup.set() # the other workers have to return as well
+					return None
+				timeout = None
+				if self.pending is not None:
+					(path, due) = self.pending
+					timeout = due - clock.monotonic()
+					if timeout <= 0:
+						self.pending = None
+						self.active.add(path)
+						return path
+			self.wakeup.wait(timeout)
+
+	def _run(self):
+		os.nice(19) # only changes the priority of the calling thread on Linux
+		try:
+			page_cache.set_idle_io_priority()
+		except OSError:
+			pass # e.g. unknown architecture, the reads still have the lowest CPU priority
+		while True:
+			path = self._next()
+			if path is None:
+				return
+			try:
+				self._read(path)
+			except (IOError, OSError):
+				with self.lock:
+					self.failures += 1
+			finally:
+				with self.lock:
+					self.active.discard(path)
+
+	def _read(self, path):
+		fd = os.open(path, os.O_RDONLY)
+		try:
+			length = min(self.max_bytes, os.fstat(fd).st_size)
+			missing = length - page_cache.cached_bytes(fd, 0, length)
+			page_cache.fadvise(fd, 0, length, page_cache.POSIX_FADV_SEQUENTIAL)
+			offset = 0
+			while offset < length:
+				if self.wanted != path:
+					with self.lock:
+						self.aborted += 1
+					return
+				data = os.read(fd, min(CHUNK_SIZE, length - offset))
+				if not data:
+					break
+				offset += len(data)
+		finally:
+			os.close(fd)
+		with self.lock:
+			self.done = path
+			self.files += 1
+			self.bytes_read += offset
+			self.bytes_saved += missing
@@ -0,0 +1,659 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Simulated hardware of the jukebox, allows running the jukebox (and benchmarks)
+# on a normal Linux machine without buttons, RFID reader and LCD:
+# * SimulatedGPIO: replaces RPi.GPIO, button edges can be injected with press()
+# * SimulatedMFRC522: register model of the MFRC522 RFID reader chip, presents
+#   configurable card UIDs and raises its IRQ line just like the real chip
+# * SimulatedSPI: replaces the "spi" module, forwards transfers to the
+#   simulated chip and takes as long as a transfer at the configured SPI speed
+# * SimulatedLCD: replaces the RPLCD CharLCD, keeps the characters in memory,
+#   records the shown frames and counts the I2C transactions a real
+#   HD44780 behind a PCF8574 would have needed
+#
+
+import collections
+import threading
+import time
+
+try:
+	import Queue as queue # python 2
+except ImportError:
+	import queue
+
+from clock import monotonic
+import lcd_text
+import pipe_event
+import tracing
+
+
+########################################################################
+# GPIO
+########################################################################
+
+class SimulatedGPIO:
+
+	BCM = 11
+	BOARD = 10
+	IN = 1
+	OUT = 0
+	HIGH = 1
+	LOW = 0
+	PUD_OFF = 20
+	PUD_DOWN = 21
+	PUD_UP = 22
+	RISING = 31
+	FALLING = 32
+	BOTH = 33
+
+	def __init__(self):
+		self.mode = None
+		self.levels = {}       # channel -> current level
+		self.callbacks = {}    # channel -> (edge, [callbacks], bouncetime in s)
+		self.last_edge = {}    # channel -> time of the last reported edge (for bouncetime)
+		self.edge_waiters = {} # channel -> list of (edge, PipeEvent) of the threads in wait_for_edge
+		self.lock = threading.Lock()
+		# just like RPi.GPIO all callbacks are run by one separate thread
+		self.events = queue.Queue()
+		thread = threading.Thread(target=self._dispatch_events)
+		thread.daemon = True
+		thread.start()
+
+	def setwarnings(self, enabled):
+		pass
+
+	def setmode(self, mode):
+		self.mode = mode
+
+	def setup(self, channel, direction, pull_up_down=None, initial=None):
+		with self.lock:
+			if pull_up_down == self.PUD_UP:
+				self.levels[channel] = 1
+			elif initial is not None:
+				self.levels[channel] = initial
+			else:
+				self.levels.setdefault(channel, 0)
+
+	def output(self, channel, value):
+		self.set_input(channel, 1 if value else 0)
+
+	def input(self, channel):
+		with self.lock:
+			return self.levels.get(channel, 0)
+
+	def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+		with self.lock:
+			callbacks = []
+			if callback is not None:
+				callbacks.append(callback)
+			bounce = 0
+			if bouncetime:
+				bounce = bouncetime / 1000.0
+			self.callbacks[channel] = (edge, callbacks, bounce)
+
+	# block until the given edge occurs on the given channel or timeout ms have passed,
+	# returns the channel or None on timeout (just like RPi.GPIO)
+	def wait_for_edge(self, channel, edge, bouncetime=None, timeout=None):
+		event = pipe_event.PipeEvent()
+		with self.lock:
+			if channel in self.callbacks:
+				raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+			self.edge_waiters.setdefault(channel, []).append((edge, event))
+		try:
+			if timeout is not None:
+				timeout = timeout / 1000.0
+			if event.wait(timeout):
+				return channel
+			return None
+		finally:
+			with self.lock:
+				self.edge_waiters[channel].remove((edge, event))
+			event.close()
+
+	def add_event_callback(self, channel, callback):
+		with self.lock:
+			self.callbacks[channel][1].append(callback)
+
+	def remove_event_detect(self, channel):
+		with self.lock:
+			self.callbacks.pop(channel, None)
+
+	def cleanup(self, channel=None):
+		with self.lock:
+			if channel is None:
+				self.callbacks.clear()
+			else:
+				self.callbacks.pop(channel, None)
+
+	# change the level of the given input, reports the edge to the registered callbacks
+	def set_input(self, channel, level):
+		with self.lock:
+			callbacks = self._change_level(channel, level)
+		for callback in callbacks:
+			self.events.put((callback, channel))
+
+	# returns the callbacks to run for the level change
+	# NOTE: may only be called if the lock is already acquired
+	def _change_level(self, channel, level):
+		previous = self.levels.get(channel, 0)
+		self.levels[channel] = level
+		if previous == level:
+			return []
+		for edge, event in self.edge_waiters.get(channel, []):
+			if self._detects(edge, level):
+				event.set()
+		if channel not in self.callbacks:
+			return []
+		edge, callbacks, bounce = self.callbacks[channel]
+		if not self._detects(edge, level):
+			return []
+		now = monotonic()
+		if now - self.last_edge.get(channel, -bounce - 1) < bounce:
+			return []
+		self.last_edge[channel] = now
+		return list(callbacks)
+
+	# whether a change to the given level is an edge of the given kind
+	def _detects(self, edge, level):
+		if level:
+			return edge in (self.RISING, self.BOTH)
+		return edge in (self.FALLING, self.BOTH)
+
+	# Press the button connected to the given channel (buttons pull the input up).
+	# If hold is 0 the button is released before the callbacks are run,
+	# otherwise it is released after hold seconds.
+	def press(self, channel, hold=0):
+		if hold:
+			self.set_input(channel, 1)
+			timer = threading.Timer(hold, self.set_input, (channel, 0))
+			timer.daemon = True
+			timer.start()
+			return
+		with self.lock:
+			callbacks = self._change_level(channel, 1) + self._change_level(channel, 0)
+		for callback in callbacks:
+			self.events.put((callback, channel))
+
+	def _dispatch_events(self):
+		while True:
+			callback, channel = self.events.get()
+			try:
+				callback(channel)
+			except Exception:
+				import traceback
+				traceback.print_exc()
+
+
+########################################################################
+# RFID reader
+########################################################################
+
+# CRC_A as defined in ISO 14443-3, returns the low and the high byte
+def crc_a(data):
+	crc = 0x6363
+	for byte in data:
+		byte = (byte ^ (crc & 0xFF)) & 0xFF
+		byte = (byte ^ (byte << 4)) & 0xFF
+		crc = ((crc >> 8) ^ (byte << 8) ^ (byte << 3) ^ (byte >> 4)) & 0xFFFF
+	return [crc & 0xFF, crc >> 8]
+
+# block check character of an anticollision frame
+def bcc(data):
+	result = 0
+	for byte in data:
+		result ^= byte
+	return result
+
+
+class SimulatedMFRC522:
+
+	# registers (see MFRC522.py)
+	CommandReg = 0x01
+	CommIEnReg = 0x02
+	DivIEnReg = 0x03
+	CommIrqReg = 0x04
+	DivIrqReg = 0x05
+	ErrorReg = 0x06
+	Status2Reg = 0x08
+	FIFODataReg = 0x09
+	FIFOLevelReg = 0x0A
+	ControlReg = 0x0C
+	BitFramingReg = 0x0D
+	TxControlReg = 0x14
+	CRCResultRegM = 0x21
+	CRCResultRegL = 0x22
+	VersionReg = 0x37
+
+	# commands
+	PCD_IDLE = 0x00
+	PCD_CALCCRC = 0x03
+	PCD_TRANSCEIVE = 0x0C
+	PCD_RESETPHASE = 0x0F
+
+	# card commands
+	PICC_REQIDL = 0x26
+	PICC_REQALL = 0x52
+	PICC_HALT = 0x50
+	CASCADE_LEVELS = [0x93, 0x95, 0x97]
+	CASCADE_TAG = 0x88
+
+	# interrupt request bits
+	TIMER_IRQ = 0x01
+	IDLE_IRQ = 0x10
+	RX_IRQ = 0x20
+	CRC_IRQ = 0x04
+
+	# gpio: simulated GPIO the IRQ line is connected to
+	# response_time: time (in s) a card needs to answer
+	# timeout: time (in s) after which a transceive without answer fails
+	#          (the timer configured by MFRC522_Init expires after about 15ms)
+	def __init__(self, gpio=None, irq_pin=24, response_time=0.0005, timeout=0.015):
+		self.gpio = gpio
+		self.irq_pin = irq_pin
+		self.response_time = response_time
+		self.timeout = timeout
+		self.lock = threading.RLock()
+		self.card_uid = None
+		self.card_state = "idle"   # idle, ready, active or halted
+		self.cascade_level = 0
+		self.irq_active = False
+		self.pending = None        # timer completing the running transceive
+		self.register_reads = 0
+		self.register_writes = 0
+		self._reset()
+
+	# a soft reset switches the antenna off, i.e. the card loses power and starts over
+	def _reset(self):
+		self.card_state = "idle"
+		self.registers = [0] * 64
+		self.registers[self.TxControlReg] = 0x80
+		self.registers[self.CommIEnReg] = 0x80
+		self.registers[self.CommIrqReg] = 0x14
+		self.registers[self.VersionReg] = 0x92
+		self.fifo = []
+		if self.pending is not None:
+			self.pending.cancel()
+			self.pending = None
+
+	#-------------------------------------------------------------------
+	# cards
+
+	# place a card with the given UID (list of 4, 7 or 10 bytes) on the reader
+	def present_card(self, uid):
+		with self.lock:
+			self.card_uid = list(uid)
+			self.card_state = "idle"
+			self.cascade_level = 0
+
+	# remove the card from the reader
+	def remove_card(self):
+		with self.lock:
+			self.card_uid = None
+
+	def _antenna_on(self):
+		return self.registers[self.TxControlReg] & 0x03 == 0x03
+
+	def _card_in_field(self):
+		return self.card_uid is not None and self._antenna_on()
+
+	# bytes the card answers with on an anticollision command of the given cascade level
+	def _cascade_bytes(self, level):
+		uid = self.card_uid
+		if len(uid) == 4:
+			parts = [uid]
+		elif len(uid) == 7:
+			parts = [[self.CASCADE_TAG] + uid[0:3], uid[3:7]]
+		else:
+			parts = [[self.CASCADE_TAG] + uid[0:3], [self.CASCADE_TAG] + uid[3:6], uid[6:10]]
+		if level >= len(parts):
+			return None, True
+		return parts[level], level == len(parts) - 1
+
+	#-------------------------------------------------------------------
+	# register access
+
+	def read_register(self, reg):
+		with self.lock:
+			self.register_reads += 1
+			if reg == self.FIFODataReg:
+				if self.fifo:
+					return self.fifo.pop(0)
+				return 0
+			if reg == self.FIFOLevelReg:
+				return len(self.fifo)
+			return self.registers[reg]
+
+	def write_register(self, reg, value):
+		with self.lock:
+			self.register_writes += 1
+			if reg == self.FIFODataReg:
+				if len(self.fifo) < 64:
+					self.fifo.append(value)
+				return
+			if reg == self.FIFOLevelReg:
+				if value & 0x80:
+					self.fifo = []
+				return
+			if reg in (self.CommIrqReg, self.DivIrqReg):
+				# bit 7 (Set1) decides whether the marked bits are set or cleared
+				if value & 0x80:
+					self.registers[reg] |= value & 0x7F
+				else:
+					self.registers[reg] &= ~(value & 0x7F)
+				self._update_irq()
+				return
+
+			self.registers[reg] = value
+			if reg == self.TxControlReg and not self._antenna_on():
+				self.card_state = "idle"
+			if reg == self.CommandReg:
+				self._command(value & 0x0F)
+			elif reg == self.BitFramingReg and value & 0x80:
+				if self.registers[self.CommandReg] & 0x0F == self.PCD_TRANSCEIVE:
+					self._start_transceive()
+			elif reg == self.CommIEnReg or reg == self.DivIEnReg:
+				self._update_irq()
+
+	def _command(self, command):
+		if command == self.PCD_RESETPHASE:
+			self._reset()
+			self._update_irq()
+		elif command == self.PCD_IDLE:
+			if self.pending is not None:
+				self.pending.cancel()
+				self.pending = None
+		elif command == self.PCD_CALCCRC:
+			crc = crc_a(self.fifo)
+			self.fifo = []
+			self.registers[self.CRCResultRegL] = crc[0]
+			self.registers[self.CRCResultRegM] = crc[1]
+			self.registers[self.DivIrqReg] |= self.CRC_IRQ
+			self._update_irq()
+
+	#-------------------------------------------------------------------
+	# communication with the card
+
+	def _start_transceive(self):
+		frame = self.fifo
+		self.fifo = []
+		last_bits = self.registers[self.BitFramingReg] & 0x07
+		response = self._card_response(frame, last_bits)
+		if response is None:
+			delay = self.timeout
+		else:
+			delay = self.response_time
+		if self.pending is not None:
+			self.pending.cancel()
+		self.pending = threading.Timer(delay, self._complete_transceive, (response,))
+		self.pending.daemon = True
+		self.pending.start()
+
+	# answer of the card to the given frame (None if the card does not answer)
+	def _card_response(self, frame, last_bits):
+		if not frame or not self._card_in_field():
+			return None
+
+		command = frame[-1] if last_bits == 7 else frame[0]
+		if last_bits == 7:
+			# short frame: REQA or WUPA
+			if command == self.PICC_REQIDL and self.card_state != "idle":
+				# a REQA that is not expected sends a ready or active card back to IDLE (ISO 14443-3)
+				if self.card_state != "halted":
+					self.card_state = "idle"
+				return None
+			if command not in (self.PICC_REQIDL, self.PICC_REQALL):
+				return None
+			self.card_state = "ready"
+			self.cascade_level = 0
+			if len(self.card_uid) == 4:
+				return [0x04, 0x00]
+			return [0x44, 0x00]
+
+		if command == self.PICC_HALT:
+			self.card_state = "halted"
+			return None
+
+		if command in self.CASCADE_LEVELS and len(frame) >= 2 and self.card_state in ("ready", "active"):
+			level = self.CASCADE_LEVELS.index(command)
+			part, last = self._cascade_bytes(level)
+			if part is None:
+				return None
+			if frame[1] == 0x20:
+				# anticollision: answer with the UID bytes of this level
+				return part + [bcc(part)]
+			if frame[1] == 0x70 and len(frame) >= 7:
+				# select: answer with SAK and CRC
+				if frame[2:6] != part:
+					return None
+				if last:
+					self.card_state = "active"
+					sak = 0x08
+				else:
+					sak = 0x04 # UID not complete
+				return [sak] + crc_a([sak])
+		return None
+
+	def _complete_transceive(self, response):
+		with self.lock:
+			self.pending = None
+			if response is None:
+				self.registers[self.CommIrqReg] |= self.TIMER_IRQ
+			else:
+				self.fifo = list(response)
+				self.registers[self.ControlReg] = 0x10 # all bits of the last byte valid
+				self.registers[self.CommIrqReg] |= self.RX_IRQ | self.IDLE_IRQ
+			self._update_irq()
+
+	# drive the IRQ line according to the enabled and raised interrupt requests
+	def _update_irq(self):
+		comm = self.registers[self.CommIEnReg] & self.registers[self.CommIrqReg] & 0x7F
+		div = self.registers[self.DivIEnReg] & self.registers[self.DivIrqReg] & 0x14
+		active = bool(comm or div)
+		if active == self.irq_active:
+			return
+		self.irq_active = active
+		if self.gpio is None:
+			return
+		inverted = self.registers[self.CommIEnReg] & 0x80
+		if inverted:
+			level = 0 if active else 1
+		else:
+			level = 1 if active else 0
+		self.gpio.set_input(self.irq_pin, level)
+
+
+class SimulatedSPI:
+
+	# chip: simulated MFRC522 connected to the SPI bus
+	# transfer_overhead: time (in s) every transfer takes in addition to clocking out
+	#                    the bytes (system call, driver, chip select)
+	def __init__(self, chip, transfer_overhead=0.00005):
+		self.chip = chip
+		self.transfer_overhead = transfer_overhead
+		self.speed = 1000000
+		self.transfers = 0
+		self.bytes_transferred = 0
+
+	# same interface as the spi module used by MFRC522.py
+	def openSPI(self, device='/dev/spidev0.0', speed=1000000, **kwargs):
+		self.speed = speed
+
+	def closeSPI(self):
+		pass
+
+	def reset_statistics(self):
+		self.transfers = 0
+		self.bytes_transferred = 0
+
+	def transfer(self, data):
+		data = list(data)
+		self.transfers += 1
+		self.bytes_transferred += len(data)
+		time.sleep(self.transfer_overhead + len(data) * 8.0 / self.speed)
+
+		result = [0] * len(data)
+		if not data:
+			return tuple(result)
+		if data[0] & 0x80:
+			# read: every byte addresses the register returned with the next byte
+			for i in range(1, len(data)):
+				result[i] = self.chip.read_register((data[i-1] >> 1) & 0x3F)
+		else:
+			# write: all following bytes are written to the addressed register
+			reg = (data[0] >> 1) & 0x3F
+			for value in data[1:]:
+				self.chip.write_register(reg, value)
+		return tuple(result)
+
+
+########################################################################
+# LCD
+########################################################################
+
+class SimulatedLCD(object): # new style class, required for the cursor_pos property
+
+	# every byte is sent as two nibbles, each nibble needs three I2C writes
+	# to the PCF8574 (data, enable high, enable low)
+	I2C_TRANSACTIONS_PER_BYTE = 6
+
+	# cols, rows: size of the display
+	# timing: whether to take as long as the real display for clear and home
+	# auto_linebreaks: whether to move the cursor to the next row after the last column (like RPLCD)
+	def __init__(self, cols=16, rows=2, timing=False, max_frames=1000, auto_linebreaks=True):
+		self.cols = cols
+		self.rows = rows
+		self.timing = timing
+		self.auto_linebreaks = auto_linebreaks
+		self.lock = threading.Lock()
+		self.buffer = [[' '] * cols for i in range(rows)]
+		self.row = 0
+		self.col = 0
+		self.recent_auto = False
+		self.display_enabled = True
+		self.backlight_enabled = True
+		self.custom_chars = {}
+		self.frames = collections.deque(maxlen=max_frames) # (timestamp, rows) of every shown frame
+		self.frame_listeners = []
+		self.i2c_transactions = 0
+		self.characters_written = 0
+		self.commands = 0
+
+	def _command(self, duration=0):
+		self.commands += 1
+		self.i2c_transactions += self.I2C_TRANSACTIONS_PER_BYTE
+		if self.timing and duration:
+			time.sleep(duration)
+
+	def _record_frame(self):
+		rows = tuple(''.join(row) for row in self.buffer)
+		if self.frames and self.frames[-1][1] == rows:
+			return
+		timestamp = monotonic()
+		self.frames.append((timestamp, rows))
+		for listener in self.frame_listeners:
+			listener(timestamp, rows)
+
+	# text currently shown on the display
+	def get_rows(self):
+		with self.lock:
+			return [''.join(row) for row in self.buffer]
+
+	def home(self):
+		with self.lock:
+			self._command(0.002)
+			self.row = 0
+			self.col = 0
+
+	def clear(self):
+		with self.lock:
+			self._command(0.002)
+			self.buffer = [[' '] * self.cols for i in range(self.rows)]
+			self.row = 0
+			self.col = 0
+			self._record_frame()
+
+	def _get_cursor_pos(self):
+		return (self.row, self.col)
+
+	def _set_cursor_pos(self, value):
+		with self.lock:
+			self._command()
+			self.row, self.col = value
+			self.recent_auto = False
+
+	cursor_pos = property(_get_cursor_pos, _set_cursor_pos)
+
+	def create_char(self, location, bitmap):
+		with self.lock:
+			self._command()
+			self.custom_chars[location] = tuple(bitmap)
+			self.i2c_transactions += len(bitmap) * self.I2C_TRANSACTIONS_PER_BYTE
+
+	# write the given string at the cursor position,
+	# line breaks are handled like RPLCD does it
+	def write_string(self, value):
+		with self.lock:
+			for char in value:
+				# RPLCD sends a cursor move for every line break not following an automatic one
+				if char == '\r':
+					if not self.recent_auto:
+						self._command()
+						self.col = 0
+					continue
+				if char == '\n':
+					if not self.recent_auto:
+						self._command()
+						self.row = (self.row + 1) % self.rows
+					self.recent_auto = False
+					continue
+				self.recent_auto = False
+				if self.col < self.cols:
+					self.buffer[self.row][self.col] = char
+				# else: written to the invisible part of the display memory
+				self.characters_written += 1
+				self.i2c_transactions += self.I2C_TRANSACTIONS_PER_BYTE
+				self.col += 1
+				if self.col >= self.cols and self.auto_linebreaks:
+					# RPLCD moves the cursor to the next row
+					self._command()
+					self.col = 0
+					self.row = (self.row + 1) % self.rows
+					self.recent_auto = True
+			self._record_frame()
+
+	def close(self, clear=False):
+		if clear:
+			self.clear()
+
+
+########################################################################
+# Console
+########################################################################
+
+# Read commands for the simulated hardware from the given stream (e.g. stdin):
+# * "card 176,223,243,121": place the card with the given UID on the reader
+# * "remove": remove the card from the reader
+# * "<button name>": press the button with the given name (see buttons)
+# * "lcd": print the current contents of the display
+# * "trace": print the recorded stages (see tracing.py)
+# buttons: dictionary mapping button names to GPIO channels
+def run_console(hardware, buttons, stream, output):
+	for line in iter(stream.readline, ''):
+		words = line.split()
+		if not words:
+			continue
+		if words[0] == "card" and len(words) == 2:
+			hardware.rfid.present_card([int(byte) for byte in words[1].split(",")])
+		elif words[0] == "remove":
+			hardware.rfid.remove_card()
+		elif words[0] in buttons:
+			hardware.gpio.press(buttons[words[0]])
+		elif words[0] == "lcd":
+			for row in hardware.lcd.get_rows():
+				output.write("|" + lcd_text.readable(row) + "|\n")
+		elif words[0] == "trace":
+			tracing.dump(output)
+		else:
+			output.write("Befehle: card <UID>, remove, lcd, trace, " + ", ".join(sorted(buttons)) + "\n")
+		output.flush()
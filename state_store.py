@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Persistent key/value state of the jukebox (e.g. the resume position of each
+# "tag-*" directory) stored as JSON file on the SD card.
+#
+# The whole state is read once on startup and afterwards kept in memory.
+# Changes are not written immediately: a background thread writes the state
+# every flush_interval seconds if it has changed, in order to limit flash wear
+# and to keep I/O stalls away from the playback. Writes are atomic, i.e. the
+# state is written to a temporary file which is fsync'd and then renamed,
+# hence a power cut never leaves a half written state file.
+#
+
+import json
+import os
+import threading
+
+import pipe_event
+
+
+class StateStore(threading.Thread):
+
+	# path: JSON file holding the state
+	# flush_interval: time (in s) between two writes of the state
+	# sample: optional function called before each write, e.g. to record the current position
+	def __init__(self, path, flush_interval=30, sample=None):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.path = path
+		self.flush_interval = flush_interval
+		self.sample = sample
+		self.state = {}
+		self.dirty = False
+		self.lock = threading.Lock()
+		self.stopped = pipe_event.PipeEvent() # threading.Event would poll while waiting on python 2
+
+	# read the state file (missing or broken files result in an empty state)
+	def load(self):
+		try:
+			with open(self.path) as state_file:
+				state = json.load(state_file)
+		except (IOError, OSError, ValueError):
+			state = {}
+		if not isinstance(state, dict):
+			state = {}
+		with self.lock:
+			self.state = state
+			self.dirty = False
+		return len(state)
+
+	def get(self, key):
+		with self.lock:
+			value = self.state.get(key)
+			if isinstance(value, dict):
+				value = dict(value)
+			return value
+
+	def set(self, key, value):
+		with self.lock:
+			if self.state.get(key) != value:
+				self.state[key] = value
+				self.dirty = True
+
+	def remove(self, key):
+		with self.lock:
+			if key in self.state:
+				del self.state[key]
+				self.dirty = True
+
+	# write the state to the SD card if it has changed since the last write
+	def flush(self):
+		with self.lock:
+			if not self.dirty:
+				return False
+			data = json.dumps(self.state, indent=1, sort_keys=True)
+			self.dirty = False
+
+		directory = os.path.dirname(os.path.abspath(self.path))
+		tmp_path = self.path + ".tmp"
+		try:
+			with open(tmp_path, "w") as tmp_file:
+				tmp_file.write(data)
+				tmp_file.flush()
+				os.fsync(tmp_file.fileno())
+			os.rename(tmp_path, self.path)
+
+			# make the rename itself persistent
+			dir_fd = os.open(directory, os.O_RDONLY)
+			try:
+				os.fsync(dir_fd)
+			finally:
+				os.close(dir_fd)
+		except (IOError, OSError):
+			with self.lock:
+				self.dirty = True # try again with the next flush
+			raise
+		return True
+
+	def run(self):
+		while not self.stopped.wait(self.flush_interval):
+			self._sample_and_flush()
+		self._sample_and_flush()
+
+	def _sample_and_flush(self):
+		try:
+			if self.sample is not None:
+				self.sample()
+			self.flush()
+		except Exception:
+			pass # the next flush will try again
+
+	# stop the thread, the state is written one last time before the thread terminates
+	def stop(self):
+		self.stopped.set()
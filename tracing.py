@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Lightweight tracing of the stages of the jukebox (RFID reader, MPD commands, display).
+#
+# Every stage is recorded with the monotonic clock into an in-memory ring buffer
+# holding the most recent records. The buffer is written out by dump(), e.g. when
+# the jukebox receives SIGUSR1:
+#   sudo systemctl kill -s USR1 jukebox
+#
+# Records belong to a trace, e.g. all stages caused by one RFID card or one button
+# press. A new trace is started by start_trace(), all following records belong to
+# that trace until the next one is started.
+#
+# Usage:
+#   tracing.start_trace("button", "next")     # new trace
+#   tracing.event("rfid.anticoll", uid)       # a single point in time
+#   start = tracing.begin()
+#   ...
+#   tracing.end("mpd.command", start, name)   # a span from start until now
+#
+# Tracing is disabled by default. While it is disabled all functions return
+# immediately (begin() returns None which makes end() return immediately as well),
+# hence instrumented code only pays for a function call. The details passed to
+# the functions are only formatted when the buffer is dumped.
+#
+
+import collections
+import threading
+
+from clock import monotonic
+
+enabled = False
+buffer_size = 2000
+
+# records: (trace, start, duration or None, thread ident, name, detail)
+_records = collections.deque(maxlen=buffer_size)
+_trace = 0
+_trace_lock = threading.Lock()
+
+# enable tracing with a ring buffer of the given size (the buffer is cleared)
+def enable(size=None):
+	global enabled
+	global buffer_size
+	global _records
+	if size is not None:
+		buffer_size = size
+	_records = collections.deque(maxlen=buffer_size)
+	enabled = True
+
+def disable():
+	global enabled
+	enabled = False
+
+# start a new trace, e.g. for a detected RFID card or a pressed button
+def start_trace(name, detail=None):
+	global _trace
+	if not enabled:
+		return
+	with _trace_lock:
+		_trace += 1
+		_records.append((_trace, monotonic(), None, threading.current_thread().ident, name, detail))
+
+# record a single point in time
+def event(name, detail=None):
+	if not enabled:
+		return
+	_records.append((_trace, monotonic(), None, threading.current_thread().ident, name, detail))
+
+# start timestamp of a span (None if tracing is disabled)
+def begin():
+	if not enabled:
+		return None
+	return monotonic()
+
+# record the span from the given start timestamp (see begin) until now
+def end(name, start, detail=None):
+	if start is None:
+		return
+	_records.append((_trace, start, monotonic() - start, threading.current_thread().ident, name, detail))
+
+# copy of the records currently held in the ring buffer
+def records():
+	return list(_records)
+
+# write the records of the ring buffer to the given stream, grouped by trace,
+# the times are given relative to the first record of each trace
+def dump(stream):
+	current = records()
+	stream.write("Trace-Puffer: %d Einträge\n" % len(current))
+	trace = None
+	trace_start = 0
+	for record_trace, start, duration, thread, name, detail in sorted(current, key=lambda record: (record[0], record[1])):
+		if record_trace != trace:
+			trace = record_trace
+			trace_start = start
+			stream.write("Trace %d:\n" % trace)
+		line = "  %+10.3fms" % ((start - trace_start) * 1000)
+		if duration is None:
+			line += " %10s" % ""
+		else:
+			line += " %8.3fms" % (duration * 1000)
+		line += "  %-24s thread%-16s" % (name, thread)
+		if isinstance(detail, tuple):
+			line += " " + " ".join("%s" % (value,) for value in detail)
+		elif detail is not None:
+			line += " %s" % (detail,)
+		stream.write(line + "\n")
+	stream.flush()
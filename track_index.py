@@ -0,0 +1,202 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Local index of the library and of the tracks of the "tag-*" directories
+# stored in a SQLite database (library.db):
+#   tags:   directory and name of every entry of the library
+#   cards:  UID (as in library.json) and directory of every card
+#   tracks: file, directory, position within the directory, title, duration and
+#           modification time of every track
+#
+# Titles, durations and the contents of the playlists can thus be looked up
+# without asking MPD or reading the SD card, e.g. by the display, by the resume
+# logic and by helper/track_index_query.py.
+#
+# The tracks are taken from the MPD database (listallinfo) by the TrackScanner
+# thread, one directory at a time and in the background. Only tracks that are new or
+# whose modification time has changed are written, tracks that have disappeared
+# are deleted. Each directory is written in one transaction, i.e. readers never
+# see a directory that has been scanned halfway.
+#
+# Other processes (e.g. helper/track_index_query.py) open the index read-only,
+# they neither create nor migrate it.
+#
+# A single connection is shared by all threads and guarded by a lock, all
+# queries are simple lookups by primary key or by directory.
+#
+
+import sqlite3
+import threading
+try:
+	import Queue as queue # python 2
+except ImportError:
+	import queue
+
+import card_registry
+import mpd_client
+
+SCHEMA_VERSION = 1
+SCHEMA = [
+	"CREATE TABLE tags (directory TEXT PRIMARY KEY, name TEXT NOT NULL)",
+	"CREATE TABLE cards (uid TEXT PRIMARY KEY, directory TEXT NOT NULL)",
+	"CREATE TABLE tracks (file TEXT PRIMARY KEY, directory TEXT NOT NULL, position INTEGER NOT NULL,"
+		" title TEXT, duration REAL, mtime TEXT)",
+	"CREATE INDEX tracks_directory ON tracks (directory, position)",
+]
+
+
+class TrackIndex:
+
+	# path: database file, it is created if it does not exist yet (unless read_only is set)
+	# read_only: only query the index, it is neither created nor migrated
+	# raises sqlite3.Error if the database cannot be opened or if it has another
+	# schema version and read_only is set
+	def __init__(self, path, read_only=False):
+		self.path = path
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(path, check_same_thread=False)
+		self.connection.text_factory = str # UTF-8 encoded strings just like the ones received from MPD
+		with self.lock:
+			if read_only:
+				self._check()
+			else:
+				self._setup()
+
+	# refuse any writes of this connection (sqlite3 of python 2 cannot open a "file:...?mode=ro" URI)
+	def _check(self):
+		connection = self.connection
+		connection.execute("PRAGMA query_only=ON")
+		(version,) = connection.execute("PRAGMA user_version").fetchone()
+		if version != SCHEMA_VERSION:
+			connection.close()
+			raise sqlite3.DatabaseError("Titelindex hat die Version %d statt %d" % (version, SCHEMA_VERSION))
+
+	# create the tables, an index of another schema version is created again
+	def _setup(self):
+		connection = self.connection
+		# fewer writes to the SD card, a power cut may only lose the last scan
+		connection.execute("PRAGMA journal_mode=WAL")
+		connection.execute("PRAGMA synchronous=NORMAL")
+		(version,) = connection.execute("PRAGMA user_version").fetchone()
+		if version == SCHEMA_VERSION:
+			return
+		with connection:
+			for table in ("tags", "cards", "tracks"):
+				connection.execute("DROP TABLE IF EXISTS " + table)
+			for statement in SCHEMA:
+				connection.execute(statement)
+			connection.execute("PRAGMA user_version=%d" % SCHEMA_VERSION)
+
+	def close(self):
+		with self.lock:
+			self.connection.close()
+
+	# Replace the tags and cards by the ones of the given registry (see card_registry.py),
+	# the tracks of directories that are not part of the library anymore are deleted.
+	def update_library(self, registry):
+		with self.lock, self.connection as connection:
+			connection.execute("DELETE FROM tags")
+			connection.executemany("INSERT INTO tags (directory, name) VALUES (?, ?)",
+				zip(registry.directories, registry.names))
+			connection.execute("DELETE FROM cards")
+			connection.executemany("INSERT INTO cards (uid, directory) VALUES (?, ?)",
+				[(card_registry.format_uid(uid), registry.directories[index]) for uid, index in registry.entries()])
+			connection.execute("DELETE FROM tracks WHERE directory NOT IN (SELECT directory FROM tags)")
+
+	# Store the tracks of the given directory given as list of (file, title, duration, mtime)
+	# in playlist order. Returns the number of tracks that have been added, changed or removed.
+	def update_directory(self, directory, tracks):
+		with self.lock, self.connection as connection:
+			known = dict((row[0], row[1:]) for row in connection.execute(
+				"SELECT file, position, mtime FROM tracks WHERE directory = ?", (directory,)))
+			changed = []
+			for position, (file, title, duration, mtime) in enumerate(tracks):
+				if known.pop(file, None) != (position, mtime):
+					changed.append((file, directory, position, title, duration, mtime))
+			connection.executemany("INSERT OR REPLACE INTO tracks (file, directory, position, title, duration, mtime)"
+				" VALUES (?, ?, ?, ?, ?, ?)", changed)
+			connection.executemany("DELETE FROM tracks WHERE file = ?", [(file,) for file in known])
+		return len(changed) + len(known)
+
+	# list of (directory, name, number of tracks) of all tags
+	def directories(self):
+		with self.lock:
+			return self.connection.execute("SELECT tags.directory, tags.name, COUNT(tracks.file) FROM tags"
+				" LEFT JOIN tracks ON tracks.directory = tags.directory GROUP BY tags.directory ORDER BY tags.directory").fetchall()
+
+	# list of (file, title, duration) of the tracks of the given directory in playlist order
+	def tracks(self, directory):
+		with self.lock:
+			return self.connection.execute("SELECT file, title, duration FROM tracks WHERE directory = ?"
+				" ORDER BY position", (directory,)).fetchall()
+
+	# number of known tracks of the given directory
+	def track_count(self, directory):
+		with self.lock:
+			return self.connection.execute("SELECT COUNT(*) FROM tracks WHERE directory = ?", (directory,)).fetchone()[0]
+
+	# (file, title, duration) of the track at the given position within the given directory (None if unknown)
+	def track_at(self, directory, position):
+		with self.lock:
+			return self.connection.execute("SELECT file, title, duration FROM tracks WHERE directory = ? AND position = ?",
+				(directory, position)).fetchone()
+
+	# list of the UIDs of the cards associated with the given directory
+	def cards(self, directory):
+		with self.lock:
+			return [row[0] for row in self.connection.execute(
+				"SELECT uid FROM cards WHERE directory = ? ORDER BY uid", (directory,))]
+
+
+# (file, title, duration, mtime) of a track as listed by MPD (see MPDClient.listallinfo)
+def track_from_mpd(info):
+	duration = info.get('duration', info.get('Time'))
+	if duration is not None:
+		duration = float(duration)
+	return (info['file'], info.get('Title'), duration, info.get('Last-Modified'))
+
+
+# Thread scanning the directories passed to scan() in the background. It uses its own
+# connection to MPD, hence a large directory does not delay the commands of the jukebox.
+class TrackScanner(threading.Thread):
+
+	# index: TrackIndex the tracks are written to
+	# callback: optional function called with the directory, the number of changed tracks
+	#           and None or with the directory, 0 and the error if the directory could not be scanned
+	def __init__(self, index, callback=None, mpd=None):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.index = index
+		self.callback = callback
+		self.running = True
+		self.queue = queue.Queue()
+		if mpd is None:
+			mpd = mpd_client.MPDClient()
+		self.mpd = mpd
+
+	# scan the given directories (again)
+	def scan(self, directories):
+		for directory in directories:
+			self.queue.put(directory)
+
+	def _scan(self, directory):
+		try:
+			tracks = [track_from_mpd(info) for info in self.mpd.listallinfo(directory)]
+			changed = self.index.update_directory(directory, tracks)
+		except (mpd_client.MPDError, sqlite3.Error) as e:
+			if self.callback is not None:
+				self.callback(directory, 0, e)
+			return
+		if self.callback is not None:
+			self.callback(directory, changed, None)
+
+	def run(self):
+		while self.running:
+			directory = self.queue.get()
+			if directory is not None: # None is put by stop()
+				self._scan(directory)
+		self.mpd.disconnect()
+
+	def stop(self):
+		self.running = False
+		self.queue.put(None)
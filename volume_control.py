@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Keeps track of the MPD volume within the jukebox process.
+#
+# Pressing a volume button only changes the local volume value and returns
+# immediately, i.e. the new volume can be shown on the display without
+# asking MPD. A background thread sends the new volume to MPD as a single
+# absolute "setvol". Presses happening while a change is pending (e.g. the
+# button is pressed several times in a row) are coalesced into that one command.
+#
+# Volume changes made by other MPD clients are reported by the MPD listener
+# thread via update_from_mixer, which keeps the local value in sync.
+#
+
+import threading
+import time
+
+import mpd_client
+
+
+class VolumeController(threading.Thread):
+
+	# mpd: MPD client used for sending the volume
+	# coalesce_time: time (in s) to wait for further button presses before sending the volume
+	def __init__(self, mpd, coalesce_time=0.1, min_volume=0, max_volume=100):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.mpd = mpd
+		self.coalesce_time = coalesce_time
+		self.min_volume = min_volume
+		self.max_volume = max_volume
+		self.volume = -1          # authoritative volume (-1 as long as unknown)
+		self.pending = False      # whether self.volume still has to be sent to MPD
+		self.running = True
+		self.condition = threading.Condition()
+
+	# current volume, includes changes that have not been sent to MPD yet
+	def get_volume(self):
+		with self.condition:
+			return self.volume
+
+	# set the volume to the given value, e.g. on startup
+	def set_volume(self, volume):
+		with self.condition:
+			self.volume = max(self.min_volume, min(self.max_volume, volume))
+			self.pending = True
+			self.condition.notify()
+			return self.volume
+
+	# change the volume by the given amount of percent and return the new volume
+	def change(self, change):
+		with self.condition:
+			if self.volume < 0:
+				return -1 # volume not known yet
+			return self.set_volume(self.volume + change)
+
+	# To be called with the volume reported by MPD after the mixer has changed.
+	# Returns True if the volume has been changed by someone else (e.g. another MPD client)
+	# and False if MPD just reports a volume set by this controller.
+	def update_from_mixer(self, volume):
+		with self.condition:
+			if volume < 0 or self.pending or volume == self.volume:
+				return False
+			self.volume = volume
+			return True
+
+	def run(self):
+		while self.running:
+			with self.condition:
+				while self.running and not self.pending:
+					self.condition.wait()
+			if not self.running:
+				break
+
+			# give further button presses the chance to be coalesced into one command
+			time.sleep(self.coalesce_time)
+
+			with self.condition:
+				volume = self.volume
+			try:
+				self.mpd.setvol(volume)
+			except mpd_client.MPDError:
+				time.sleep(1) # MPD not reachable, try again later
+				continue
+			with self.condition:
+				# the volume may have been changed again while setvol was running
+				if self.volume == volume:
+					self.pending = False
+
+	def stop(self):
+		with self.condition:
+			self.running = False
+			self.condition.notify()
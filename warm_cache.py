@@ -0,0 +1,172 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Keeps the beginning of the first track and the part of the resume track that
+# is played next of every "tag-*" directory in memory, hence MPD does not have
+# to wait for the SD card when a card is put on the reader.
+#
+# The parts are read in the background by the WarmCache thread and locked into
+# memory (see page_cache.py) as long as they fit into the memory budget.
+# If a directory does not fit anymore the directories whose cards have not been
+# used for the longest time are released first.
+#
+# Whether the directory of a card has been warm when the card was used is
+# counted (hits and misses), see statistics(), e.g. in order to choose the budget.
+#
+
+import collections
+import os
+import threading
+try:
+	import Queue as queue # python 2
+except ImportError:
+	import queue
+
+import page_cache
+
+# assumed bit rate (in bytes per second) of tracks whose duration is unknown (320 kbit/s)
+DEFAULT_BYTE_RATE = 40000
+# additionally read for the tags (e.g. ID3 incl. cover image) at the beginning of a file
+TAG_SIZE = 64 * 1024
+
+WARM = "warm"
+REMOVE = "remove"
+
+
+# (path, offset, length) of the part of the given file played within seconds starting at start (in s),
+# duration: duration of the track in s (None if unknown)
+# raises OSError if the file does not exist
+def track_region(path, duration, start, seconds):
+	size = os.path.getsize(path)
+	if duration:
+		byte_rate = size / float(duration)
+	else:
+		byte_rate = DEFAULT_BYTE_RATE
+	if start > 0:
+		return (path, int(start * byte_rate), int(seconds * byte_rate))
+	return (path, 0, TAG_SIZE + int(seconds * byte_rate))
+
+
+class WarmCache(threading.Thread):
+
+	# regions: function returning the list of (path, offset, length) to keep in memory
+	#          for the given directory (e.g. computed with track_region), it is called
+	#          by the thread and must not raise exceptions
+	# budget: maximum number of bytes kept in memory
+	# lock_pages: whether to lock the parts into memory, otherwise they are only read ahead
+	def __init__(self, regions, budget, lock_pages=True):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.regions = regions
+		self.budget = budget
+		self.lock_pages = lock_pages
+		self.running = True
+		self.queue = queue.Queue()
+		self.lock = threading.Lock()
+		self.queued = set() # directories queued to be read, each one is queued only once
+		self.entries = collections.OrderedDict() # directory -> list of PinnedRegion, least recently used first
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.failures = 0
+
+	# read the given directories (again), e.g. after they or their resume positions have changed
+	def warm(self, directories):
+		for directory in directories:
+			with self.lock:
+				if directory in self.queued:
+					continue
+				self.queued.add(directory)
+			self.queue.put((WARM, directory))
+
+	# release the given directories, e.g. after they have been removed from the library
+	def remove(self, directories):
+		for directory in directories:
+			self.queue.put((REMOVE, directory))
+
+	def is_warm(self, directory):
+		with self.lock:
+			return directory in self.entries
+
+	# called when the given directory is about to be played,
+	# counts a hit or miss and marks the directory as most recently used
+	def used(self, directory):
+		with self.lock:
+			regions = self.entries.pop(directory, None)
+			if regions is None:
+				self.misses += 1
+				return
+			self.hits += 1
+			self.entries[directory] = regions
+
+	# dictionary of the numbers of hits, misses, evictions and failed reads,
+	# of the number of warm directories and of the bytes kept in memory (total and locked)
+	def statistics(self):
+		with self.lock:
+			return {
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+				'failures': self.failures,
+				'directories': len(self.entries),
+				'bytes': self.size,
+				'locked_bytes': sum(region.size for regions in self.entries.values() for region in regions if region.locked),
+				'budget': self.budget,
+			}
+
+	def _release(self, directory):
+		with self.lock:
+			regions = self.entries.pop(directory, [])
+			self.size -= sum(region.size for region in regions)
+		for region in regions:
+			region.release()
+
+	def _warm(self, directory):
+		wanted = self.regions(directory)
+		self._release(directory)
+		# the regions are kept in whole pages
+		requested = sum(page_cache.align(offset, length)[1] for path, offset, length in wanted)
+		if not wanted or requested > self.budget:
+			return
+
+		# release the least recently used directories until the new one fits
+		while True:
+			with self.lock:
+				if self.size + requested <= self.budget:
+					break
+				oldest = next(iter(self.entries))
+				self.evictions += 1
+			self._release(oldest)
+
+		regions = []
+		for path, offset, length in wanted:
+			try:
+				regions.append(page_cache.PinnedRegion(path, offset, length, self.lock_pages))
+			except OSError:
+				with self.lock:
+					self.failures += 1
+		if not regions:
+			return
+		with self.lock:
+			self.entries[directory] = regions
+			self.size += sum(region.size for region in regions)
+
+	def run(self):
+		while self.running:
+			item = self.queue.get()
+			if item is None: # put by stop()
+				continue
+			(action, directory) = item
+			if action == WARM:
+				with self.lock:
+					self.queued.discard(directory)
+				self._warm(directory)
+			else:
+				self._release(directory)
+		for directory in list(self.entries):
+			self._release(directory)
+
+	def stop(self):
+		self.running = False
+		self.queue.put(None)